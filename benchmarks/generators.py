@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+from libcovulor.finding import Finding
+
+import random
+
+TOOLS = ('Opengrep', 'Bandit', 'Gitleaks', 'Checkov', 'Trivy')
+SEVERITIES = (Finding.SEVERITY_CRITICAL, Finding.SEVERITY_HIGH, Finding.SEVERITY_MEDIUM, Finding.SEVERITY_LOW, Finding.SEVERITY_INFO)
+# Real scans are mostly medium and low findings
+SEVERITY_WEIGHTS = (2, 10, 40, 35, 13)
+STATUSES = (Finding.STATUS_NEW, Finding.STATUS_ENRICHED, Finding.STATUS_READY, Finding.STATUS_ISSUED, Finding.STATUS_SOLVED)
+STATUS_WEIGHTS = (50, 20, 15, 10, 5)
+CWES = (20, 22, 78, 79, 89, 200, 287, 327, 352, 502, 798, 918)
+LANGUAGES = ('python', 'javascript', 'java', 'go', 'terraform')
+DIRECTORIES = ('src', 'app', 'lib', 'services/api', 'infra', 'tests')
+
+SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+
+# Reproducible findings shaped like a scan: a few thousand files, repeated rules and a duplicate every so often
+def iter_findings(count: int, client_id: str = 'benchmark', repo_id: str = 'repository', scan_id: str = 'scan', seed: int = 42):
+    rng = random.Random(seed)
+    files = [f'{rng.choice(DIRECTORIES)}/module_{index}.{rng.choice(("py", "js", "java", "go", "tf"))}' for index in range(max(count // 20, 1))]
+    started = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    for index in range(count):
+        tool = rng.choice(TOOLS)
+        cwe = rng.choice(CWES)
+        line = rng.randint(1, 2000)
+        rule = f'{tool.lower()}.rule-{cwe}-{rng.randint(1, 20)}'
+
+        yield {
+            Finding.CLIENT_ID: client_id,
+            Finding.REPOSITORY_ID: repo_id,
+            Finding.SCAN_ID: scan_id,
+            Finding.TOOL: tool,
+            Finding.TITLE: f'Potential CWE-{cwe} in {rule}',
+            Finding.DESCRIPTION: f'{rule} matched user controlled input reaching a sensitive sink. ' * rng.randint(1, 4),
+            Finding.SCANNER_WEAKNESS: rule,
+            Finding.ID: f'{rule}:{index}',
+            Finding.FILE: rng.choice(files),
+            Finding.ACTUAL_LINE: line,
+            Finding.ORIGINAL_LINE: line,
+            Finding.START_COLUMN: rng.randint(1, 40),
+            Finding.END_COLUMN: rng.randint(41, 120),
+            Finding.SEVERITY: rng.choices(SEVERITIES, SEVERITY_WEIGHTS)[0],
+            Finding.STATUS: rng.choices(STATUSES, STATUS_WEIGHTS)[0],
+            Finding.CONFIDENCE: rng.choice((25, 50, 75, 90)),
+            Finding.CWE: cwe,
+            Finding.CVSSV3_SCORE: round(rng.uniform(0, 10), 1),
+            Finding.EPSS: round(rng.random() ** 4, 5),
+            Finding.LANGUAGE: rng.choice(LANGUAGES),
+            Finding.TAGS: rng.sample(('security', 'injection', 'secrets', 'iac', 'kev', 'exploit'), rng.randint(0, 3)),
+            Finding.SINGLE_LINE_CODE: f'value = call_{rng.randint(1, 500)}(request.args["{rng.choice(("id", "q", "path"))}"])',
+            Finding.DATE: started + timedelta(seconds=index)
+        }
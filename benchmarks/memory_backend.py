@@ -0,0 +1,528 @@
+from bson import ObjectId
+from datetime import datetime
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+import copy
+import functools
+
+# In-memory stand-in for the subset of the Motor collection API the library uses. Every awaited call or
+# cursor counts as one round trip, so benchmarks can compare access patterns without a server.
+
+MISSING = object()
+
+# BSON comparison order between types
+def get_type_rank(value) -> int:
+    if value is None or value is MISSING:
+        return 0
+    if isinstance(value, bool):
+        return 7
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, list):
+        return 4
+    if isinstance(value, ObjectId):
+        return 6
+    if isinstance(value, datetime):
+        return 8
+
+    return 9
+
+def compare(first, second) -> int:
+    first_rank, second_rank = get_type_rank(first), get_type_rank(second)
+
+    if first_rank != second_rank:
+        return -1 if first_rank < second_rank else 1
+
+    if first_rank == 0 or first == second:
+        return 0
+
+    try:
+        return -1 if first < second else 1
+    except TypeError:
+        return -1 if str(first) < str(second) else 1
+
+def get_field(document: dict, path: str):
+    value = document
+
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else MISSING
+        else:
+            return MISSING
+
+    return value
+
+def set_field(document: dict, path: str, value):
+    parts = path.split('.')
+
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+
+    document[parts[-1]] = value
+
+TYPE_NAMES = {'string': str, 'double': float, 'int': int, 'bool': bool, 'object': dict, 'array': list, 'objectId': ObjectId, 'date': datetime}
+
+def matches_operator(value, operator: str, argument) -> bool:
+    candidates = value if isinstance(value, list) else [value]
+
+    if operator == '$eq':
+        return any(compare(candidate, argument) == 0 for candidate in candidates) or value == argument
+    if operator == '$ne':
+        return not matches_operator(value, '$eq', argument)
+    if operator == '$in':
+        return any(matches_operator(value, '$eq', item) for item in argument)
+    if operator == '$nin':
+        return not matches_operator(value, '$in', argument)
+    if operator == '$exists':
+        return (value is not MISSING) == bool(argument)
+    if operator == '$type':
+        return value is not MISSING and isinstance(value, TYPE_NAMES[argument])
+
+    comparisons = {'$gt': lambda result: result > 0, '$gte': lambda result: result >= 0, '$lt': lambda result: result < 0, '$lte': lambda result: result <= 0}
+
+    if operator in comparisons:
+        return any(get_type_rank(candidate) == get_type_rank(argument) and comparisons[operator](compare(candidate, argument)) for candidate in candidates)
+
+    raise NotImplementedError(f'Unsupported query operator {operator}')
+
+def matches(document: dict, query: dict) -> bool:
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            if not all(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(operator.startswith('$') for operator in condition):
+            if not all(matches_operator(get_field(document, key), operator, argument) for operator, argument in condition.items()):
+                return False
+        elif not matches_operator(get_field(document, key), '$eq', condition):
+            return False
+
+    return True
+
+def evaluate(document: dict, expression):
+    if isinstance(expression, str) and expression.startswith('$'):
+        value = get_field(document, expression[1:])
+        return None if value is MISSING else value
+
+    if isinstance(expression, list):
+        return [evaluate(document, item) for item in expression]
+
+    if not isinstance(expression, dict) or not expression or not next(iter(expression)).startswith('$'):
+        return expression
+
+    operator, arguments = next(iter(expression.items()))
+
+    if operator == '$literal':
+        return arguments
+
+    values = evaluate(document, arguments)
+
+    if operator == '$ifNull':
+        return next((value for value in values if value is not None), None)
+    if operator == '$add':
+        return sum(values)
+    if operator == '$multiply':
+        return functools.reduce(lambda first, second: first * second, values, 1)
+    if operator == '$round':
+        return round(values[0], values[1] if len(values) > 1 else 0)
+    if operator == '$arrayElemAt':
+        return values[0][values[1]] if values[0] and -len(values[0]) <= values[1] < len(values[0]) else None
+
+    raise NotImplementedError(f'Unsupported expression operator {operator}')
+
+# Like a decoded server reply, callers get their own copy of every document they read
+def copy_document(document: dict) -> dict:
+    return {key: value.copy() if isinstance(value, (dict, list)) else value for key, value in document.items()}
+
+def project(document: dict, projection) -> dict:
+    if not projection:
+        return copy_document(document)
+
+    fields = projection if isinstance(projection, dict) else {field: 1 for field in projection}
+
+    if all(not include for field, include in fields.items() if field != '_id'):
+        return {key: copy.deepcopy(value) for key, value in document.items() if fields.get(key, 1)}
+
+    projected = {'_id': document['_id']} if fields.get('_id', 1) else {}
+
+    for field, include in fields.items():
+        if include and field != '_id':
+            value = get_field(document, field)
+            if value is not MISSING:
+                set_field(projected, field, copy.deepcopy(value))
+
+    return projected
+
+def get_sort_value(value) -> tuple:
+    rank = get_type_rank(value)
+
+    return (rank, value) if rank in (1, 2, 6, 7, 8) else (rank, 0)
+
+# Stable sorts from the last key to the first give the compound order
+def sort_documents(documents: list, sort: list) -> list:
+    for field, order in reversed(sort):
+        documents = sorted(documents, key=lambda document: get_sort_value(get_field(document, field)), reverse=order < 0)
+
+    return documents
+
+def apply_update(document: dict, update):
+    if isinstance(update, list):
+        for stage in update:
+            for operator, fields in stage.items():
+                if operator not in ('$set', '$addFields'):
+                    raise NotImplementedError(f'Unsupported update stage {operator}')
+                values = {field: evaluate(document, expression) for field, expression in fields.items()}
+                for field, value in values.items():
+                    set_field(document, field, value)
+        return
+
+    for operator, fields in update.items():
+        for field, value in fields.items():
+            if operator == '$set':
+                set_field(document, field, copy.deepcopy(value))
+            elif operator == '$inc':
+                current = get_field(document, field)
+                set_field(document, field, (0 if current is MISSING else current) + value)
+            elif operator == '$unset':
+                document.pop(field, None)
+            else:
+                raise NotImplementedError(f'Unsupported update operator {operator}')
+
+class MemoryCursor:
+    def __init__(self, collection, documents: list, projection=None):
+        self.collection = collection
+        self.documents = documents
+        self.projection = projection
+        self.sort_spec = None
+        self.skip_count = 0
+        self.limit_count = 0
+
+    def sort(self, key_or_list, direction: int = None):
+        self.sort_spec = [(key_or_list, direction or 1)] if isinstance(key_or_list, str) else list(key_or_list)
+        return self
+
+    def skip(self, skip: int):
+        self.skip_count = skip
+        return self
+
+    def limit(self, limit: int):
+        self.limit_count = limit
+        return self
+
+    def batch_size(self, batch_size: int):
+        return self
+
+    def get_documents(self) -> list:
+        documents = sort_documents(self.documents, self.sort_spec) if self.sort_spec else self.documents
+        documents = documents[self.skip_count:]
+        documents = documents[:self.limit_count] if self.limit_count else documents
+
+        return [project(document, self.projection) for document in documents]
+
+    async def __aiter__(self):
+        self.collection.round_trips += 1
+
+        for document in self.get_documents():
+            yield document
+
+    async def to_list(self, length: int = None) -> list:
+        self.collection.round_trips += 1
+        documents = self.get_documents()
+
+        return documents[:length] if length else documents
+
+    async def explain(self) -> dict:
+        self.collection.round_trips += 1
+
+        return {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}, 'backend': 'memory'}
+
+class MemoryDatabase:
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def command(self, *args, **kwargs) -> dict:
+        return {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}, 'backend': 'memory'}
+
+class MemoryCollection:
+    def __init__(self, backend, name: str):
+        self.name = name
+        self.database = MemoryDatabase(backend)
+        self.documents = {}
+        self.indexes = {}
+        self.round_trips = 0
+
+    def find_documents(self, query: dict) -> list:
+        # Equality or $in on _id is a direct lookup, everything else scans
+        _id = query.get('_id') if query else None
+
+        if isinstance(_id, ObjectId):
+            candidates = [self.documents.get(_id)]
+        elif isinstance(_id, dict) and list(_id) == ['$in']:
+            candidates = [self.documents.get(value) for value in dict.fromkeys(_id['$in']) if isinstance(value, ObjectId)]
+        else:
+            return [document for document in self.documents.values() if matches(document, query)]
+
+        return [document for document in candidates if document is not None and matches(document, query)]
+
+    def insert(self, document: dict):
+        document.setdefault('_id', ObjectId())
+
+        if document['_id'] in self.documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+
+        self.documents[document['_id']] = copy_document(document)
+
+    def find(self, filter: dict = None, projection=None):
+        return MemoryCursor(self, self.find_documents(filter), projection)
+
+    async def find_one(self, filter: dict = None, projection=None):
+        self.round_trips += 1
+        documents = self.find_documents(filter)
+
+        return project(documents[0], projection) if documents else None
+
+    async def find_one_and_update(self, filter: dict, update, projection=None, return_document=ReturnDocument.BEFORE, upsert: bool = False):
+        self.round_trips += 1
+        documents = self.find_documents(filter)
+
+        if not documents:
+            return None
+
+        before = project(documents[0], projection)
+        apply_update(documents[0], update)
+
+        return project(documents[0], projection) if return_document == ReturnDocument.AFTER else before
+
+    async def insert_one(self, document: dict):
+        self.round_trips += 1
+        self.insert(document)
+
+        return InsertOneResult(document['_id'], True)
+
+    async def insert_many(self, documents: list, ordered: bool = True):
+        self.round_trips += 1
+        write_errors = []
+
+        for index, document in enumerate(documents):
+            try:
+                self.insert(document)
+            except DuplicateKeyError as e:
+                write_errors.append({'index': index, 'code': 11000, 'errmsg': str(e)})
+                if ordered:
+                    break
+
+        if write_errors:
+            raise BulkWriteError({'writeErrors': write_errors, 'nInserted': len(documents) - len(write_errors)})
+
+        return InsertManyResult([document['_id'] for document in documents], True)
+
+    def update(self, filter: dict, update, upsert: bool, multi: bool) -> dict:
+        documents = self.find_documents(filter)
+        documents = documents if multi else documents[:1]
+        result = {'n': len(documents), 'nModified': 0, 'upserted': None}
+
+        for document in documents:
+            before = copy_document(document)
+            apply_update(document, update)
+            result['nModified'] += 1 if document != before else 0
+
+        if not documents and upsert:
+            document = {key: value for key, value in filter.items() if not key.startswith('$') and not isinstance(value, dict)}
+            apply_update(document, update)
+            self.insert(document)
+            result['upserted'] = document['_id']
+
+        return result
+
+    async def update_one(self, filter: dict, update, upsert: bool = False):
+        self.round_trips += 1
+
+        return UpdateResult(self.update(filter, update, upsert, False), True)
+
+    async def update_many(self, filter: dict, update, upsert: bool = False):
+        self.round_trips += 1
+
+        return UpdateResult(self.update(filter, update, upsert, True), True)
+
+    async def replace_one(self, filter: dict, replacement: dict, upsert: bool = False):
+        self.round_trips += 1
+        documents = self.find_documents(filter)
+
+        if documents:
+            self.documents[documents[0]['_id']] = {'_id': documents[0]['_id'], **copy.deepcopy(replacement)}
+        elif upsert:
+            self.insert({**{key: value for key, value in filter.items() if not isinstance(value, dict)}, **replacement})
+
+        return UpdateResult({'n': len(documents[:1]), 'nModified': len(documents[:1])}, True)
+
+    def delete(self, filter: dict, multi: bool) -> int:
+        documents = self.find_documents(filter)
+        documents = documents if multi else documents[:1]
+
+        for document in documents:
+            del self.documents[document['_id']]
+
+        return len(documents)
+
+    async def delete_one(self, filter: dict):
+        self.round_trips += 1
+
+        return DeleteResult({'n': self.delete(filter, False)}, True)
+
+    async def delete_many(self, filter: dict):
+        self.round_trips += 1
+
+        return DeleteResult({'n': self.delete(filter, True)}, True)
+
+    async def bulk_write(self, requests: list, ordered: bool = True):
+        self.round_trips += 1
+        totals = {'nInserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'nUpserted': 0, 'upserted': [], 'writeErrors': []}
+
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self.insert(request._doc)
+                    totals['nInserted'] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                    update = request._doc if not isinstance(request, ReplaceOne) else {'$set': request._doc}
+                    result = self.update(request._filter, update, request._upsert, isinstance(request, UpdateMany))
+                    totals['nMatched'] += result['n']
+                    totals['nModified'] += result['nModified']
+                    if result['upserted'] is not None:
+                        totals['nUpserted'] += 1
+                        totals['upserted'].append({'index': index, '_id': result['upserted']})
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    totals['nRemoved'] += self.delete(request._filter, isinstance(request, DeleteMany))
+                else:
+                    raise NotImplementedError(f'Unsupported bulk operation {type(request).__name__}')
+            except DuplicateKeyError as e:
+                totals['writeErrors'].append({'index': index, 'code': 11000, 'errmsg': str(e)})
+                if ordered:
+                    break
+
+        if totals['writeErrors']:
+            raise BulkWriteError(totals)
+
+        return BulkWriteResult(totals, True)
+
+    async def count_documents(self, filter: dict):
+        self.round_trips += 1
+
+        return len(self.find_documents(filter))
+
+    async def estimated_document_count(self):
+        self.round_trips += 1
+
+        return len(self.documents)
+
+    async def create_index(self, keys, **kwargs):
+        self.round_trips += 1
+        name = kwargs.get('name') or '_'.join(f'{key}_{order}' for key, order in ([(keys, 1)] if isinstance(keys, str) else keys))
+        self.indexes[name] = keys
+
+        return name
+
+    async def create_indexes(self, indexes: list):
+        self.round_trips += 1
+
+        for index in indexes:
+            self.indexes[index.document['name']] = index.document['key']
+
+        return [index.document['name'] for index in indexes]
+
+    def aggregate(self, pipeline: list):
+        return MemoryCursor(self, run_pipeline(list(self.documents.values()), pipeline))
+
+def group(documents: list, specification: dict) -> list:
+    groups = {}
+
+    for document in documents:
+        key = evaluate(document, specification['_id'])
+        hashable_key = repr(key)
+        entry = groups.setdefault(hashable_key, {'_id': key, **{field: None for field in specification if field != '_id'}})
+
+        for field, accumulator in specification.items():
+            if field == '_id':
+                continue
+
+            operator, expression = next(iter(accumulator.items()))
+            value = evaluate(document, expression)
+
+            if operator == '$sum':
+                entry[field] = (entry[field] or 0) + (value or 0)
+            elif operator == '$max':
+                entry[field] = value if entry[field] is None or compare(value, entry[field]) > 0 else entry[field]
+            elif operator == '$min':
+                entry[field] = value if entry[field] is None or compare(value, entry[field]) < 0 else entry[field]
+            elif operator == '$first':
+                entry[field] = value if entry[field] is None else entry[field]
+            else:
+                raise NotImplementedError(f'Unsupported accumulator {operator}')
+
+    return list(groups.values())
+
+def bucket_auto(documents: list, specification: dict) -> list:
+    values = sorted((evaluate(document, specification['groupBy']) for document in documents), key=get_sort_value)
+    size = -(-len(values) // specification['buckets']) if values else 0
+
+    return [{'_id': {'min': values[start], 'max': values[min(start + size, len(values)) - 1]}, 'count': len(values[start:start + size])}
+            for start in range(0, len(values), size or 1)]
+
+def run_pipeline(documents: list, pipeline: list) -> list:
+    for stage in pipeline:
+        operator, specification = next(iter(stage.items()))
+
+        if operator == '$match':
+            documents = [document for document in documents if matches(document, specification)]
+        elif operator == '$project':
+            documents = [project(document, {field: include for field, include in specification.items() if not isinstance(include, dict)}) |
+                         {field: evaluate(document, expression) for field, expression in specification.items() if isinstance(expression, dict)}
+                         for document in documents]
+        elif operator == '$sort':
+            documents = sort_documents(documents, list(specification.items()))
+        elif operator == '$limit':
+            documents = documents[:specification]
+        elif operator == '$skip':
+            documents = documents[specification:]
+        elif operator == '$count':
+            documents = [{specification: len(documents)}] if documents else []
+        elif operator == '$group':
+            documents = group(documents, specification)
+        elif operator == '$bucketAuto':
+            documents = bucket_auto(documents, specification)
+        elif operator == '$facet':
+            documents = [{name: run_pipeline(documents, sub_pipeline) for name, sub_pipeline in specification.items()}]
+        else:
+            raise NotImplementedError(f'Unsupported pipeline stage {operator}')
+
+    return documents
+
+class MemoryBackend:
+    def __init__(self):
+        self.collections = {}
+
+    def get_collection(self, collection_name: str) -> MemoryCollection:
+        if collection_name not in self.collections:
+            self.collections[collection_name] = MemoryCollection(self, collection_name)
+
+        return self.collections[collection_name]
+
+    @property
+    def round_trips(self) -> int:
+        return sum(collection.round_trips for collection in self.collections.values())
+
+    # Routes every query a Database makes to this backend
+    def attach(self, database):
+        database.get_collection = self.get_collection
+
+        return self
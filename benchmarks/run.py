@@ -0,0 +1,251 @@
+from datetime import datetime, timezone
+from generators import SIZES, iter_findings
+from libcovulor.finding import Finding, FindingModel
+from libcovulor.instrumentation import MemoryCollector
+from memory_backend import MemoryBackend
+
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+# Usage: python benchmarks/run.py --backend memory --sizes 1k,100k --output results.json
+# Results are keyed by size and API so two runs can be diffed, e.g. in CI against the main branch.
+
+CLIENT_ID = 'benchmark'
+
+def get_peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def get_percentile(latencies: list, percent: float) -> float:
+    if not latencies:
+        return None
+
+    ordered = sorted(latencies)
+
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))] * 1000, 3)
+
+class Recorder:
+    def __init__(self, finding: Finding, collector: MemoryCollector, backend: MemoryBackend = None, trace_memory: bool = True):
+        self.finding = finding
+        self.collector = collector
+        self.backend = backend
+        self.trace_memory = trace_memory
+        self.results = {}
+
+    def get_queries(self) -> int:
+        return sum(stats['attempts'] for stats in self.collector.snapshot()['operations'].values())
+
+    # The memory backend counts its own calls, against a server the driver's commands are counted
+    def get_round_trips(self) -> int:
+        return self.backend.round_trips if self.backend else self.collector.round_trips
+
+    # run is an async callable receiving a timer, each `async with timer()` block is one measured operation.
+    # items is the number of findings the benchmark processed, for throughput.
+    # Memory is the tracemalloc peak over what was allocated when the API started, so it only counts that API.
+    # Tracing slows every allocation down, use --no-trace-memory when only the timings matter. With the memory
+    # backend the documents it stores are allocations too, so write APIs include them.
+    async def measure(self, name: str, run: callable(any)):
+        latencies = []
+        queries, round_trips = self.get_queries(), self.get_round_trips()
+
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+
+        class Timer:
+            async def __aenter__(self):
+                self.started = time.perf_counter()
+
+            async def __aexit__(self, exc_type, exc_val, exc_tb):
+                latencies.append(time.perf_counter() - self.started)
+
+        started = time.perf_counter()
+        items = await run(Timer)
+        seconds = time.perf_counter() - started
+        peak_mb = round((tracemalloc.get_traced_memory()[1] - allocated) / (1024 * 1024), 2) if self.trace_memory else None
+
+        self.results[name] = {'operations': len(latencies),
+                              'items': items,
+                              'seconds': round(seconds, 4),
+                              'throughput': round(items / seconds, 1) if seconds else None,
+                              'p50_ms': get_percentile(latencies, 50),
+                              'p99_ms': get_percentile(latencies, 99),
+                              'queries': self.get_queries() - queries,
+                              'round_trips': self.get_round_trips() - round_trips,
+                              'peak_memory_mb': peak_mb}
+
+        print(f"  {name:<24} {self.results[name]['throughput'] or 0:>12} items/s  p50 {self.results[name]['p50_ms']} ms  p99 {self.results[name]['p99_ms']} ms",
+              file=sys.stderr)
+
+# Findings are generated while they are written, so the harness never holds more than one chunk of them
+async def run_size(finding: Finding, recorder: Recorder, size: int, operations: int, seed: int):
+    rng = random.Random(seed)
+    chunk_size = finding.db.write_batch_size
+    # A uniform sample of the inserted ids is enough for the lookups, keeping all of them would cost memory at 1m
+    inserted_ids = []
+    inserted_count = 0
+
+    async def validation(timer):
+        count = 0
+        for data in iter_findings(min(size, operations * 10), CLIENT_ID, seed=seed):
+            async with timer():
+                FindingModel.model_validate(data)
+            count += 1
+        return count
+
+    async def insert_one(timer):
+        count = 0
+        for data in iter_findings(min(size, operations), f'{CLIENT_ID}-insert-one', seed=seed):
+            async with timer():
+                await finding.create(data)
+            count += 1
+        return count
+
+    async def create_many(timer):
+        nonlocal inserted_count
+        findings = iter_findings(size, CLIENT_ID, seed=seed)
+
+        while chunk := list(itertools.islice(findings, chunk_size)):
+            async with timer():
+                result = await finding.create_many(chunk)
+            for finding_model in result['data']:
+                if finding_model is None:
+                    continue
+                inserted_count += 1
+                if len(inserted_ids) < operations:
+                    inserted_ids.append(finding_model.object_id)
+                elif (index := rng.randrange(inserted_count)) < operations:
+                    inserted_ids[index] = finding_model.object_id
+        return size
+
+    async def find_one(timer):
+        for _id in inserted_ids:
+            async with timer():
+                await finding.find_one(CLIENT_ID, _id, read_mode=Finding.READ_TRUSTED)
+        return len(inserted_ids)
+
+    async def find_one_concurrent(timer):
+        ids = rng.sample(inserted_ids, len(inserted_ids))
+        async with timer():
+            await asyncio.gather(*[finding.find_one(CLIENT_ID, _id, read_mode=Finding.READ_TRUSTED) for _id in ids])
+        return len(ids)
+
+    async def find_many_offset(timer):
+        page_count = max(size // 50, 1)
+        count = 0
+        for _ in range(operations):
+            async with timer():
+                page = await finding.find_many(CLIENT_ID, {'pagination': {'page': rng.randrange(page_count), 'page_size': 50}}, read_mode=Finding.READ_TRUSTED)
+            count += len(page['data'])
+        return count
+
+    async def find_many_keyset(timer):
+        options = {'pagination': {'mode': 'keyset', 'page_size': 50, 'count': 'cached'}}
+        count = 0
+        for _ in range(operations):
+            async with timer():
+                page = await finding.find_many(CLIENT_ID, options, read_mode=Finding.READ_TRUSTED)
+            count += len(page['data'])
+            options['pagination']['cursor'] = page['meta']['pagination']['nextCursor']
+            if not options['pagination']['cursor']:
+                break
+        return count
+
+    async def iter_many(timer):
+        count = 0
+        async with timer():
+            async for _ in finding.iter_many(CLIENT_ID, batch_size=chunk_size, read_mode=Finding.READ_TRUSTED, view=Finding.VIEW_SUMMARY):
+                count += 1
+        return count
+
+    async def stats(timer):
+        for _ in range(min(operations, 20)):
+            async with timer():
+                await finding.stats(CLIENT_ID, cached=False)
+        return min(operations, 20) * size
+
+    async def delete_many(timer):
+        async with timer():
+            result = await finding.delete_many(CLIENT_ID)
+        await finding.delete_many(f'{CLIENT_ID}-insert-one')
+        return result['deleted_count'] if result else 0
+
+    for name, run in (('validation', validation), ('insert_one', insert_one), ('create_many', create_many), ('find_one', find_one),
+                      ('find_one_concurrent', find_one_concurrent), ('find_many_offset', find_many_offset), ('find_many_keyset', find_many_keyset),
+                      ('iter_many', iter_many), ('stats', stats), ('delete_many', delete_many)):
+        await recorder.measure(name, run)
+
+async def main(args) -> dict:
+    report = {'meta': {'backend': args.backend,
+                       'sizes': args.sizes,
+                       'operations': args.operations,
+                       'seed': args.seed,
+                       'trace_memory': args.trace_memory,
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'started_at': datetime.now(timezone.utc).isoformat()},
+              'results': {}}
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    for size_name in args.sizes.split(','):
+        collector = MemoryCollector(count_commands=args.backend == 'mongo')
+        finding = Finding(args.username, args.password, args.host, args.port, db_name=args.db_name, instrumentation=collector)
+        backend = MemoryBackend().attach(finding.db) if args.backend == 'memory' else None
+        recorder = Recorder(finding, collector, backend, args.trace_memory)
+
+        print(f'{size_name} findings on {args.backend}', file=sys.stderr)
+
+        # Leftovers of an interrupted run would skew the counts
+        await finding.delete_many(CLIENT_ID)
+        await run_size(finding, recorder, SIZES.get(size_name.lower()) or int(size_name), args.operations, args.seed)
+        await finding.close()
+
+        report['results'][size_name] = recorder.results
+
+    if args.trace_memory:
+        tracemalloc.stop()
+
+    # Whole process, harness and backend included, only for context next to the per-API numbers
+    report['meta']['peak_rss_mb'] = get_peak_rss_mb()
+
+    return report
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Benchmark the libcovulor data access layer.')
+    parser.add_argument('--backend', choices=('memory', 'mongo'), default='memory')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--db-name', default='libcovulor_benchmark')
+    parser.add_argument('--sizes', default='1k', help='Comma separated: 1k, 100k, 1m or a number of findings')
+    parser.add_argument('--operations', type=int, default=200, help='Calls per API for the per-call benchmarks')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--trace-memory', action=argparse.BooleanOptionalAction, default=True,
+                        help='Peak memory per API with tracemalloc, the memory backend\'s stored documents count towards it')
+    parser.add_argument('--output', default='-', help='JSON file for the results, - for stdout')
+
+    return parser
+
+if __name__ == '__main__':
+    arguments = get_parser().parse_args()
+    results = asyncio.run(main(arguments))
+    output = json.dumps(results, indent=2, default=str)
+
+    if arguments.output == '-':
+        print(output)
+    else:
+        with open(arguments.output, 'w', encoding='utf-8') as file:
+            file.write(output)
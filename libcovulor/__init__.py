@@ -1,4 +1,11 @@
+from .buffer import *
+from .cache import *
 from .database import *
+from .epss import *
 from .finding import *
+from .instrumentation import *
 from .openai import *
+from .priority import *
 from .repository import *
+from .retry import *
+from .sarif import *
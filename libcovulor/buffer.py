@@ -0,0 +1,115 @@
+from bson import ObjectId
+from pymongo import UpdateOne
+
+import asyncio
+
+# Write-behind buffer for $set updates: updates to the same document are merged and pending documents
+# are written as one unordered bulk write when max_pending is reached or every flush_interval seconds.
+# Updates are only durable after a flush, so callers must close() the buffer before shutting down.
+# Updates that fail are queued again and dropped into errors after max_retries failed flushes.
+class WriteBehindBuffer:
+    def __init__(self, database, collection_name: str, max_pending: int = 1000, flush_interval: float = 1.0, chunk_size: int = None, max_retries: int = 3):
+        self.db = database
+        self.collection_name = collection_name
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.pending = {}
+        self.failures = {}
+        self.lock = asyncio.Lock()
+        self.timer = None
+        self.updates = 0
+        self.writes = 0
+        self.flushes = 0
+        self.retries = 0
+        self.matched_count = 0
+        self.modified_count = 0
+        self.errors = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    async def set(self, client_id: str, _id: str, data: dict):
+        key = (client_id, ObjectId(_id))
+        self.pending[key] = {**self.pending.get(key, {}), **data}
+        self.updates += 1
+
+        if self.flush_interval and self.timer is None:
+            self.timer = asyncio.ensure_future(self.flush_periodically())
+
+        if len(self.pending) >= self.max_pending:
+            await self.flush()
+
+    async def flush(self) -> dict:
+        async with self.lock:
+            pending, self.pending = self.pending, {}
+
+            if not pending:
+                return {'matched_count': 0, 'modified_count': 0, 'errors': []}
+
+            keys = list(pending)
+            result = await self.db.bulk_write(self.collection_name, [UpdateOne({'_id': _id, 'client_id': client_id}, {'$set': pending[(client_id, _id)]})
+                                                                     for client_id, _id in keys], self.chunk_size)
+            failed = {keys[error['index']]: error for error in result['errors']}
+
+            for key in keys:
+                if key not in failed:
+                    self.failures.pop(key, None)
+                    continue
+
+                self.failures[key] = self.failures.get(key, 0) + 1
+
+                if self.failures[key] > self.max_retries:
+                    self.failures.pop(key)
+                    self.errors.append(failed[key])
+                    continue
+
+                # Updates set while this flush was running are newer and win over the failed ones
+                self.pending[key] = {**pending[key], **self.pending.get(key, {})}
+                self.retries += 1
+
+            self.writes += len(pending) - len(failed)
+            self.flushes += 1
+            self.matched_count += result['matched_count']
+            self.modified_count += result['modified_count']
+
+            return result
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Shielded so close() can't cancel a bulk write that already took the pending updates
+            await asyncio.shield(self.flush())
+
+    # Keeps flushing until every update is written or out of retries
+    async def close(self) -> dict:
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        summary = {'matched_count': 0, 'modified_count': 0, 'errors': []}
+
+        while self.pending:
+            result = await self.flush()
+            summary['matched_count'] += result['matched_count']
+            summary['modified_count'] += result['modified_count']
+            summary['errors'].extend(result['errors'])
+
+        return summary
+
+    def stats(self) -> dict:
+        return {'updates': self.updates,
+                'writes': self.writes,
+                'flushes': self.flushes,
+                'retries': self.retries,
+                'pending': len(self.pending),
+                'matched_count': self.matched_count,
+                'modified_count': self.modified_count,
+                'errors': len(self.errors)}
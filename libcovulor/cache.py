@@ -0,0 +1,298 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pydantic import BaseModel
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+
+class TTLCache:
+    MISSING = object()
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, TTLCache.MISSING, count=False) is not TTLCache.MISSING
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key, default=None, count: bool = True):
+        entry = self.entries.get(key)
+
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+
+            if count:
+                self.hits += 1
+
+            return entry[1]
+
+        if entry is not None:
+            del self.entries[key]
+
+        if count:
+            self.misses += 1
+
+        return default
+
+    def set(self, key, value, ttl: float = None):
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, predicate: callable(any) = None):
+        if predicate is None:
+            self.entries.clear()
+            return
+
+        for key in [key for key in self.entries if predicate(key)]:
+            del self.entries[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self.entries)}
+
+def get_response_cache_key(deployment_name: str, prompt_system_message: str, prompt_input: str, response_model: type[BaseModel]) -> str:
+    payload = json.dumps([deployment_name, prompt_system_message, prompt_input, response_model.model_json_schema()], sort_keys=True)
+
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class ResponseCache(ABC):
+    def __init__(self, ttl: float = 7 * 24 * 3600, max_entries: int = 100000, eviction_interval: int = 100):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.eviction_interval = eviction_interval
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @abstractmethod
+    async def get(self, key: str):
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: dict):
+        pass
+
+    def record(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    def should_evict(self) -> bool:
+        self.stores += 1
+
+        return self.stores % self.eviction_interval == 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions}
+
+# sqlite3 blocks, so every call runs on one worker thread that owns the connection and the event loop
+# only awaits it. accessed_at only orders evictions, so hits are touched in batches instead of one commit per read.
+class SQLiteResponseCache(ResponseCache):
+    def __init__(self, path: str, ttl: float = 7 * 24 * 3600, max_entries: int = 100000, eviction_interval: int = 100, touch_batch_size: int = 100):
+        super().__init__(ttl, max_entries, eviction_interval)
+        self.touch_batch_size = touch_batch_size
+        self.touched = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.connection = self.executor.submit(self.connect, path).result()
+
+    def connect(self, path: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        connection.commit()
+
+        return connection
+
+    async def run(self, function: callable(any), *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def pop_touched(self) -> dict:
+        touched, self.touched = self.touched, {}
+
+        return touched
+
+    async def get(self, key: str):
+        now = time.time()
+        row = await self.run(self.select, key, now)
+
+        if row:
+            self.touched[key] = now
+
+            if len(self.touched) >= self.touch_batch_size:
+                await self.run(self.write, None, None, now, self.pop_touched(), False)
+
+        return self.record(json.loads(row[0]) if row else None)
+
+    async def set(self, key: str, value: dict):
+        await self.run(self.write, key, json.dumps(value), time.time(), self.pop_touched(), self.should_evict())
+
+    def select(self, key: str, now: float):
+        return self.connection.execute('SELECT value FROM responses WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+
+    # Pending touches are written first, so evictions see every hit made so far
+    def write(self, key: str, value: str, now: float, touched: dict, evict: bool):
+        self.connection.executemany('UPDATE responses SET accessed_at = ? WHERE key = ?', [(accessed_at, touched_key) for touched_key, accessed_at in touched.items()])
+
+        if key is not None:
+            self.connection.execute('INSERT OR REPLACE INTO responses (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                                    (key, value, now + self.ttl, now))
+
+        if evict:
+            self.evict(now)
+
+        self.connection.commit()
+
+    def evict(self, now: float):
+        expired = self.connection.execute('DELETE FROM responses WHERE expires_at <= ?', (now,)).rowcount
+        # Least recently used entries over max_entries
+        overflow = self.connection.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                                           (self.max_entries,)).rowcount
+        self.evictions += expired + overflow
+
+    def close(self):
+        self.executor.submit(self.write, None, None, time.time(), self.pop_touched(), False).result()
+        self.executor.submit(self.connection.close).result()
+        self.executor.shutdown()
+
+class MongoResponseCache(ResponseCache):
+    def __init__(self, database, collection_name: str = None, ttl: float = 7 * 24 * 3600, max_entries: int = 100000, eviction_interval: int = 100):
+        super().__init__(ttl, max_entries, eviction_interval)
+        self.db = database
+        self.collection_name = collection_name if collection_name else database.llm_cache_collection
+
+    async def ensure_indexes(self) -> list:
+        return await self.db.create_indexes(self.collection_name, self.db.indexes[self.db.llm_cache_collection])
+
+    async def get(self, key: str):
+        now = datetime.now(timezone.utc)
+
+        async def get_query(collection):
+            return await collection.find_one_and_update({'_id': key, 'expires_at': {'$gt': now}}, {'$set': {'accessed_at': now}}, projection={'value': 1})
+
+        document = await self.db.execute_query(self.collection_name, get_query)
+
+        return self.record(document['value'] if document else None)
+
+    async def set(self, key: str, value: dict):
+        now = datetime.now(timezone.utc)
+        document = {'value': value, 'expires_at': now + timedelta(seconds=self.ttl), 'accessed_at': now}
+
+        async def set_query(collection):
+            await collection.replace_one({'_id': key}, document, upsert=True)
+
+            if self.should_evict():
+                await evict(collection)
+
+        # Expired entries are removed by the TTL index on expires_at, only the size limit is enforced here
+        async def evict(collection):
+            overflow = await collection.estimated_document_count() - self.max_entries
+
+            if overflow > 0:
+                keys = [entry['_id'] async for entry in collection.find({}, {'_id': 1}).sort('accessed_at', 1).limit(overflow)]
+                result = await collection.delete_many({'_id': {'$in': keys}})
+                self.evictions += result.deleted_count
+
+        await self.db.execute_query(self.collection_name, set_query)
+
+# Read-through cache for mostly static reference collections (CWE, OWASP, EPSS, Rules) keyed by their
+# natural key, which defaults to Database.reference_keys. Keys that don't exist are cached too so repeated
+# misses don't go back to the database.
+class ReferenceCache:
+    def __init__(self, database, collection_name: str, key_field: str = None, filters: dict = None, ttl: float = 3600, max_entries: int = 100000, chunk_size: int = 1000):
+        self.db = database
+        self.collection_name = collection_name
+        self.key_field = key_field if key_field else database.reference_keys.get(collection_name)
+
+        if self.key_field is None:
+            raise ValueError(f'key_field is required for {collection_name}, its natural key is not known')
+
+        self.filters = filters
+        self.chunk_size = chunk_size
+        self.entries = TTLCache(max_entries, ttl)
+        self.queries = 0
+
+    async def get(self, key):
+        documents = await self.get_many([key])
+
+        return documents[key]
+
+    async def get_many(self, keys) -> dict:
+        documents = {}
+        missing = []
+
+        for key in dict.fromkeys(keys):
+            document = self.entries.get(key, TTLCache.MISSING)
+
+            if document is TTLCache.MISSING:
+                missing.append(key)
+            else:
+                documents[key] = document
+
+        for start in range(0, len(missing), self.chunk_size):
+            chunk = missing[start:start + self.chunk_size]
+            found = await self.db.find_in(self.collection_name, self.key_field, chunk, self.filters)
+            self.queries += 1
+
+            # A failed query isn't cached, otherwise every key would be a cached miss for the whole ttl
+            if found is None:
+                documents.update(dict.fromkeys(chunk))
+                continue
+
+            found = {document[self.key_field]: document for document in found}
+
+            for key in chunk:
+                documents[key] = found.get(key)
+                self.entries.set(key, documents[key])
+
+        return documents
+
+    async def preload(self, filters: dict = None) -> int:
+        count = 0
+
+        async for document in self.db.iter_aggregate(self.collection_name, [{'$match': {**(self.filters or {}), **(filters or {})}}]):
+            self.entries.set(document[self.key_field], document)
+            count += 1
+
+        self.queries += 1
+
+        return count
+
+    def invalidate(self, keys=None):
+        if keys is None:
+            self.entries.invalidate()
+            return
+
+        keys = set(keys)
+        self.entries.invalidate(lambda key: key in keys)
+
+    def stats(self) -> dict:
+        return {**self.entries.stats(), 'queries': self.queries}
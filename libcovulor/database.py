@@ -1,14 +1,97 @@
+from .cache import ReferenceCache, TTLCache
+from .instrumentation import EVENT_ERROR, EVENT_QUERY, EVENT_SLOW_QUERY, EVENT_THROTTLE, Instrumentation, current_operation
+from .retry import RetryPolicy, get_rate_limiter
+from bson import json_util
 from bson.objectid import ObjectId
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError, OperationFailure
+from pymongo import ASCENDING, IndexModel, MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError, OperationFailure
 
 import asyncio
+import base64
 import math
 import motor.motor_asyncio
-import random
+import time
+import weakref
+
+# Motor clients are bound to the event loop they were created on, so the shared
+# registry keeps one set of pooled clients per loop, keyed by URI and pool options.
+# Owners (Database, MongoDBClient) hold a reference per loop and the pool is closed with the last one.
+_motor_clients = weakref.WeakKeyDictionary()
+_motor_client_references = weakref.WeakKeyDictionary()
+
+def get_motor_client_key(database_uri: str, **client_options) -> tuple:
+    return (database_uri, tuple(sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in client_options.items())))
+
+def get_motor_client(database_uri: str, **client_options):
+    loop = asyncio.get_running_loop()
+    clients = _motor_clients.setdefault(loop, {})
+    key = get_motor_client_key(database_uri, **client_options)
+    client = clients.get(key)
+
+    if client is None:
+        client = motor.motor_asyncio.AsyncIOMotorClient(database_uri, io_loop=loop, **client_options)
+        clients[key] = client
+
+    return client
+
+def acquire_motor_client(database_uri: str, **client_options):
+    references = _motor_client_references.setdefault(asyncio.get_running_loop(), {})
+    key = get_motor_client_key(database_uri, **client_options)
+    references[key] = references.get(key, 0) + 1
+
+    return get_motor_client(database_uri, **client_options)
+
+def release_motor_client(database_uri: str, **client_options):
+    loop = asyncio.get_running_loop()
+    references = _motor_client_references.get(loop, {})
+    key = get_motor_client_key(database_uri, **client_options)
+
+    # Already closed by close_motor_clients
+    if key not in references:
+        return
+
+    references[key] -= 1
+
+    if references[key] <= 0:
+        references.pop(key)
+        client = _motor_clients.get(loop, {}).pop(key, None)
+
+        if client is not None:
+            client.close()
+
+# Process level shutdown: closes the pooled clients of the running loop, or of every loop when none is
+# running, even if instances still hold references. Instances release theirs with close().
+def close_motor_clients(database_uri: str = None):
+    try:
+        loops = [asyncio.get_running_loop()]
+    except RuntimeError:
+        loops = list(_motor_clients)
+
+    for loop in loops:
+        clients = _motor_clients.get(loop, {})
+        references = _motor_client_references.get(loop, {})
+
+        for key in list(clients):
+            if database_uri is None or key[0] == database_uri:
+                references.pop(key, None)
+                clients.pop(key).close()
+
+# Cached counts are shared by every Database on the same server and database in this process, so a write
+# through any instance invalidates them. Writes from other processes are only seen once the ttl expires.
+_count_caches = {}
+_facet_caches = {}
+
+def get_shared_cache(caches: dict, key: tuple, ttl: float) -> TTLCache:
+    cache = caches.get(key)
+
+    if cache is None:
+        cache = TTLCache(max_entries=1024, ttl=ttl)
+        caches[key] = cache
+
+    return cache
 
 class MongoDBClient:
-    def __init__(self, database_username=None, database_password=None, database_host="mongodb", port: int = 27017, database_options=None, db_name="plexicus"):
+    def __init__(self, database_username=None, database_password=None, database_host="mongodb", port: int = 27017, database_options=None, db_name="plexicus", **client_options):
         uri_parts = []
 
         if database_username and database_password:
@@ -26,8 +109,11 @@ class MongoDBClient:
         
         self.database_uri = "mongodb://" + "".join(uri_parts)
         self.db_name = db_name
+        self.client_options = {key: value for key, value in client_options.items() if value is not None}
         self.client = None
         self.db = None
+        # Loops this instance holds a pooled client reference on
+        self.loops = weakref.WeakSet()
 
     def __enter__(self):
         self.client = MongoClient(self.database_uri)
@@ -38,27 +124,62 @@ class MongoDBClient:
         self.client.close()
 
     async def __aenter__(self):
-        self.client = motor.motor_asyncio.AsyncIOMotorClient(self.database_uri)
+        self.client = self.get_client()
         self.db = self.client[self.db_name]
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        self.client.close()
+        # The pooled client is shared by every Database on this loop, use close() to release it.
+        pass
+
+    # Releases this instance's reference, the pool is only closed once no other instance on the loop uses it
+    def close(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is not None and loop in self.loops:
+            self.loops.discard(loop)
+            release_motor_client(self.database_uri, **self.client_options)
+
+        self.client = None
+        self.db = None
+
+    def get_client(self):
+        loop = asyncio.get_running_loop()
+
+        if loop not in self.loops:
+            self.loops.add(loop)
+            return acquire_motor_client(self.database_uri, **self.client_options)
+
+        return get_motor_client(self.database_uri, **self.client_options)
 
     def get_collection(self, collection_name):
         return self.db[collection_name]
 
 class Database:
-    def __init__(self, database_username=None, database_password=None, database_host="mongodb", port: int = 27017, database_options = None, db_name = "plexicus", retries = 5):
+    def __init__(self, database_username=None, database_password=None, database_host="mongodb", port: int = 27017, database_options = None, db_name = "plexicus", retries = 5,
+                 max_pool_size: int = 100, min_pool_size: int = 0, max_idle_time_ms: int = None,
+                 retry_policy: RetryPolicy = None, rate_limit: float = None, rate_burst: float = None, instrumentation: Instrumentation = None):
         self.db_username = database_username
         self.db_password = database_password
         self.db_host = database_host
         self.db_port = port
         self.db_options = database_options
         self.db_name = db_name
-        self.retries = 5
-        self.retry_delay=4
+        self.instrumentation = instrumentation if instrumentation else Instrumentation()
+        self.mongo = MongoDBClient(database_username, database_password, database_host, port, database_options, db_name,
+                                   maxPoolSize=max_pool_size, minPoolSize=min_pool_size, maxIdleTimeMS=max_idle_time_ms,
+                                   event_listeners=self.instrumentation.get_event_listeners())
+        self.retries = retries
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy(max_attempts=retries + 1)
+        # Requests per second shared by every Database pointing at the same server in this process
+        self.rate_limiter = get_rate_limiter(self.mongo.database_uri, rate_limit, rate_burst) if rate_limit else None
         self.batch_size=50
+        self.write_batch_size=1000
+        self.delete_chunk_size=1000
+        self.delete_concurrency=4
         self.client_collection = 'Client'
         self.cwes_collection = 'CWE'
         self.findings_collection = 'Finding'
@@ -73,8 +194,136 @@ class Database:
         self.users_collection = 'Users'
         self.invitations_collection = 'Invitations'
         self.epss_collection = 'EPSS'
+        self.llm_cache_collection = 'LLMCache'
         self.FIRST_PAGE = 0
         self.ENTRIES_PER_PAGE = 10
+        self.count_cache = get_shared_cache(_count_caches, (self.mongo.database_uri, db_name), ttl=30)
+        self.facet_cache = get_shared_cache(_facet_caches, (self.mongo.database_uri, db_name), ttl=10)
+        # Natural key of the reference collections this library writes (EPSS by load_epss). CWE, OWASP and
+        # Rules documents are written elsewhere, so their key field has to come from the caller.
+        self.reference_keys = {self.epss_collection: 'cve'}
+        self.indexes = self.get_index_spec()
+        self.reference_caches = {}
+        # find_one calls by _id issued in the same event loop tick are merged into one $in query
+        self.coalesce_reads = True
+        self.pending_reads = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        self.mongo.close()
+
+    def get_collection(self, collection_name: str):
+        return self.mongo.get_client()[self.db_name][collection_name]
+
+    # One cache per reference collection and Database, so every lookup through this instance shares it
+    def get_reference_cache(self, collection_name: str, **options) -> ReferenceCache:
+        if collection_name not in self.reference_caches:
+            self.reference_caches[collection_name] = ReferenceCache(self, collection_name, **options)
+
+        return self.reference_caches[collection_name]
+
+    # Writes drop the cached counts of the collection they touched for every Database sharing the caches
+    def invalidate_caches(self, collection_name: str):
+        self.count_cache.invalidate(lambda key: key[0] == collection_name)
+        self.facet_cache.invalidate(lambda key: key[0] == collection_name)
+
+    def is_throttled(self, error) -> bool:
+        return self.retry_policy.is_retryable(error)
+
+    async def acquire(self):
+        if self.rate_limiter:
+            await self.rate_limiter.acquire()
+
+    async def backoff(self, attempt: int, started: float, error=None) -> bool:
+        retried = await self.retry_policy.backoff(attempt, started, error, self.rate_limiter)
+        self.emit(EVENT_THROTTLE, attempt=attempt, code=self.retry_policy.get_code_and_message(error)[0] if error is not None else None, retried=retried)
+
+        return retried
+
+    def emit(self, event_type: str, **data):
+        self.instrumentation.record({'type': event_type, **data})
+
+    async def write_in_chunks(self, items: list, chunk_size: int, write: callable(list)) -> dict:
+        totals = {'nInserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'nUpserted': 0}
+        errors = []
+
+        for start in range(0, len(items), chunk_size):
+            pending = list(range(start, min(start + chunk_size, len(items))))
+            attempt, started, retry_error = 0, time.monotonic(), None
+
+            while pending:
+                await self.acquire()
+
+                try:
+                    result = await write([items[index] for index in pending])
+                    # bulk_write results carry the full counts, insert_many results only the inserted ids
+                    details = result.bulk_api_result if hasattr(result, 'bulk_api_result') else {'nInserted': len(result.inserted_ids)}
+                    pending = []
+                except BulkWriteError as e:
+                    details = e.details
+                    throttled = []
+
+                    for write_error in details.get('writeErrors', []):
+                        index = pending[write_error['index']]
+
+                        if self.is_throttled(write_error):
+                            throttled.append(index)
+                            retry_error = write_error
+                        else:
+                            errors.append({'index': index, 'detail': write_error.get('errmsg', '')})
+
+                    # Only the throttled operations of this chunk are sent again
+                    pending = throttled
+                except OperationFailure as e:
+                    details = {}
+
+                    if self.is_throttled(e):
+                        retry_error = e
+                    else:
+                        errors.extend({'index': index, 'detail': str(e)} for index in pending)
+                        pending = []
+                except PyMongoError as e:
+                    # Earlier chunks are already written, so only the items of this chunk are reported as failed
+                    details = {}
+                    errors.extend({'index': index, 'detail': str(e)} for index in pending)
+                    pending = []
+
+                for key in totals:
+                    totals[key] += details.get(key, 0)
+
+                if pending:
+                    if not await self.backoff(attempt, started, retry_error):
+                        errors.extend({'index': index, 'detail': 'Max retries reached'} for index in pending)
+                        break
+
+                    attempt += 1
+
+        return {'totals': totals, 'errors': sorted(errors, key=lambda error: error['index'])}
+
+    # Every query built by get_match_query filters on client_id, so client collections are indexed by it first
+    def get_index_spec(self) -> dict:
+        def index(*fields: str, name: str = None, **kwargs) -> IndexModel:
+            return IndexModel([(field, ASCENDING) for field in fields], name=name or '_'.join(fields), **kwargs)
+
+        indexes = {collection_name: [index('client_id')] for collection_name in (self.client_collection, self.notifications_collection, self.remediation_collection,
+                                                                                 self.scan_requests_collection, self.users_collection, self.invitations_collection)}
+        # Reference data is shared by every client and looked up by its natural key
+        indexes.update({collection_name: [index(key)] for collection_name, key in self.reference_keys.items()})
+        indexes[self.findings_collection] = [index('client_id', 'repo_id', 'status', 'severity'),
+                                             index('client_id', 'scan_id'),
+                                             index('client_id', 'repo_id', 'scan_id', 'fingerprint', '_id', name='fingerprint'),
+                                             index('cve', partialFilterExpression={'cve': {'$type': 'string'}})]
+        indexes[self.repositories_collection] = [index('client_id', 'url')]
+        indexes[self.sbom_finding_collection] = [index('client_id', 'repo_id')]
+        indexes[self.scans_collection] = [index('client_id', 'repo_id')]
+        indexes[self.llm_cache_collection] = [index('expires_at', expireAfterSeconds=0), index('accessed_at')]
+
+        return indexes
 
     def get_match_query(self, client_id: str, filters: dict = None) -> dict:
         if filters is None:
@@ -82,31 +331,73 @@ class Database:
         return {'client_id': client_id,
                 **filters}
 
-    async def execute_query(self, collection_name: str, query: callable(any)) -> any:
-        amongo = MongoDBClient(self.db_username, self.db_password, self.db_host, self.db_port, self.db_options, self.db_name)
+    # create_indexes is a no-op for indexes that already exist with the same keys and options
+    async def ensure_indexes(self, collection_names: list = None) -> dict:
+        created = {}
 
-        async with amongo:
-            collection = amongo.get_collection(collection_name)
+        for collection_name in collection_names or self.indexes:
+            created[collection_name] = await self.create_indexes(collection_name, self.indexes[collection_name])
 
-            # for attempt in range(self.retries):
-            while True:
-                try:
-                    return await query(collection)
-                except OperationFailure as e:
-                    if 'TooManyRequests' in str(e):
-                        # wait_time = (2 ** attempt) + random.uniform(0, 1)
-                        wait_time = (2 ** random.uniform(0, 1))  # Exponential backoff with jitter
-                        await asyncio.sleep(wait_time)
-                    else:
-                        print(f"Error: {e}")
-                        return None
-                except PyMongoError as e:
-                    print(f'Error: {e}')
-                    return None
+        return created
 
-            # print('Max retries reached')
-            
-            # return None
+    # explain is called with the collection and returns the query plan, it only runs for slow queries
+    async def execute_query(self, collection_name: str, query: callable(any), explain: callable(any) = None) -> any:
+        collection = self.get_collection(collection_name)
+        operation = getattr(query, '__name__', 'query').removesuffix('_query')
+        # Server commands sent while the query runs are counted against this operation
+        token = current_operation.set((collection_name, operation))
+
+        try:
+            return await self.run_query(collection, collection_name, operation, query, explain)
+        finally:
+            current_operation.reset(token)
+
+    async def run_query(self, collection, collection_name: str, operation: str, query: callable(any), explain: callable(any) = None) -> any:
+        attempt, started = 0, time.monotonic()
+
+        while True:
+            await self.acquire()
+
+            try:
+                result = await query(collection)
+            except OperationFailure as e:
+                if not self.is_throttled(e):
+                    return self.query_failed(collection_name, operation, attempt, started, e)
+
+                if not await self.backoff(attempt, started, e):
+                    return self.query_failed(collection_name, operation, attempt, started, f'Max retries reached: {e}')
+
+                attempt += 1
+                continue
+            except PyMongoError as e:
+                return self.query_failed(collection_name, operation, attempt, started, e)
+
+            duration_ms = (time.monotonic() - started) * 1000
+            documents, size = self.instrumentation.measure(result)
+            self.emit(EVENT_QUERY, operation=operation, collection=collection_name, duration_ms=duration_ms, attempts=attempt + 1, documents=documents, bytes=size, ok=True)
+
+            if self.instrumentation.is_slow(duration_ms):
+                await self.report_slow_query(collection, operation, duration_ms, explain)
+
+            return result
+
+    def query_failed(self, collection_name: str, operation: str, attempt: int, started: float, error) -> None:
+        duration_ms = (time.monotonic() - started) * 1000
+        self.emit(EVENT_ERROR, operation=operation, collection=collection_name, detail=str(error))
+        self.emit(EVENT_QUERY, operation=operation, collection=collection_name, duration_ms=duration_ms, attempts=attempt + 1, documents=None, bytes=None, ok=False)
+
+        return None
+
+    async def report_slow_query(self, collection, operation: str, duration_ms: float, explain: callable(any) = None):
+        plan = None
+
+        if explain:
+            try:
+                plan = await explain(collection)
+            except PyMongoError as e:
+                plan = {'error': str(e)}
+
+        self.emit(EVENT_SLOW_QUERY, operation=operation, collection=collection.name, duration_ms=duration_ms, explain=plan)
 
     async def aggregate(self, collection_name: str, pipeline: list) -> list:
         async def aggregate_query(collection):
@@ -114,10 +405,47 @@ class Database:
 
             return result if result else []
 
-        aggregate_result = await self.execute_query(collection_name, aggregate_query)
+        async def explain(collection):
+            return await collection.database.command('explain', {'aggregate': collection.name, 'pipeline': pipeline, 'cursor': {}}, verbosity='queryPlanner')
+
+        aggregate_result = await self.execute_query(collection_name, aggregate_query, explain)
 
         return aggregate_result if aggregate_result else []
 
+    async def bulk_write(self, collection_name: str, operations: list, chunk_size: int = None) -> dict:
+        chunk_size = chunk_size or self.write_batch_size
+
+        async def bulk_write_query(collection):
+            return await self.write_in_chunks(operations, chunk_size, lambda chunk: collection.bulk_write(chunk, ordered=False))
+
+        bulk_write_result = await self.execute_query(collection_name, bulk_write_query)
+        self.invalidate_caches(collection_name)
+
+        if not bulk_write_result:
+            return {'inserted_count': 0, 'matched_count': 0, 'modified_count': 0, 'deleted_count': 0, 'upserted_count': 0,
+                    'errors': [{'index': index, 'detail': 'Bulk write failed'} for index in range(len(operations))]}
+
+        totals = bulk_write_result['totals']
+
+        return {'inserted_count': totals['nInserted'],
+                'matched_count': totals['nMatched'],
+                'modified_count': totals['nModified'],
+                'deleted_count': totals['nRemoved'],
+                'upserted_count': totals['nUpserted'],
+                'errors': bulk_write_result['errors']}
+
+    # $indexStats counts accesses since the server started, so unused only means unused since then
+    async def check_indexes(self, collection_names: list = None) -> dict:
+        report = {}
+
+        for collection_name in collection_names or self.indexes:
+            stats = await self.aggregate(collection_name, [{'$indexStats': {}}])
+            accesses = {stat['name']: stat.get('accesses', {}).get('ops', 0) for stat in stats}
+            report[collection_name] = {'missing': [index.document['name'] for index in self.indexes.get(collection_name, []) if index.document['name'] not in accesses],
+                                       'unused': [name for name, ops in accesses.items() if name != '_id_' and ops == 0]}
+
+        return report
+
     async def count_documents(self, collection_name: str, filter_query: dict) -> int:
         async def count_documents_query(collection):
             result = await collection.count_documents(filter_query)
@@ -128,46 +456,104 @@ class Database:
 
         return count_documents_result if count_documents_result else 0
 
-    async def delete_many(self, collection_name: str, client_id: str, filters: dict = None):
+    # One $facet aggregation counts documents per value of every facet field
+    async def count_facets(self, collection_name: str, client_id: str, facets: list, filters: dict = None, cached: bool = True) -> dict:
+        match_query = self.get_match_query(client_id, filters)
+        cache_key = (collection_name, json_util.dumps(match_query, sort_keys=True), tuple(facets))
+
+        if cached and cache_key in self.facet_cache:
+            return self.facet_cache.get(cache_key)
+
+        pipeline = [{'$match': match_query},
+                    {'$facet': {'total': [{'$count': 'count'}],
+                                **{facet: [{'$group': {'_id': f'${facet}', 'count': {'$sum': 1}}}, {'$sort': {'count': -1}}] for facet in facets}}}]
+        result = await self.aggregate(collection_name, pipeline)
+
+        # $facet always returns one document, nothing back means the query failed and isn't cached
+        if not result:
+            return {'total': 0, 'facets': {facet: {} for facet in facets}}
+
+        total = result[0]['total'] or [{'count': 0}]
+        counts = {'total': total[0]['count'],
+                  'facets': {facet: {group['_id']: group['count'] for group in result[0].get(facet, [])} for facet in facets}}
+
+        self.facet_cache.set(cache_key, counts)
+
+        return counts
+
+    async def create_indexes(self, collection_name: str, indexes: list) -> list:
+        async def create_indexes_query(collection):
+            return await collection.create_indexes(indexes)
+
+        create_indexes_result = await self.execute_query(collection_name, create_indexes_query)
+
+        return create_indexes_result if create_indexes_result else []
+
+    async def delete_many(self, collection_name: str, client_id: str, filters: dict = None, chunk_size: int = None, concurrency: int = None, progress: callable(any) = None):
         query_filter = self.get_match_query(client_id, filters)
+        chunk_size = chunk_size or self.delete_chunk_size
+        concurrency = concurrency or self.delete_concurrency
+
+        async def partition(collection, range_filter: dict, buckets: int) -> list:
+            # $bucketAuto computes evenly sized _id ranges on the server, no _id is sent to the client
+            pipeline = [{'$match': range_filter}, {'$bucketAuto': {'groupBy': '$_id', 'buckets': buckets}}]
 
-        async def delete_many_query(collection):
-            total_deleted_count = 0
-            ids_to_delete = []
             try:
-                async for document in collection.find(query_filter, {'_id': 1}).batch_size(self.batch_size):
-                    ids_to_delete.append(document['_id'])
-                    
-                    if len(ids_to_delete) >= self.batch_size:
-                        await try_delete(collection, ids_to_delete)
-                        total_deleted_count += len(ids_to_delete)
-                        ids_to_delete = []
+                return [(bucket['_id']['min'], bucket['_id']['max']) async for bucket in collection.aggregate(pipeline)]
+            except OperationFailure as e:
+                self.emit(EVENT_ERROR, operation='delete_many', collection=collection_name, detail=f"Error partitioning delete, deleting by filter: {e}")
+                return [None]
+
+        def get_range_filter(id_range) -> dict:
+            if id_range is None:
+                return query_filter
+
+            return {'$and': [query_filter, {'_id': {'$gte': id_range[0], '$lte': id_range[1]}}]}
 
-                if ids_to_delete:  # Delete remaining documents
-                    await try_delete(collection, ids_to_delete)
-                    total_deleted_count += len(ids_to_delete)
+        async def delete_many_query(collection):
+            total_count = await collection.count_documents(query_filter)
+
+            if not total_count:
+                return {"deleted_count": 0, "errors": []}
 
-            except Exception as e:
-                print(f"Error trying to delete: {e}")
+            buckets = math.ceil(total_count / chunk_size)
+            started = time.monotonic()
+            id_ranges = await partition(collection, query_filter, buckets) if buckets > 1 else [None]
+            semaphore = asyncio.Semaphore(concurrency)
+            deleted = {"deleted_count": 0, "errors": []}
 
-            return {"deleted_count": total_deleted_count}
+            # A failed range is reported with its _id bounds (None when deleting by filter) so it can be retried
+            async def delete_range(id_range, attempt: int = 0):
+                range_filter = get_range_filter(id_range)
 
-        async def try_delete(collection, ids_to_delete):
-            while True:
                 try:
-                    result = await collection.delete_many({'_id': {'$in': ids_to_delete}})
-                    return result.deleted_count
+                    async with semaphore:
+                        await self.acquire()
+                        result = await collection.delete_many(range_filter)
                 except PyMongoError as e:
-                    if "Request rate is large" in str(e):
-                        await asyncio.sleep(self.retry_delay)
-                        continue
-                    else:
-                        print(f"Unknown error: {e}")
-                        raise
+                    # Throttled: back off, then retry the range as two smaller chunks
+                    if isinstance(e, OperationFailure) and self.is_throttled(e) and await self.backoff(attempt, started, e):
+                        sub_ranges = await partition(collection, range_filter, 2)
+                        await asyncio.gather(*[delete_range(id_range if sub_range is None else sub_range, attempt + 1) for sub_range in sub_ranges])
+                        return
+
+                    self.emit(EVENT_ERROR, operation='delete_many', collection=collection_name, detail=f"Error trying to delete: {e}")
+                    deleted["errors"].append({'range': id_range, 'detail': str(e)})
+                    return
+
+                deleted["deleted_count"] += result.deleted_count
+
+                if progress:
+                    progress(deleted["deleted_count"], total_count)
+
+            await asyncio.gather(*[delete_range(id_range) for id_range in id_ranges])
+
+            return deleted
 
         delete_many_result = await self.execute_query(collection_name, delete_many_query)
+        self.invalidate_caches(collection_name)
 
-        return delete_many_result if delete_many_result else {'deleted_count': 0}
+        return delete_many_result if delete_many_result else {'deleted_count': 0, 'errors': [{'range': None, 'detail': 'Delete failed'}]}
 
     async def delete_one(self, collection_name: str, client_id: str, _id: str):
         async def delete_one_query(collection):
@@ -176,11 +562,90 @@ class Database:
             return result.deleted_count > 0 if result else False
 
         delete_one_result = await self.execute_query(collection_name, delete_one_query)
+        self.invalidate_caches(collection_name)
 
         return delete_one_result if delete_one_result else False
 
+    async def count_with_cache(self, collection, filters_query: dict, count_mode) -> int:
+        if count_mode is False:
+            return None
+
+        cache_key = (collection.name, json_util.dumps(filters_query, sort_keys=True))
+
+        if count_mode == 'cached' and cache_key in self.count_cache:
+            return self.count_cache.get(cache_key)
+
+        total_elements = await collection.count_documents(filters_query)
+        self.count_cache.set(cache_key, total_elements)
+
+        return total_elements
+
+    def encode_cursor(self, document: dict, sort_field: str) -> str:
+        position = {'id': document['_id'], 'value': document.get(sort_field)}
+
+        return base64.urlsafe_b64encode(json_util.dumps(position).encode()).decode()
+
+    # Cursors come from clients, anything that isn't a position we encoded is rejected
+    def decode_cursor(self, cursor: str) -> dict:
+        try:
+            position = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except (AttributeError, ValueError) as e:
+            raise ValueError(f'Invalid pagination cursor: {e}') from e
+
+        if not isinstance(position, dict) or 'id' not in position or 'value' not in position:
+            raise ValueError('Invalid pagination cursor')
+
+        return position
+
+    def get_keyset_query(self, filters_query: dict, position: dict, sort_field: str, sort_order: int) -> dict:
+        if not position:
+            return filters_query
+
+        operator = '$gt' if sort_order == 1 else '$lt'
+
+        if sort_field == '_id':
+            seek_query = {'_id': {operator: position['id']}}
+        elif position['value'] is None:
+            # Null and missing values sort before every other type, but $gt/$lt only match values of the
+            # same type, so crossing from null to non-null values needs its own clause
+            seek_query = {sort_field: None, '_id': {operator: position['id']}}
+
+            if sort_order == 1:
+                seek_query = {'$or': [seek_query, {sort_field: {'$ne': None}}]}
+        else:
+            seek_query = {'$or': [{sort_field: {operator: position['value']}},
+                                  {sort_field: position['value'], '_id': {operator: position['id']}}]}
+
+            if sort_order == -1:
+                seek_query['$or'].append({sort_field: None})
+
+        return {'$and': [filters_query, seek_query]}
+
+    def get_keyset_sort(self, sort_field: str, sort_order: int) -> list:
+        return [(sort_field, sort_order)] if sort_field == '_id' else [(sort_field, sort_order), ('_id', sort_order)]
+
+    def get_keyset_fields(self, fields, sort_field: str):
+        # Positions are built from the sort field, so inclusion projections must return it
+        if isinstance(fields, dict) and fields and all(fields.values()):
+            return {**fields, sort_field: 1}
+
+        if isinstance(fields, list):
+            return [*fields, sort_field]
+
+        return fields
+
+    # Returns None when the query failed, so callers can tell a failure from no matches
+    async def find_in(self, collection_name: str, field: str, values: list, filters: dict = None, fields: dict = None) -> list:
+        query_filter = {**(filters or {}), field: {'$in': list(values)}}
+
+        async def find_in_query(collection):
+            return [document async for document in collection.find(query_filter, fields).batch_size(max(self.batch_size, len(values)))]
+
+        return await self.execute_query(collection_name, find_in_query, lambda collection: collection.find(query_filter, fields).explain())
+
     async def find_many(self, collection_name: str, client_id: str, options: dict = None):
         filters, fields, sort_field, sort_order, paginate, skip, page_size = None, None, "_id", 1, True, self.FIRST_PAGE, self.ENTRIES_PER_PAGE
+        keyset, page_cursor, count_mode = False, None, True
 
         if options:
             # Filters & Fields
@@ -199,22 +664,48 @@ class Database:
             page_size = pagination_options.get('page_size', self.ENTRIES_PER_PAGE) if paginate else self.ENTRIES_PER_PAGE
             skip = max(page_skip * page_size, self.FIRST_PAGE) if paginate else self.FIRST_PAGE
 
+            # Keyset pagination seeks past the (sort field, _id) of the previous page instead of skipping,
+            # count is True (always), 'cached' (reuse a recent total) or False (never)
+            keyset = paginate and pagination_options.get('mode') == 'keyset'
+            page_cursor = pagination_options.get('cursor', None)
+            count_mode = pagination_options.get('count', True)
+
         filters_query = self.get_match_query(client_id, filters)
+        position = self.decode_cursor(page_cursor) if keyset and page_cursor else None
 
         async def find_many_query(collection):
-            total_elements = await collection.count_documents(filters_query)
-            total_pages = math.ceil(total_elements / page_size) if paginate else 0
             pagination_meta = {}
             
             results = []
-            if paginate:
+            if keyset:
+                seek_query = self.get_keyset_query(filters_query, position, sort_field, sort_order)
+                total_elements = await self.count_with_cache(collection, filters_query, count_mode)
+
+                # One extra document tells whether there is a next page
+                documents = collection.find(seek_query, self.get_keyset_fields(fields, sort_field)).sort(self.get_keyset_sort(sort_field, sort_order)).batch_size(self.batch_size)
+                async for document in documents.limit(page_size + 1):
+                    results.append(document)
+
+                has_next = len(results) > page_size
+                results = results[:page_size]
+                pagination_meta["pagination"] = {
+                    "pageCount": math.ceil(total_elements / page_size) if total_elements is not None else None,
+                    "pageSize": page_size,
+                    "total": total_elements,
+                    "nextCursor": self.encode_cursor(results[-1], sort_field) if has_next else None
+                }
+
+                for document in results:
+                    document['_id'] = str(document['_id'])
+            elif paginate:
+                total_elements = await self.count_with_cache(collection, filters_query, count_mode)
                 cursor = collection.find(filters_query, fields).sort([(sort_field, sort_order)]).skip(skip).batch_size(self.batch_size)
                 async for document in cursor.limit(page_size):
                     document['_id'] = str(document['_id'])
                     results.append(document)
                 pagination_meta["pagination"] = {
                     "page": skip // page_size + 1,
-                    "pageCount": total_pages,
+                    "pageCount": math.ceil(total_elements / page_size) if total_elements is not None else None,
                     "pageSize": page_size,
                     "total": total_elements
                 }
@@ -225,7 +716,8 @@ class Database:
                     results.append(document)
             return {"data": results, "meta": pagination_meta}
 
-        find_many_result = await self.execute_query(collection_name, find_many_query)
+        find_many_result = await self.execute_query(collection_name, find_many_query,
+                                                    lambda collection: collection.find(filters_query, fields).sort([(sort_field, sort_order)]).explain())
 
         return find_many_result if find_many_result else {"data": []}
 
@@ -233,6 +725,9 @@ class Database:
         if client_id is None and _id is None and extra_fields is None:
             return None
 
+        if self.coalesce_reads and client_id is not None and _id is not None and extra_fields is None:
+            return await self.load_one(collection_name, client_id, ObjectId(_id))
+
         query_filter = {}
 
         if client_id is not None:
@@ -252,10 +747,47 @@ class Database:
 
             return result if result else {}
 
-        find_one_result = await self.execute_query(collection_name, find_one_query)
+        find_one_result = await self.execute_query(collection_name, find_one_query, lambda collection: collection.find(query_filter).limit(1).explain())
 
         return find_one_result if find_one_result else {}
 
+    def load_one(self, collection_name: str, client_id: str, _id: ObjectId) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        key = (collection_name, client_id)
+        batch = self.pending_reads.get(key)
+
+        if batch is None:
+            batch = self.pending_reads[key] = {}
+            loop.call_soon(lambda: asyncio.ensure_future(self.dispatch_reads(key)))
+
+        future = loop.create_future()
+        batch.setdefault(_id, []).append(future)
+
+        return future
+
+    async def dispatch_reads(self, key: tuple):
+        batch = self.pending_reads.pop(key)
+        collection_name, client_id = key
+
+        try:
+            documents = await self.find_in(collection_name, '_id', list(batch), {'client_id': client_id})
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        documents_by_id = {document['_id']: document for document in documents or []}
+
+        # Every caller gets its own copy of the document, same as a separate find_one would return
+        for _id, futures in batch.items():
+            document = documents_by_id.get(_id)
+
+            for future in futures:
+                if not future.done():
+                    future.set_result({**document, '_id': str(_id)} if document else {})
+
     async def insert_one(self, collection_name: str, data: dict) -> str:
         async def insert_one_query(collection):
             result = await collection.insert_one(data)
@@ -263,10 +795,102 @@ class Database:
             return str(result.inserted_id) if result else ''
 
         insert_one_result = await self.execute_query(collection_name, insert_one_query)
+        self.invalidate_caches(collection_name)
 
         return insert_one_result if insert_one_result else ''
 
-    async def update_one(self, collection_name: str, client_id: str, _id: str, data: dict, extra_fields: dict = None):
+    async def insert_many(self, collection_name: str, documents: list, chunk_size: int = None) -> dict:
+        chunk_size = chunk_size or self.write_batch_size
+
+        async def insert_many_query(collection):
+            return await self.write_in_chunks(documents, chunk_size, lambda chunk: collection.insert_many(chunk, ordered=False))
+
+        insert_many_result = await self.execute_query(collection_name, insert_many_query)
+        self.invalidate_caches(collection_name)
+
+        if not insert_many_result:
+            return {'inserted_ids': [None] * len(documents),
+                    'errors': [{'index': index, 'detail': 'Insert failed'} for index in range(len(documents))]}
+
+        failed = {error['index'] for error in insert_many_result['errors']}
+        # insert_many sets the generated _id on each document before sending it
+        inserted_ids = [None if index in failed else str(document['_id']) for index, document in enumerate(documents)]
+
+        return {'inserted_ids': inserted_ids, 'errors': insert_many_result['errors']}
+
+    # Errors are raised once retries run out, so callers can't mistake a broken stream for a finished one
+    async def iter_aggregate(self, collection_name: str, pipeline: list, batch_size: int = None):
+        collection = self.get_collection(collection_name)
+        attempt, started, yielded = 0, time.monotonic(), False
+
+        # A pipeline has no position to resume from, so throttling is only retried before the first document
+        while True:
+            await self.acquire()
+
+            try:
+                async for document in collection.aggregate(pipeline).batch_size(batch_size or self.batch_size):
+                    yielded = True
+                    yield document
+
+                return
+            except OperationFailure as e:
+                if yielded or not self.is_throttled(e) or not await self.backoff(attempt, started, e):
+                    self.emit(EVENT_ERROR, operation='iter_aggregate', collection=collection_name, detail=str(e))
+                    raise
+
+                attempt += 1
+            except PyMongoError as e:
+                self.emit(EVENT_ERROR, operation='iter_aggregate', collection=collection_name, detail=str(e))
+                raise
+
+    async def iter_many(self, collection_name: str, client_id: str, options: dict = None, batch_size: int = None):
+        options = options or {}
+        sort_options = options.get('sort', {})
+        sort_field = sort_options.get('field', '_id')
+        sort_order = sort_options.get('order', 1)
+        fields = self.get_keyset_fields(options.get('fields', None), sort_field)
+        filters_query = self.get_match_query(client_id, options.get('filters', None))
+        collection = self.get_collection(collection_name)
+        position = None
+        attempt, started = 0, time.monotonic()
+
+        # A throttled cursor is reopened right after the last yielded document instead of starting over
+        while True:
+            await self.acquire()
+
+            try:
+                documents = collection.find(self.get_keyset_query(filters_query, position, sort_field, sort_order), fields)
+                async for document in documents.sort(self.get_keyset_sort(sort_field, sort_order)).batch_size(batch_size or self.batch_size):
+                    position = {'id': document['_id'], 'value': document.get(sort_field)}
+                    document['_id'] = str(document['_id'])
+                    yield document
+
+                return
+            except OperationFailure as e:
+                if not self.is_throttled(e) or not await self.backoff(attempt, started, e):
+                    self.emit(EVENT_ERROR, operation='iter_many', collection=collection_name, detail=str(e))
+                    raise
+
+                attempt += 1
+            except PyMongoError as e:
+                self.emit(EVENT_ERROR, operation='iter_many', collection=collection_name, detail=str(e))
+                raise
+
+    # update is an update document or an update pipeline (a list of stages)
+    async def update_many(self, collection_name: str, client_id: str, filters: dict, update) -> dict:
+        query_filter = self.get_match_query(client_id, filters)
+
+        async def update_many_query(collection):
+            result = await collection.update_many(query_filter, update)
+
+            return {'matched_count': result.matched_count, 'modified_count': result.modified_count}
+
+        update_many_result = await self.execute_query(collection_name, update_many_query)
+        self.invalidate_caches(collection_name)
+
+        return update_many_result if update_many_result else {'matched_count': 0, 'modified_count': 0}
+
+    async def update_one(self, collection_name: str, client_id: str, _id: str, data: dict, extra_fields: dict = None, projection: dict = None, return_document: bool = True):
         if client_id is None and _id is None and extra_fields is None:
             return None
 
@@ -282,14 +906,23 @@ class Database:
             query_filter.update(extra_fields)
 
         async def update_one_query(collection):
-            result = await collection.update_one(query_filter, {"$set": data})
-            existing_document = await collection.find_one(query_filter)
+            # Callers that don't need the document only get whether it matched
+            if not return_document:
+                result = await collection.update_one(query_filter, {"$set": data})
+
+                return result.matched_count > 0 if result else False
 
-            if existing_document:
-                existing_document["_id"] = str(existing_document["_id"])
+            updated_document = await collection.find_one_and_update(query_filter, {"$set": data}, projection=projection, return_document=ReturnDocument.AFTER)
 
-            return existing_document if result and result.modified_count > 0 else {}
+            if updated_document:
+                updated_document["_id"] = str(updated_document["_id"])
+
+            return updated_document if updated_document else {}
 
         update_one_result = await self.execute_query(collection_name, update_one_query)
+        self.invalidate_caches(collection_name)
+
+        if not return_document:
+            return bool(update_one_result)
 
         return update_one_result if update_one_result else {}
@@ -0,0 +1,119 @@
+from .database import Database
+from .finding import Finding
+from pymongo import UpdateOne
+
+import csv
+import gzip
+
+EPSS_CVE = 'cve'
+EPSS_SCORE = 'epss'
+EPSS_PERCENTILE = 'percentile'
+EPSS_MODEL_VERSION = 'model_version'
+EPSS_SCORE_DATE = 'score_date'
+
+def open_epss(path: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+
+    return open(path, 'r', encoding='utf-8', newline='')
+
+# The feed starts with a "#model_version:...,score_date:..." comment line followed by a cve,epss,percentile header
+def iter_epss_scores(file):
+    metadata = {}
+    header = None
+
+    for row in csv.reader(file):
+        if not row:
+            continue
+
+        if row[0].startswith('#'):
+            for entry in row:
+                key, _, value = entry.lstrip('#').partition(':')
+                metadata[key.strip()] = value.strip()
+            continue
+
+        if header is None:
+            header = [column.strip() for column in row]
+            continue
+
+        values = dict(zip(header, row))
+
+        yield {EPSS_CVE: values[EPSS_CVE],
+               EPSS_SCORE: float(values[EPSS_SCORE]),
+               EPSS_PERCENTILE: float(values[EPSS_PERCENTILE]),
+               EPSS_MODEL_VERSION: metadata.get(EPSS_MODEL_VERSION),
+               EPSS_SCORE_DATE: metadata.get(EPSS_SCORE_DATE)}
+
+# Only scores that changed are written, so a daily load mostly reads. The stored scores for each chunk
+# are fetched with one $in query and compared before building the upserts.
+async def load_epss(database: Database, source, chunk_size: int = None, refresh_findings: bool = True) -> dict:
+    chunk_size = chunk_size or database.write_batch_size
+    summary = {'read_count': 0, 'unchanged_count': 0, 'upserted_count': 0, 'modified_count': 0, 'errors': []}
+    changed_cves = []
+
+    async def write(chunk: list):
+        stored = await database.find_in(database.epss_collection, EPSS_CVE, [score[EPSS_CVE] for score in chunk],
+                                        fields={EPSS_CVE: 1, EPSS_SCORE: 1, EPSS_PERCENTILE: 1})
+        stored_scores = {document[EPSS_CVE]: (document.get(EPSS_SCORE), document.get(EPSS_PERCENTILE)) for document in stored or []}
+        changed = [score for score in chunk if stored_scores.get(score[EPSS_CVE]) != (score[EPSS_SCORE], score[EPSS_PERCENTILE])]
+        summary['unchanged_count'] += len(chunk) - len(changed)
+
+        if not changed:
+            return
+
+        result = await database.bulk_write(database.epss_collection, [UpdateOne({EPSS_CVE: score[EPSS_CVE]}, {'$set': score}, upsert=True) for score in changed], chunk_size)
+        summary['upserted_count'] += result['upserted_count']
+        summary['modified_count'] += result['modified_count']
+        summary['errors'].extend(result['errors'])
+        changed_cves.extend(score[EPSS_CVE] for score in changed)
+
+    file = open_epss(source) if isinstance(source, str) else source
+
+    try:
+        chunk = []
+
+        for score in iter_epss_scores(file):
+            chunk.append(score)
+            summary['read_count'] += 1
+
+            if len(chunk) >= chunk_size:
+                await write(chunk)
+                chunk = []
+
+        if chunk:
+            await write(chunk)
+    finally:
+        if isinstance(source, str):
+            file.close()
+
+    if refresh_findings:
+        for start in range(0, len(changed_cves), chunk_size):
+            result = await refresh_finding_epss(database, changed_cves[start:start + chunk_size])
+            summary['errors'].extend(result['errors'])
+
+    return summary
+
+# Findings are updated server side: the scores are joined by cve and merged back into the Finding collection.
+# The pipeline writes findings, so the Finding caches are invalidated even when it fails part way.
+async def refresh_finding_epss(database: Database, cves: list = None) -> dict:
+    match = {Finding.CVE: {'$in': cves}} if cves is not None else {Finding.CVE: {'$type': 'string'}}
+    pipeline = [
+        {'$match': match},
+        {'$lookup': {'from': database.epss_collection, 'localField': Finding.CVE, 'foreignField': EPSS_CVE, 'as': 'epss_scores'}},
+        {'$match': {'epss_scores.0': {'$exists': True}}},
+        {'$project': {Finding.EPSS: {'$arrayElemAt': [f'$epss_scores.{EPSS_SCORE}', 0]}}},
+        {'$merge': {'into': database.findings_collection, 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}
+    ]
+
+    async def refresh_epss_query(collection):
+        await collection.aggregate(pipeline).to_list(length=None)
+
+        return True
+
+    refreshed = await database.execute_query(database.findings_collection, refresh_epss_query)
+    database.invalidate_caches(database.findings_collection)
+
+    if not refreshed:
+        return {'errors': [{'detail': 'Finding EPSS refresh failed', 'cves': cves}]}
+
+    return {'errors': []}
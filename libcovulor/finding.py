@@ -1,9 +1,18 @@
+from .buffer import WriteBehindBuffer
 from .database import Database, MongoDBClient
+from .openai import get_response_format, read_batch_results, write_batch_request
+from bson import ObjectId
+from bson.errors import InvalidId
 from datetime import datetime
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from pymongo import UpdateMany, UpdateOne
 from pymongo.errors import PyMongoError
 from typing import Optional
 
+import copy
+import hashlib
+import posixpath
+
 class Finding:
     ACCESS_CREDENTIAL = 'access_credential'
     ACTUAL_LINE = 'line'
@@ -29,6 +38,7 @@ class Finding:
     EXTRA_CWE = 'extra_cwe'
     FALSE_POSITIVE_TYPE = 'fp_type'
     FILE = 'file_path'
+    FINGERPRINT = 'fingerprint'
     FIXING_EFFORT = 'effort_for_fixing'
     ID = 'finding_id'
     IMPACT = 'impact'
@@ -85,8 +95,26 @@ class Finding:
     STATUS_SOLVED = 'solved'
     STATUS_ISSUED = 'issued'
 
-    def __init__(self, database_username=None, database_password=None, database_host="mongodb", port: int = 27017, database_options=None, db_name="plexicus"):
-        self.db = Database(database_username, database_password, database_host, port, database_options, db_name)
+    SEVERITY_CRITICAL = 'critical'
+    SEVERITY_HIGH = 'high'
+    SEVERITY_MEDIUM = 'medium'
+    SEVERITY_LOW = 'low'
+    SEVERITY_INFO = 'info'
+
+    # Read modes: full validation, trusted construction of documents we wrote ourselves, or plain dicts
+    READ_VALIDATE = 'validate'
+    READ_TRUSTED = 'trusted'
+    READ_RAW = 'raw'
+
+    VIEW_FULL = 'full'
+    VIEW_SUMMARY = 'summary'
+
+    STATS_FACETS = [SEVERITY, STATUS, TOOL, CATEGORY, REPOSITORY_ID]
+
+    def __init__(self, database_username=None, database_password=None, database_host="mongodb", port: int = 27017, database_options=None, db_name="plexicus", read_mode: str = READ_VALIDATE, **pool_options):
+        self.db = Database(database_username, database_password, database_host, port, database_options, db_name, **pool_options)
+        self.read_mode = read_mode
+        self.write_buffer = None
         self.db_username = database_username
         self.db_password = database_password
         self.db_host = database_host
@@ -94,9 +122,84 @@ class Finding:
         self.db_options = database_options
         self.db_name = db_name
 
+    async def apply_enrichment_batch(self, client_id: str, result_path: str, response_model: type[BaseModel], to_update: callable(dict) = None, chunk_size: int = None) -> dict:
+        chunk_size = chunk_size or self.db.write_batch_size
+        summary = {'matched_count': 0, 'modified_count': 0, 'errors': []}
+        operations = []
+
+        async def flush(batch: list):
+            result = await self.db.bulk_write(self.db.findings_collection, batch, chunk_size)
+            summary['matched_count'] += result['matched_count']
+            summary['modified_count'] += result['modified_count']
+            summary['errors'].extend(result['errors'])
+
+        # Parsed responses are set on the finding as they are unless to_update maps them to finding fields
+        for finding_id, response in read_batch_results(result_path, response_model):
+            if 'status_code' in response:
+                summary['errors'].append({'finding_id': finding_id, 'detail': response['detail']})
+                continue
+
+            try:
+                finding_filter = {'_id': ObjectId(finding_id), Finding.CLIENT_ID: client_id}
+            except (InvalidId, TypeError):
+                summary['errors'].append({'finding_id': finding_id, 'detail': 'Invalid finding id'})
+                continue
+
+            operations.append(UpdateOne(finding_filter, {'$set': to_update(response) if to_update else response}))
+
+            if len(operations) >= chunk_size:
+                await flush(operations)
+                operations = []
+
+        if operations:
+            await flush(operations)
+
+        return summary
+
+    async def close(self):
+        if self.write_buffer is not None:
+            await self.write_buffer.close()
+
+        await self.db.close()
+
+    # Runs after the insert so only duplicates that were written are counted. When the original of a batch
+    # failed to insert, the first inserted duplicate takes its place and the others point to it.
+    async def count_duplicates(self, duplicates: tuple, inserted: set):
+        existing_duplicates, batch_groups = duplicates
+        operations = []
+
+        for original_id, documents in existing_duplicates.items():
+            occurrences = sum(document['_id'] in inserted for document in documents)
+
+            if occurrences:
+                # Older originals may not have a count yet, so the increment is done with an update pipeline
+                operations.append(UpdateOne({'_id': original_id}, [{'$set': {Finding.NB_OCCURRENCES: {'$add': [{'$ifNull': [f'${Finding.NB_OCCURRENCES}', 1]}, occurrences]}}}]))
+
+        for group in batch_groups:
+            inserted_group = [document for document in group if document['_id'] in inserted]
+
+            if not inserted_group:
+                continue
+
+            original = inserted_group[0]
+
+            if original is not group[0]:
+                operations.append(UpdateOne({'_id': original['_id']}, {'$set': {Finding.IS_DUPLICATE: False, Finding.DUPLICATE_ID: None,
+                                                                               Finding.NB_OCCURRENCES: len(inserted_group)}}))
+
+                if len(inserted_group) > 1:
+                    operations.append(UpdateMany({'_id': {'$in': [document['_id'] for document in inserted_group[1:]]}},
+                                                 {'$set': {Finding.DUPLICATE_ID: str(original['_id'])}}))
+            elif len(inserted_group) != len(group):
+                operations.append(UpdateOne({'_id': original['_id']}, {'$set': {Finding.NB_OCCURRENCES: len(inserted_group)}}))
+
+        if operations:
+            await self.db.bulk_write(self.db.findings_collection, operations)
+
     async def create(self, data: dict):
         data[Finding.PROCESSING_STATUS] = "processing"
-        finding_model = FindingModel.parse_obj(data)
+        finding_model = FindingModel.model_validate(data)
+        finding_model.fingerprint = finding_model.fingerprint or get_fingerprint(finding_model)
         finding = await self.db.insert_one(self.db.findings_collection, finding_model.model_dump(by_alias=True))
 
         if not finding:
@@ -106,37 +209,267 @@ class Finding:
 
         return finding_model
 
+    async def create_enrichment_batch(self, client_id: str, request_path: str, openai_data: dict, prompt_system_message: str, build_prompt: callable(any),
+                                      response_model: type[BaseModel], options: dict = None) -> int:
+        response_format = get_response_format(response_model)
+        count = 0
+
+        # One request per finding, keyed by the finding _id so results can be applied back
+        with open(request_path, 'w', encoding='utf-8') as file:
+            async for finding in self.iter_many(client_id, options, read_mode=Finding.READ_TRUSTED):
+                write_batch_request(file, openai_data, finding.object_id, build_prompt(finding), prompt_system_message, response_format)
+                count += 1
+
+        return count
+
+    async def create_many(self, data: list, chunk_size: int = None, deduplicate: bool = True):
+        finding_models = [None] * len(data)
+        errors = []
+
+        for index, finding in enumerate(data):
+            try:
+                finding_models[index] = FindingModel.model_validate({**finding, Finding.PROCESSING_STATUS: "processing"})
+                finding_models[index].fingerprint = finding_models[index].fingerprint or get_fingerprint(finding_models[index])
+            except ValidationError as e:
+                errors.append({'index': index, 'detail': str(e)})
+
+        valid_indexes = [index for index, finding_model in enumerate(finding_models) if finding_model is not None]
+        documents = [{'_id': ObjectId(), **finding_models[index].model_dump(by_alias=True)} for index in valid_indexes]
+
+        duplicates = await self.mark_duplicates(documents) if deduplicate else None
+        result = await self.db.insert_many(self.db.findings_collection, documents, chunk_size)
+
+        if duplicates:
+            await self.count_duplicates(duplicates, {document['_id'] for document, inserted_id in zip(documents, result['inserted_ids']) if inserted_id})
+
+        for index, inserted_id in zip(valid_indexes, result['inserted_ids']):
+            if inserted_id:
+                finding_models[index].object_id = inserted_id
+            else:
+                finding_models[index] = None
+
+        errors.extend({'index': valid_indexes[error['index']], 'detail': error['detail']} for error in result['errors'])
+
+        return {'data': finding_models, 'errors': sorted(errors, key=lambda error: error['index'])}
+
     async def delete(self, client_id: str, finding_id: str):
         dict_finding = await self.db.delete_one(self.db.findings_collection, client_id, finding_id)
 
-        return FindingModel.parse_obj(dict_finding)
+        return FindingModel.model_validate(dict_finding)
 
     async def delete_many(self, client_id: str, options: dict = None):
         dict_finding = await self.db.delete_many(self.db.findings_collection, client_id, options)
 
         return dict_finding
 
-    async def find_many(self, client_id: str, options: dict = None):
-        findings = await self.db.find_many(self.db.findings_collection, client_id, options)
-        model_data = []
+    # Both scans are streamed in fingerprint order and merged in one pass: fingerprints only in the old scan
+    # are fixed, only in the new scan are new, and findings in both carry their status over to the new scan.
+    # A finding that was solved and shows up again is counted as new. A read error on either scan is raised
+    # by iter_many and aborts the merge, so a truncated scan never marks the rest of the other one as fixed.
+    async def diff_scans(self, client_id: str, repo_id: str, old_scan_id: str, new_scan_id: str, batch_size: int = None, chunk_size: int = None) -> dict:
+        chunk_size = chunk_size or self.db.write_batch_size
+        summary = {'new_count': 0, 'fixed_count': 0, 'unchanged_count': 0, 'modified_count': 0, 'errors': []}
+        operations = []
+
+        def iter_scan(scan_id: str):
+            options = {'filters': {Finding.REPOSITORY_ID: repo_id, Finding.SCAN_ID: scan_id, Finding.IS_DUPLICATE: False, Finding.FINGERPRINT: {'$type': 'string'}},
+                       'fields': {Finding.FINGERPRINT: 1, Finding.STATUS: 1},
+                       'sort': {'field': Finding.FINGERPRINT, 'order': 1}}
+
+            return self.db.iter_many(self.db.findings_collection, client_id, options, batch_size)
+
+        async def flush(batch: list):
+            result = await self.db.bulk_write(self.db.findings_collection, batch, chunk_size)
+            summary['modified_count'] += result['modified_count']
+            summary['errors'].extend(result['errors'])
+
+        # A fingerprint can repeat in a scan (create() doesn't mark duplicates, concurrent imports can race),
+        # so the merge works on runs of equal fingerprints
+        async def take_run(findings, first: dict) -> tuple:
+            run = [first]
+            following = await anext(findings, None)
+
+            while following is not None and following[Finding.FINGERPRINT] == first[Finding.FINGERPRINT]:
+                run.append(following)
+                following = await anext(findings, None)
+
+            return run, following
+
+        await self.flush_writes()
+        old_findings, new_findings = iter_scan(old_scan_id), iter_scan(new_scan_id)
+        old_finding, new_finding = await anext(old_findings, None), await anext(new_findings, None)
+
+        while old_finding is not None or new_finding is not None:
+            if new_finding is None or (old_finding is not None and old_finding[Finding.FINGERPRINT] < new_finding[Finding.FINGERPRINT]):
+                old_run, old_finding = await take_run(old_findings, old_finding)
+
+                for finding in old_run:
+                    if finding.get(Finding.STATUS) != Finding.STATUS_SOLVED:
+                        operations.append(UpdateOne({'_id': ObjectId(finding['_id'])}, {'$set': {Finding.STATUS: Finding.STATUS_SOLVED}}))
+                        summary['fixed_count'] += 1
+            elif old_finding is None or new_finding[Finding.FINGERPRINT] < old_finding[Finding.FINGERPRINT]:
+                new_run, new_finding = await take_run(new_findings, new_finding)
+                summary['new_count'] += len(new_run)
+            else:
+                old_run, old_finding = await take_run(old_findings, old_finding)
+                new_run, new_finding = await take_run(new_findings, new_finding)
+                # The issue is still present, so none of the old findings is fixed and every new one takes the
+                # status of the first old finding that is still open
+                status = next((finding.get(Finding.STATUS, Finding.STATUS_NEW) for finding in old_run if finding.get(Finding.STATUS) != Finding.STATUS_SOLVED),
+                              Finding.STATUS_SOLVED)
+
+                for finding in new_run:
+                    if status == Finding.STATUS_SOLVED:
+                        summary['new_count'] += 1
+                        continue
+
+                    summary['unchanged_count'] += 1
+
+                    if finding.get(Finding.STATUS) != status:
+                        operations.append(UpdateOne({'_id': ObjectId(finding['_id'])}, {'$set': {Finding.STATUS: status}}))
+
+            if len(operations) >= chunk_size:
+                await flush(operations)
+                operations = []
+
+        if operations:
+            await flush(operations)
 
-        for finding in findings['data']:
-            model_finding = FindingModel.parse_obj(finding)
-            model_data.append(model_finding)
+        return summary
 
-        findings['data'] = model_data
+    # Opt-in: update calls that don't need the updated document are buffered and merged per finding.
+    # Reads through this Finding flush the buffer first, reads from other instances or processes can be stale.
+    def enable_write_behind(self, max_pending: int = 1000, flush_interval: float = 1.0) -> WriteBehindBuffer:
+        if self.write_buffer is None:
+            self.write_buffer = WriteBehindBuffer(self.db, self.db.findings_collection, max_pending, flush_interval)
+
+        return self.write_buffer
+
+    async def ensure_indexes(self) -> list:
+        created = await self.db.ensure_indexes([self.db.findings_collection])
+
+        return created[self.db.findings_collection]
+
+    async def find_many(self, client_id: str, options: dict = None, read_mode: str = None, view: str = None):
+        await self.flush_writes()
+        findings = await self.db.find_many(self.db.findings_collection, client_id, self.get_view_options(options, view))
+        findings['data'] = self.to_models(findings['data'], read_mode, view)
 
         return findings
 
-    async def find_one(self, client_id: str, finding_id: str):
+    async def find_one(self, client_id: str, finding_id: str, read_mode: str = None):
+        await self.flush_writes()
         dict_finding = await self.db.find_one(self.db.findings_collection, client_id, finding_id)
 
-        return FindingModel.parse_obj(dict_finding)
+        return self.to_models([dict_finding], read_mode)[0]
+
+    # Buffered updates are written before reads so they are seen
+    async def flush_writes(self):
+        if self.write_buffer is not None and len(self.write_buffer):
+            await self.write_buffer.flush()
+
+    def get_view_options(self, options: dict = None, view: str = None) -> dict:
+        # Explicit fields win over the view projection
+        if view is None or view == Finding.VIEW_FULL or (options and options.get('fields')):
+            return options
+
+        return {**(options or {}), 'fields': get_projection(FINDING_VIEWS[view])}
+
+    async def iter_many(self, client_id: str, options: dict = None, batch_size: int = None, read_mode: str = None, view: str = None):
+        await self.flush_writes()
+
+        async for finding in self.db.iter_many(self.db.findings_collection, client_id, self.get_view_options(options, view), batch_size):
+            yield self.to_models([finding], read_mode, view)[0]
+
+    # Duplicates are scoped to a scan: the first finding with a fingerprint in a (client, repository, scan)
+    # is the original, later ones point to it and the original counts every occurrence. Nothing is written here:
+    # the duplicates of existing originals and the in-batch groups are returned for count_duplicates.
+    async def mark_duplicates(self, documents: list) -> tuple:
+        scopes = {}
+
+        for document in documents:
+            scope = (document[Finding.CLIENT_ID], document[Finding.REPOSITORY_ID], document[Finding.SCAN_ID])
+            scopes.setdefault(scope, []).append(document)
+
+        existing_duplicates, batch_groups = {}, []
+
+        for (client_id, repo_id, scan_id), scope_documents in scopes.items():
+            originals = await self.db.find_in(self.db.findings_collection, Finding.FINGERPRINT, {document[Finding.FINGERPRINT] for document in scope_documents},
+                                              {Finding.CLIENT_ID: client_id, Finding.REPOSITORY_ID: repo_id, Finding.SCAN_ID: scan_id, Finding.IS_DUPLICATE: False},
+                                              {Finding.FINGERPRINT: 1})
+            originals_by_fingerprint = {original[Finding.FINGERPRINT]: original['_id'] for original in originals or []}
+            batch_originals = {}
+
+            for document in scope_documents:
+                fingerprint = document[Finding.FINGERPRINT]
+
+                if fingerprint in originals_by_fingerprint:
+                    original_id = originals_by_fingerprint[fingerprint]
+                    existing_duplicates.setdefault(original_id, []).append(document)
+                elif fingerprint in batch_originals:
+                    group = batch_originals[fingerprint]
+                    group.append(document)
+                    group[0][Finding.NB_OCCURRENCES] = len(group)
+                    original_id = group[0]['_id']
+                else:
+                    document[Finding.NB_OCCURRENCES] = 1
+                    batch_originals[fingerprint] = [document]
+                    continue
+
+                document[Finding.IS_DUPLICATE] = True
+                document[Finding.DUPLICATE_ID] = str(original_id)
+
+            batch_groups.extend(group for group in batch_originals.values() if len(group) > 1)
+
+        return existing_duplicates, batch_groups
+
+    async def stats(self, client_id: str, filters: dict = None, facets: list = None, cached: bool = True) -> dict:
+        await self.flush_writes()
+
+        return await self.db.count_facets(self.db.findings_collection, client_id, facets or Finding.STATS_FACETS, filters, cached)
+
+    def to_models(self, documents: list, read_mode: str = None, view: str = None) -> list:
+        read_mode = read_mode or self.read_mode
+        model = FINDING_VIEWS[view or Finding.VIEW_FULL]
+
+        if read_mode == Finding.READ_RAW:
+            return documents
+
+        if read_mode == Finding.READ_TRUSTED:
+            return [construct_model(model, document) for document in documents]
+
+        return get_list_adapter(model).validate_python(documents)
+
+    # One server side update for every finding in from_status: the status guard keeps a retried or concurrent
+    # transition from touching findings that already moved. With pipeline=True the extra_set values are
+    # aggregation expressions evaluated per finding, e.g. {'severity_numerical': '$cvssv3_score'}.
+    async def transition_many(self, client_id: str, filters: dict, from_status, to_status: str, extra_set: dict = None,
+                              status_field: str = STATUS, pipeline: bool = False) -> dict:
+        from_statuses = from_status if isinstance(from_status, (list, tuple, set)) else [from_status]
+        guarded_filters = {**(filters or {}), status_field: {'$in': list(from_statuses)}}
+        fields = {**(extra_set or {}), status_field: to_status}
+
+        if pipeline:
+            fields[status_field] = {'$literal': to_status}
+
+        await self.flush_writes()
+
+        return await self.db.update_many(self.db.findings_collection, client_id, guarded_filters, [{'$set': fields}] if pipeline else {'$set': fields})
+
+    async def update(self, client_id: str, finding_id: str, data: dict, return_document: bool = True):
+        if self.write_buffer is not None and not return_document:
+            await self.write_buffer.set(client_id, finding_id, data)
+            return True
+
+        # The returned document must include buffered updates
+        await self.flush_writes()
+
+        if not return_document:
+            return await self.db.update_one(self.db.findings_collection, client_id, finding_id, data, return_document=False)
 
-    async def update(self, client_id: str, finding_id: str, data: dict):
         dict_finding = await self.db.update_one(self.db.findings_collection, client_id, finding_id, data)
 
-        return FindingModel.parse_obj(dict_finding)
+        return FindingModel.model_validate(dict_finding)
 
 class FindingModel(BaseModel):
     object_id: Optional[str] = Field(default=None, exclude=True, alias='_id')
@@ -164,6 +497,7 @@ class FindingModel(BaseModel):
     extra_cwe: Optional[list] = Field(default=[], alias=Finding.EXTRA_CWE)
     false_positive_type: Optional[str] = Field(default=None, alias=Finding.FALSE_POSITIVE_TYPE)
     file: str = Field(alias=Finding.FILE)
+    fingerprint: Optional[str] = Field(default=None, alias=Finding.FINGERPRINT)
     fixing_effort: Optional[str] = Field(default=None, alias=Finding.FIXING_EFFORT)
     id: str = Field(alias=Finding.ID)
     impact: Optional[str] = Field(default=None, alias=Finding.IMPACT)
@@ -213,3 +547,73 @@ class FindingModel(BaseModel):
 
     class Config:
         arbitrary_types_allowed = True
+
+FINGERPRINT_LINE_WINDOW = 10
+
+# Stable identity of a finding across scans: tool, rule, normalized path, code (or the line window
+# when there is no code) and CWE. Whitespace and path spelling changes don't change it.
+def get_fingerprint(finding: FindingModel) -> str:
+    file_path = posixpath.normpath(finding.file.replace('\\', '/')).lstrip('/') if finding.file else ''
+    code = finding.single_line_code or finding.scanner_report_code
+    location = ' '.join(code.split()) if code else f'line:{finding.actual_line // FINGERPRINT_LINE_WINDOW}'
+    parts = [finding.tool.strip().lower(), (finding.scanner_weakness or finding.title).strip(), file_path, location, str(finding.cwe or '')]
+
+    return hashlib.sha256('\x1f'.join(parts).encode()).hexdigest()
+
+class FindingSummaryModel(BaseModel):
+    object_id: Optional[str] = Field(default=None, alias='_id')
+    actual_line: int = Field(default=0, ge=0, alias=Finding.ACTUAL_LINE)
+    file: str = Field(default='', alias=Finding.FILE)
+    priority: int = Field(default=0, ge=0, le=100, alias=Finding.PRIORITY)
+    repository_id: Optional[str] = Field(default=None, alias=Finding.REPOSITORY_ID)
+    severity: str = Field(default='', alias=Finding.SEVERITY)
+    status: str = Field(default=Finding.STATUS_NEW, alias=Finding.STATUS)
+    title: str = Field(default='', alias=Finding.TITLE)
+
+FINDING_VIEWS = {
+    Finding.VIEW_FULL: FindingModel,
+    Finding.VIEW_SUMMARY: FindingSummaryModel
+}
+
+_list_adapters = {}
+_model_fields = {}
+
+def get_projection(model: type[BaseModel]) -> dict:
+    return {field.alias or name: 1 for name, field in model.model_fields.items()}
+
+def get_list_adapter(model: type[BaseModel]) -> TypeAdapter:
+    if model not in _list_adapters:
+        _list_adapters[model] = TypeAdapter(list[model])
+
+    return _list_adapters[model]
+
+# Builds a model from a document read back from our own collection without validating it,
+# the documents were validated by FindingModel when they were written. A document missing a required
+# field (not found, or projected away) is validated instead, so it fails the same way as READ_VALIDATE.
+def construct_model(model: type[BaseModel], document: dict) -> BaseModel:
+    if isinstance(document, model):
+        return document
+
+    # (field name, alias, required, default, mutable default) computed once instead of on every model_construct call
+    if model not in _model_fields:
+        _model_fields[model] = [(name, field.alias or name, field.is_required(), field.default, isinstance(field.default, (dict, list)))
+                               for name, field in model.model_fields.items()]
+
+    values, fields_set = {}, set()
+
+    for name, alias, required, default, mutable in _model_fields[model]:
+        if alias in document:
+            values[name] = document[alias]
+            fields_set.add(name)
+        elif required:
+            return model.model_validate(document)
+        else:
+            values[name] = copy.copy(default) if mutable else default
+
+    instance = model.__new__(model)
+    object.__setattr__(instance, '__dict__', values)
+    object.__setattr__(instance, '__pydantic_fields_set__', fields_set)
+    object.__setattr__(instance, '__pydantic_extra__', None)
+    object.__setattr__(instance, '__pydantic_private__', None)
+
+    return instance
@@ -0,0 +1,153 @@
+from bson import encode
+from collections import deque
+from pymongo import monitoring
+
+import bisect
+import contextvars
+import logging
+
+logger = logging.getLogger(__name__)
+
+EVENT_QUERY = 'query'
+EVENT_THROTTLE = 'throttle'
+EVENT_ERROR = 'error'
+EVENT_SLOW_QUERY = 'slow_query'
+EVENT_COMMAND = 'command'
+
+# (collection, operation) of the execute_query call running in this context. Motor runs commands in
+# executor threads with a copy of the caller's context, so command events can be attributed to it.
+current_operation = contextvars.ContextVar('current_operation', default=None)
+
+# Upper bounds in milliseconds, the last bucket counts everything slower
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def get_result_documents(result) -> list:
+    if isinstance(result, list):
+        return result
+
+    if isinstance(result, dict) and isinstance(result.get('data'), list):
+        return result['data']
+
+    return None
+
+# One event per command the driver sends to the server: a paginated find_many is a count, a find and
+# a getMore per extra batch, which an execute_query call can't see.
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+
+    def started(self, event):
+        operation = current_operation.get()
+
+        if operation is None:
+            # Commands outside execute_query (iter_many, iter_aggregate) are keyed by their own name
+            target = event.command.get('collection') if event.command_name == 'getMore' else event.command.get(event.command_name)
+            operation = (target if isinstance(target, str) else None, event.command_name)
+
+        self.instrumentation.record({'type': EVENT_COMMAND, 'command': event.command_name, 'collection': operation[0], 'operation': operation[1]})
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+# Receives one structured event per query, throttle and error. The default records nothing and only forwards
+# errors to logging, subclasses keep what they need.
+class Instrumentation:
+    def __init__(self, slow_query_ms: float = None, count_bytes: bool = False, count_commands: bool = False):
+        # Queries slower than slow_query_ms are reported with their explain() output when the operation supports it
+        self.slow_query_ms = slow_query_ms
+        # Encoding results to BSON to measure them has a cost, so byte counts are opt-in
+        self.count_bytes = count_bytes
+        # Command listeners are set per client, so a Database counting commands gets its own pooled client
+        self.command_counter = CommandCounter(self) if count_commands else None
+
+    def get_event_listeners(self) -> list:
+        return [self.command_counter] if self.command_counter else None
+
+    def is_slow(self, duration_ms: float) -> bool:
+        return self.slow_query_ms is not None and duration_ms >= self.slow_query_ms
+
+    def measure(self, result) -> tuple:
+        documents = get_result_documents(result)
+
+        if documents is None:
+            return None, None
+
+        return len(documents), sum(len(encode(document)) for document in documents) if self.count_bytes else None
+
+    def record(self, event: dict):
+        if event['type'] == EVENT_ERROR:
+            logger.error("%s on %s failed: %s", event.get('operation'), event.get('collection'), event.get('detail'), extra={'event': event})
+
+# attempts counts execute_query tries, round_trips the commands sent to the server (only with count_commands)
+class MemoryCollector(Instrumentation):
+    def __init__(self, slow_query_ms: float = None, count_bytes: bool = False, count_commands: bool = False, max_events: int = 100):
+        super().__init__(slow_query_ms, count_bytes, count_commands)
+        self.max_events = max_events
+        self.reset()
+
+    def reset(self):
+        self.operations = {}
+        self.round_trips = 0
+        self.throttles = 0
+        self.retries = 0
+        self.events = deque(maxlen=self.max_events)
+
+    def get_operation(self, operation: str, collection: str) -> dict:
+        key = f'{collection}.{operation}'
+
+        if key not in self.operations:
+            self.operations[key] = {'count': 0, 'errors': 0, 'attempts': 0, 'round_trips': 0, 'documents': 0, 'bytes': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                    'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+
+        return self.operations[key]
+
+    def record(self, event: dict):
+        super().record(event)
+
+        if event['type'] == EVENT_QUERY:
+            stats = self.get_operation(event['operation'], event['collection'])
+            stats['count'] += 1
+            stats['errors'] += 0 if event['ok'] else 1
+            stats['attempts'] += event['attempts']
+            stats['documents'] += event.get('documents') or 0
+            stats['bytes'] += event.get('bytes') or 0
+            stats['total_ms'] += event['duration_ms']
+            stats['max_ms'] = max(stats['max_ms'], event['duration_ms'])
+            stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS, event['duration_ms'])] += 1
+        elif event['type'] == EVENT_COMMAND:
+            self.round_trips += 1
+            self.get_operation(event['operation'], event['collection'])['round_trips'] += 1
+        elif event['type'] == EVENT_THROTTLE:
+            self.throttles += 1
+            self.retries += 1 if event['retried'] else 0
+        else:
+            self.events.append(event)
+
+    # Upper bound of the histogram bucket holding the given percentile, None when it is in the overflow bucket
+    def percentile(self, key: str, percent: float) -> float:
+        stats = self.operations.get(key)
+
+        if not stats or not stats['count']:
+            return None
+
+        threshold = stats['count'] * percent / 100
+        seen = 0
+
+        for index, count in enumerate(stats['histogram']):
+            seen += count
+
+            if seen >= threshold:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else None
+
+        return None
+
+    def snapshot(self) -> dict:
+        return {'operations': {key: {**stats, 'histogram': list(stats['histogram']), 'p50_ms': self.percentile(key, 50), 'p99_ms': self.percentile(key, 99)}
+                               for key, stats in self.operations.items()},
+                'round_trips': self.round_trips,
+                'throttles': self.throttles,
+                'retries': self.retries,
+                'events': list(self.events)}
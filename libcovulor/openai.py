@@ -1,53 +1,298 @@
-from openai import AzureOpenAI, OpenAI
-from pydantic import BaseModel
+from .cache import ResponseCache, get_response_cache_key
+from .retry import RetryPolicy
+from openai import APIConnectionError, APITimeoutError, AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, InternalServerError, OpenAI, RateLimitError
+from pydantic import BaseModel, ValidationError
 
-def send_message(openai_data: dict, prompt_input: str, prompt_system_message: str, response_model: type[BaseModel]) -> dict:
-    print(f"Inside the send_message function")
+import asyncio
+import json
+import logging
+import time
+import weakref
 
-    api_key = openai_data.get("api_key")
-    api_base = openai_data.get("api_base")
-    api_version = openai_data.get("api_version")
-    deployment_name = openai_data.get("deployment_name")
+logger = logging.getLogger(__name__)
 
-    if api_version:
-        print(f"We have an API version, and so we are in Azure")
+DEFAULT_CONCURRENCY = 8
+BATCH_ENDPOINT = '/v1/chat/completions'
+AZURE_BATCH_ENDPOINT = '/chat/completions'
 
-        client = AzureOpenAI(
-            api_key=api_key,
-            azure_endpoint=api_base,
-            api_version=api_version
-        )
-    else:
-        print("We are not in Azure")
+class OpenAIRetryPolicy(RetryPolicy):
+    RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
 
-        client = OpenAI(
-            api_key=api_key,
-            base_url=api_base
-        )
+    def is_retryable(self, error) -> bool:
+        return isinstance(error, self.RETRYABLE_ERRORS)
+
+    def get_retry_after(self, error) -> float:
+        response = getattr(error, 'response', None)
+
+        if response is None:
+            return None
+
+        try:
+            if response.headers.get('retry-after-ms'):
+                return float(response.headers['retry-after-ms']) / 1000
+            if response.headers.get('retry-after'):
+                return float(response.headers['retry-after'])
+        except ValueError:
+            return None
+
+        return None
+
+_clients = {}
+# Async clients and semaphores are bound to the event loop they were created on
+_async_clients = weakref.WeakKeyDictionary()
+_semaphores = weakref.WeakKeyDictionary()
+
+def get_client_key(openai_data: dict) -> tuple:
+    return (openai_data.get("api_key"), openai_data.get("api_base"), openai_data.get("api_version"))
+
+def get_client(openai_data: dict):
+    key = get_client_key(openai_data)
+
+    if key not in _clients:
+        api_key, api_base, api_version = key
+
+        # An API version means we are in Azure
+        if api_version:
+            _clients[key] = AzureOpenAI(api_key=api_key, azure_endpoint=api_base, api_version=api_version)
+        else:
+            _clients[key] = OpenAI(api_key=api_key, base_url=api_base)
+
+    return _clients[key]
+
+def get_async_client(openai_data: dict):
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = get_client_key(openai_data)
+
+    if key not in clients:
+        api_key, api_base, api_version = key
+
+        # Retries are handled by OpenAIRetryPolicy so they count against the same limits
+        if api_version:
+            clients[key] = AsyncAzureOpenAI(api_key=api_key, azure_endpoint=api_base, api_version=api_version, max_retries=0)
+        else:
+            clients[key] = AsyncOpenAI(api_key=api_key, base_url=api_base, max_retries=0)
+
+    return clients[key]
+
+def get_semaphore(openai_data: dict) -> asyncio.Semaphore:
+    semaphores = _semaphores.setdefault(asyncio.get_running_loop(), {})
+    key = (openai_data.get("api_base"), openai_data.get("deployment_name"))
+
+    if key not in semaphores:
+        semaphores[key] = asyncio.Semaphore(openai_data.get("max_concurrency", DEFAULT_CONCURRENCY))
+
+    return semaphores[key]
+
+def get_messages(prompt_input: str, prompt_system_message: str) -> list:
+    return [
+        {"role": "system", "content": prompt_system_message},
+        {"role": "user", "content": prompt_input}
+    ]
+
+def get_error(detail: str) -> dict:
+    return {
+        'status_code': 500,
+        'detail': detail
+    }
+
+def send_message(openai_data: dict, prompt_input: str, prompt_system_message: str, response_model: type[BaseModel]) -> dict:
+    client = get_client(openai_data)
 
     try:
         response = client.beta.chat.completions.parse(
-            model=deployment_name,
+            model=openai_data.get("deployment_name"),
             temperature=0.2,
-            messages=[
-                {"role": "system", "content": prompt_system_message},
-                {"role": "user", "content": prompt_input}
-            ],
+            messages=get_messages(prompt_input, prompt_system_message),
             response_format=response_model
         )
-        json_response = response.choices[0].message.parsed.dict()
+        json_response = response.choices[0].message.parsed.model_dump()
 
-        print(f"This is the response from OpenAI: {json_response}")
+        logger.debug("Response from OpenAI: %s", json_response)
 
         if json_response:
             return json_response
         else:
-            return {
-                'status_code': 500,
-                'detail': 'An error occurred, no response was received from OpenAI.'
-            }
+            return get_error('An error occurred, no response was received from OpenAI.')
     except Exception as e:
-        return {
-            'status_code': 500,
-            'detail': f"An error occurred while trying to receive a response from OpenAI: {e}"
+        return get_error(f"An error occurred while trying to receive a response from OpenAI: {e}")
+
+async def send_message_async(openai_data: dict, prompt_input: str, prompt_system_message: str, response_model: type[BaseModel], retry_policy: RetryPolicy = None, cache: ResponseCache = None) -> dict:
+    cache_key = get_response_cache_key(openai_data.get("deployment_name"), prompt_system_message, prompt_input, response_model) if cache else None
+
+    if cache:
+        # A cache that can't be read is a miss, it must not fail the request
+        try:
+            cached_response = await cache.get(cache_key)
+        except Exception as e:
+            logger.warning("Response cache lookup failed: %s", e)
+            cached_response = None
+
+        if cached_response is not None:
+            return cached_response
+
+    client = get_async_client(openai_data)
+    retry_policy = retry_policy if retry_policy else OpenAIRetryPolicy()
+    attempt, started = 0, time.monotonic()
+
+    while True:
+        try:
+            async with get_semaphore(openai_data):
+                response = await client.beta.chat.completions.parse(
+                    model=openai_data.get("deployment_name"),
+                    temperature=0.2,
+                    messages=get_messages(prompt_input, prompt_system_message),
+                    response_format=response_model
+                )
+
+            json_response = response.choices[0].message.parsed.model_dump()
+
+            logger.debug("Response from OpenAI: %s", json_response)
+
+            if json_response:
+                if cache:
+                    try:
+                        await cache.set(cache_key, json_response)
+                    except Exception as e:
+                        logger.warning("Response cache store failed: %s", e)
+
+                return json_response
+            else:
+                return get_error('An error occurred, no response was received from OpenAI.')
+        except Exception as e:
+            # The semaphore is released while backing off so other requests can use the slot
+            if retry_policy.is_retryable(e) and await retry_policy.backoff(attempt, started, e):
+                attempt += 1
+                continue
+
+            return get_error(f"An error occurred while trying to receive a response from OpenAI: {e}")
+
+async def send_messages(openai_data: dict, batch: list, response_model: type[BaseModel], retry_policy: RetryPolicy = None, cache: ResponseCache = None) -> list:
+    # batch is a list of (prompt_input, prompt_system_message), results keep the batch order
+    # and identical prompts in the same batch are only sent once
+    unique_prompts = list(dict.fromkeys(tuple(prompt) for prompt in batch))
+    responses = await asyncio.gather(*[send_message_async(openai_data, prompt_input, prompt_system_message, response_model, retry_policy, cache)
+                                       for prompt_input, prompt_system_message in unique_prompts])
+    responses_by_prompt = dict(zip(unique_prompts, responses))
+
+    return [responses_by_prompt[tuple(prompt)] for prompt in batch]
+
+def get_batch_request(openai_data: dict, custom_id: str, prompt_input: str, prompt_system_message: str, response_format: dict) -> dict:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": AZURE_BATCH_ENDPOINT if openai_data.get("api_version") else BATCH_ENDPOINT,
+        "body": {
+            "model": openai_data.get("deployment_name"),
+            "temperature": 0.2,
+            "messages": get_messages(prompt_input, prompt_system_message),
+            "response_format": response_format
         }
+    }
+
+# Structured outputs in strict mode need every object closed and every property required, optional
+# fields stay nullable through their anyOf with null. $ref with sibling keys isn't allowed, so it is inlined.
+def get_strict_json_schema(schema, definitions: dict):
+    if isinstance(schema, list):
+        return [get_strict_json_schema(item, definitions) for item in schema]
+
+    if not isinstance(schema, dict):
+        return schema
+
+    # allOf with a single entry is how pydantic wraps a $ref that has a description
+    if len(schema.get('allOf', [])) == 1:
+        schema = {**{key: value for key, value in schema.items() if key != 'allOf'}, **schema['allOf'][0]}
+
+    if '$ref' in schema and len(schema) > 1:
+        reference = definitions[schema['$ref'].split('/')[-1]]
+        schema = {**reference, **{key: value for key, value in schema.items() if key != '$ref'}}
+
+    strict_schema = {}
+
+    for key, value in schema.items():
+        if key in ('properties', '$defs'):
+            strict_schema[key] = {name: get_strict_json_schema(subschema, definitions) for name, subschema in value.items()}
+        elif key != 'default' or value is not None:
+            strict_schema[key] = get_strict_json_schema(value, definitions)
+
+    if strict_schema.get('type') == 'object':
+        strict_schema['additionalProperties'] = False
+        strict_schema['required'] = list(strict_schema.get('properties', {}))
+
+    return strict_schema
+
+def get_response_format(response_model: type[BaseModel]) -> dict:
+    # Same structured output format beta.chat.completions.parse sends for the model
+    schema = response_model.model_json_schema()
+
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "schema": get_strict_json_schema(schema, schema.get('$defs', {})),
+            "name": response_model.__name__,
+            "strict": True
+        }
+    }
+
+def write_batch_request(file, openai_data: dict, custom_id: str, prompt_input: str, prompt_system_message: str, response_format: dict):
+    file.write(json.dumps(get_batch_request(openai_data, custom_id, prompt_input, prompt_system_message, response_format)) + '\n')
+
+def write_batch_requests(path: str, openai_data: dict, requests, response_model: type[BaseModel]) -> int:
+    # requests is an iterable of (custom_id, prompt_input, prompt_system_message), written one line at a time
+    response_format = get_response_format(response_model)
+    count = 0
+
+    with open(path, 'w', encoding='utf-8') as file:
+        for custom_id, prompt_input, prompt_system_message in requests:
+            write_batch_request(file, openai_data, custom_id, prompt_input, prompt_system_message, response_format)
+            count += 1
+
+    return count
+
+def parse_batch_result(line: dict, response_model: type[BaseModel]) -> dict:
+    response = line.get("response") or {}
+
+    if line.get("error") or response.get("status_code") != 200:
+        return get_error(f"The batch request failed: {line.get('error') or response.get('body')}")
+
+    try:
+        message = response["body"]["choices"][0]["message"]
+
+        if message.get("refusal"):
+            return get_error(f"The model refused the request: {message['refusal']}")
+
+        return response_model.model_validate_json(message["content"]).model_dump()
+    except (KeyError, IndexError, TypeError, ValidationError) as e:
+        return get_error(f"An error occurred while parsing the batch result: {e}")
+
+def read_batch_results(path: str, response_model: type[BaseModel]):
+    # Yields (custom_id, parsed response or error dict) without loading the whole result file
+    with open(path, 'r', encoding='utf-8') as file:
+        for raw_line in file:
+            if raw_line.strip():
+                line = json.loads(raw_line)
+                yield line.get("custom_id"), parse_batch_result(line, response_model)
+
+def submit_batch(openai_data: dict, request_path: str, metadata: dict = None) -> str:
+    client = get_client(openai_data)
+
+    with open(request_path, 'rb') as file:
+        batch_file = client.files.create(file=file, purpose="batch")
+
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=AZURE_BATCH_ENDPOINT if openai_data.get("api_version") else BATCH_ENDPOINT,
+        completion_window="24h",
+        metadata=metadata
+    )
+
+    return batch.id
+
+def download_batch_results(openai_data: dict, batch_id: str, result_path: str) -> str:
+    # Returns the batch status, the result file is only written once the batch has completed
+    client = get_client(openai_data)
+    batch = client.batches.retrieve(batch_id)
+
+    if batch.status == "completed" and batch.output_file_id:
+        client.files.content(batch.output_file_id).write_to_file(result_path)
+
+    return batch.status
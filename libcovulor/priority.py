@@ -0,0 +1,110 @@
+from .finding import Finding
+from bson import ObjectId
+from pymongo import UpdateOne
+
+import numpy as np
+
+DEFAULT_WEIGHTS = {
+    Finding.CVSSV3_SCORE: 0.35,
+    Finding.EPSS: 0.25,
+    Finding.SEVERITY: 0.2,
+    Finding.CONFIDENCE: 0.1,
+    Finding.EXPLOITABILITY: 0.1
+}
+
+SEVERITY_SCORES = {
+    Finding.SEVERITY_CRITICAL: 100,
+    Finding.SEVERITY_HIGH: 75,
+    Finding.SEVERITY_MEDIUM: 50,
+    Finding.SEVERITY_LOW: 25,
+    Finding.SEVERITY_INFO: 0
+}
+
+EXPLOITABILITY_SCORES = {
+    'high': 100,
+    'medium': 50,
+    'low': 25,
+    'none': 0
+}
+
+# Points added on top of the weighted score when a finding has the tag, the largest boost wins
+TAG_BOOSTS = {
+    'kev': 15,
+    'exploit': 10,
+    'internet-facing': 10
+}
+
+PRIORITY_FIELDS = (Finding.CVSSV3_SCORE, Finding.EPSS, Finding.CONFIDENCE, Finding.SEVERITY, Finding.EXPLOITABILITY, Finding.TAGS,
+                   Finding.NUMERICAL_SEVERITY, Finding.PRIORITY)
+
+def get_tag_boost(tags, tag_boosts: dict) -> float:
+    return max((tag_boosts.get(str(tag).lower(), 0) for tag in tags or []), default=0)
+
+# Column-oriented view of the scoring inputs, one array entry per finding
+def get_priority_columns(findings: list, tag_boosts: dict = None) -> dict:
+    tag_boosts = TAG_BOOSTS if tag_boosts is None else tag_boosts
+    count = len(findings)
+
+    return {
+        Finding.CVSSV3_SCORE: np.fromiter((finding.get(Finding.CVSSV3_SCORE) or 0 for finding in findings), dtype=np.float64, count=count),
+        Finding.EPSS: np.fromiter((finding.get(Finding.EPSS) or 0 for finding in findings), dtype=np.float64, count=count),
+        Finding.CONFIDENCE: np.fromiter((finding.get(Finding.CONFIDENCE, 50) or 0 for finding in findings), dtype=np.float64, count=count),
+        Finding.SEVERITY: np.fromiter((SEVERITY_SCORES.get(str(finding.get(Finding.SEVERITY, '')).lower(), 0) for finding in findings), dtype=np.float64, count=count),
+        Finding.EXPLOITABILITY: np.fromiter((EXPLOITABILITY_SCORES.get(str(finding.get(Finding.EXPLOITABILITY, '')).lower(), 0) for finding in findings), dtype=np.float64, count=count),
+        Finding.TAGS: np.fromiter((get_tag_boost(finding.get(Finding.TAGS), tag_boosts) for finding in findings), dtype=np.float64, count=count)
+    }
+
+# Every input is scaled to 0-100 before weighting, weights don't need to add up to 1
+def score_priorities(columns: dict, weights: dict = None) -> tuple:
+    weights = weights or DEFAULT_WEIGHTS
+    scaled = {
+        Finding.CVSSV3_SCORE: np.clip(columns[Finding.CVSSV3_SCORE], 0, 10) * 10,
+        Finding.EPSS: np.clip(columns[Finding.EPSS], 0, 1) * 100,
+        Finding.CONFIDENCE: np.clip(columns[Finding.CONFIDENCE], 0, 100),
+        Finding.SEVERITY: columns[Finding.SEVERITY],
+        Finding.EXPLOITABILITY: columns[Finding.EXPLOITABILITY]
+    }
+    total_weight = sum(weights.values()) or 1
+    weighted = sum(scaled[field] * weight for field, weight in weights.items()) / total_weight
+    numerical_severity = np.maximum(scaled[Finding.SEVERITY], scaled[Finding.CVSSV3_SCORE])
+    priority = np.clip(weighted + columns[Finding.TAGS], 0, 100)
+
+    return np.rint(numerical_severity).astype(np.int64), np.rint(priority).astype(np.int64)
+
+# Findings are scored a chunk at a time and only the ones whose values changed are written back
+async def reprioritize(finding: Finding, client_id: str, options: dict = None, weights: dict = None, tag_boosts: dict = None, chunk_size: int = None) -> dict:
+    chunk_size = chunk_size or finding.db.write_batch_size
+    options = {**(options or {}), 'fields': {field: 1 for field in PRIORITY_FIELDS}}
+    summary = {'scored_count': 0, 'matched_count': 0, 'modified_count': 0, 'errors': []}
+
+    async def write(chunk: list):
+        numerical_severities, priorities = score_priorities(get_priority_columns(chunk, tag_boosts), weights)
+        changed = np.flatnonzero((numerical_severities != np.fromiter((document.get(Finding.NUMERICAL_SEVERITY) or 0 for document in chunk), dtype=np.int64, count=len(chunk))) |
+                                 (priorities != np.fromiter((document.get(Finding.PRIORITY) or 0 for document in chunk), dtype=np.int64, count=len(chunk))))
+        summary['scored_count'] += len(chunk)
+
+        if not len(changed):
+            return
+
+        result = await finding.db.bulk_write(finding.db.findings_collection, [
+            UpdateOne({'_id': ObjectId(chunk[index]['_id'])}, {'$set': {Finding.NUMERICAL_SEVERITY: int(numerical_severities[index]), Finding.PRIORITY: int(priorities[index])}})
+            for index in changed
+        ], chunk_size)
+        summary['matched_count'] += result['matched_count']
+        summary['modified_count'] += result['modified_count']
+        summary['errors'].extend(result['errors'])
+
+    chunk = []
+    await finding.flush_writes()
+
+    async for document in finding.db.iter_many(finding.db.findings_collection, client_id, options, chunk_size):
+        chunk.append(document)
+
+        if len(chunk) >= chunk_size:
+            await write(chunk)
+            chunk = []
+
+    if chunk:
+        await write(chunk)
+
+    return summary
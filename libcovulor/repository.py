@@ -23,8 +23,8 @@ class Repository:
     URL = 'url'
     STATUS = 'status'
 
-    def __init__(self, database_username=None, database_password=None, database_host="mongodb", port: int = 27017, database_options=None, db_name="plexicus"):
-        self.db = Database(database_username, database_password, database_host, port, database_options, db_name)
+    def __init__(self, database_username=None, database_password=None, database_host="mongodb", port: int = 27017, database_options=None, db_name="plexicus", **pool_options):
+        self.db = Database(database_username, database_password, database_host, port, database_options, db_name, **pool_options)
         self.db_username = database_username
         self.db_password = database_password
         self.db_host = database_host
@@ -32,6 +32,9 @@ class Repository:
         self.db_options = database_options
         self.db_name = db_name
 
+    async def close(self):
+        await self.db.close()
+
     async def create(self, data: dict):
         existing_document = await self.db.find_one(self.db.repositories_collection, data[Repository.CLIENT_ID], extra_fields={Repository.URL: data["uri"]})
 
@@ -89,7 +92,10 @@ class Repository:
         # return RepositoryModel.parse_obj(dict_repository)
         return dict_repository
 
-    async def update(self, client_id: str, repository_id: str, data: dict):
+    async def update(self, client_id: str, repository_id: str, data: dict, return_document: bool = True):
+        if not return_document:
+            return await self.db.update_one(self.db.repositories_collection, client_id, repository_id, data, return_document=False)
+
         dict_repository = await self.db.update_one(self.db.repositories_collection, client_id, repository_id, data)
         # return RepositoryModel.parse_obj(dict_finding)
         return dict_repository
@@ -0,0 +1,98 @@
+import asyncio
+import random
+import re
+import time
+
+RETRY_AFTER_PATTERN = re.compile(r'RetryAfterMs=(\d+)')
+
+class RetryPolicy:
+    THROTTLE_CODES = (16500, 429)
+    THROTTLE_MESSAGES = ('TooManyRequests', 'Request rate is large')
+
+    def __init__(self, max_attempts: int = 5, deadline: float = 60.0, base_delay: float = 0.5, max_delay: float = 30.0):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_code_and_message(self, error) -> tuple:
+        # Accepts an exception or a single entry from a BulkWriteError's writeErrors list
+        if isinstance(error, dict):
+            return error.get('code'), error.get('errmsg', '')
+
+        return getattr(error, 'code', None), str(error)
+
+    def is_retryable(self, error) -> bool:
+        code, message = self.get_code_and_message(error)
+
+        return code in self.THROTTLE_CODES or any(throttle_message in message for throttle_message in self.THROTTLE_MESSAGES)
+
+    def get_retry_after(self, error) -> float:
+        if error is None:
+            return None
+
+        match = RETRY_AFTER_PATTERN.search(self.get_code_and_message(error)[1])
+
+        return int(match.group(1)) / 1000 if match else None
+
+    def get_delay(self, attempt: int, error=None) -> float:
+        retry_after = self.get_retry_after(error)
+
+        if retry_after is not None:
+            # Small jitter on top of the server hint keeps waiters from waking up together
+            return min(retry_after, self.max_delay) * random.uniform(1, 1.2)
+
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def backoff(self, attempt: int, started: float, error=None, limiter=None) -> bool:
+        if attempt + 1 >= self.max_attempts:
+            return False
+
+        delay = self.get_delay(attempt, error)
+
+        if self.deadline is not None and time.monotonic() + delay - started > self.deadline:
+            return False
+
+        # Throttling is shared by every coroutine on the server, so the whole process slows down
+        if limiter:
+            limiter.pause(delay)
+
+        await asyncio.sleep(delay)
+
+        return True
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1):
+        # Tokens are reserved before sleeping, so concurrent callers queue up behind each other
+        self.refill()
+        self.tokens -= tokens
+
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def pause(self, seconds: float):
+        self.refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+_rate_limiters = {}
+
+def get_rate_limiter(key: str, rate: float, capacity: float = None) -> TokenBucket:
+    limiter = _rate_limiters.get(key)
+
+    if limiter is None:
+        limiter = TokenBucket(rate, capacity)
+        _rate_limiters[key] = limiter
+
+    return limiter
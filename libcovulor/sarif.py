@@ -0,0 +1,369 @@
+from .finding import Finding, FindingModel
+from datetime import datetime, timezone
+
+import asyncio
+import gzip
+import itertools
+import json
+import re
+
+CONFIDENCE_BY_PRECISION = {
+    'very-high': 90,
+    'high': 75,
+    'medium': 50,
+    'low': 25,
+    'very-low': 10
+}
+
+SEVERITY_BY_LEVEL = {
+    'error': Finding.SEVERITY_HIGH,
+    'warning': Finding.SEVERITY_MEDIUM,
+    'note': Finding.SEVERITY_LOW,
+    'none': Finding.SEVERITY_INFO
+}
+
+# Result properties written by our own SARIF exporter that use a different name than the finding field
+RESULT_PROPERTY_ALIASES = {
+    'is_duplicate': Finding.IS_DUPLICATE,
+    'review_requested_by': Finding.REVIEW_REQUESTED_BY,
+    'epss': Finding.EPSS
+}
+
+# Only finding fields are copied from result properties, and never the ones this library manages:
+# a property from another system must not change the workflow status or the duplicate bookkeeping
+RESULT_PROPERTY_FIELDS = {field.alias or name for name, field in FindingModel.model_fields.items()} - {
+    '_id', Finding.STATUS, Finding.PROCESSING_STATUS, Finding.IS_DUPLICATE, Finding.DUPLICATE_ID, Finding.NB_OCCURRENCES
+}
+
+CWE_PATTERN = re.compile(r'CWE-(\d+)', re.IGNORECASE)
+
+# Incremental reader over a JSON text file, only the value being decoded is kept in memory
+class JsonStream:
+    WHITESPACE = ' \t\r\n'
+
+    def __init__(self, file, chunk_size: int = 65536):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+
+    def fill(self) -> bool:
+        chunk = self.file.read(self.chunk_size)
+
+        if not chunk:
+            return False
+
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in self.WHITESPACE:
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if not self.fill():
+                return ''
+
+    def expect(self, char: str):
+        found = self.peek()
+
+        if found != char:
+            raise ValueError(f"Invalid JSON: expected '{char}' but found '{found}'")
+
+        self.position += 1
+
+    def value(self):
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+
+            self.position = end
+
+            return value
+
+    # Yields the keys of an object, the caller must consume each value before resuming
+    def items(self):
+        self.expect('{')
+
+        if self.peek() == '}':
+            self.position += 1
+            return
+
+        while True:
+            key = self.value()
+            self.expect(':')
+
+            yield key
+
+            separator = self.peek()
+            self.position += 1
+
+            if separator == '}':
+                return
+
+            if separator != ',':
+                raise ValueError(f"Invalid JSON: unexpected '{separator}' in object")
+
+    # Yields once per array element, the caller must consume each element before resuming
+    def elements(self):
+        self.expect('[')
+
+        if self.peek() == ']':
+            self.position += 1
+            return
+
+        while True:
+            yield
+
+            separator = self.peek()
+            self.position += 1
+
+            if separator == ']':
+                return
+
+            if separator != ',':
+                raise ValueError(f"Invalid JSON: unexpected '{separator}' in array")
+
+    def skip(self):
+        char = self.peek()
+
+        if char == '{':
+            for _ in self.items():
+                self.skip()
+        elif char == '[':
+            for _ in self.elements():
+                self.skip()
+        else:
+            self.value()
+
+def open_sarif(path: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+
+    return open(path, 'r', encoding='utf-8')
+
+def get_tool(tool: dict) -> tuple:
+    driver = (tool or {}).get('driver', {})
+
+    return driver, {'by_index': driver.get('rules', []), 'by_id': {rule.get('id'): rule for rule in driver.get('rules', [])}}
+
+# Yields the results of the runs from first_run on. A run whose `results` come before its `tool` is skipped,
+# its tool is kept in tools and its index returned so the caller can read the file again from that run.
+def iter_runs(stream: JsonStream, tools: dict, first_run: int):
+    for key in stream.items():
+        if key != 'runs':
+            stream.skip()
+            continue
+
+        for run_index, _ in enumerate(stream.elements()):
+            if run_index < first_run:
+                stream.skip()
+                continue
+
+            driver, rules = tools.get(run_index, ({}, {}))
+            has_tool, deferred = run_index in tools, False
+
+            for run_key in stream.items():
+                if run_key == 'tool' and not has_tool:
+                    driver, rules = get_tool(stream.value())
+                    has_tool = True
+                elif run_key == 'results' and has_tool:
+                    for _ in stream.elements():
+                        yield driver, rules, stream.value()
+                elif run_key == 'results':
+                    deferred = True
+                    stream.skip()
+                else:
+                    stream.skip()
+
+            if deferred:
+                tools[run_index] = driver, rules
+
+                return run_index
+
+    return None
+
+# SARIF writers emit `tool` before `results`, so each result is streamed with its rule metadata in one pass.
+# A run in the other order is read a second time once its tool is known, which needs a seekable source.
+def iter_sarif_results(file, chunk_size: int = 65536):
+    tools, first_run = {}, 0
+
+    while True:
+        first_run = yield from iter_runs(JsonStream(file, chunk_size), tools, first_run)
+
+        if first_run is None:
+            return
+
+        if not file.seekable():
+            raise ValueError(f"SARIF run {first_run} lists its results before its tool and the source can't be read again")
+
+        file.seek(0)
+
+def get_rule(rules: dict, result: dict) -> dict:
+    rule_index = result.get('ruleIndex', result.get('rule', {}).get('index'))
+
+    if rule_index is not None and 0 <= rule_index < len(rules.get('by_index', [])):
+        return rules['by_index'][rule_index]
+
+    rule_id = result.get('ruleId', result.get('rule', {}).get('id'))
+
+    return rules.get('by_id', {}).get(rule_id, {})
+
+def get_severity(result: dict, rule: dict) -> str:
+    security_severity = result.get('properties', {}).get('security-severity', rule.get('properties', {}).get('security-severity'))
+
+    try:
+        score = float(security_severity)
+    except (TypeError, ValueError):
+        score = 0.0
+
+    if score >= 9.0:
+        return Finding.SEVERITY_CRITICAL
+    if score >= 7.0:
+        return Finding.SEVERITY_HIGH
+    if score >= 4.0:
+        return Finding.SEVERITY_MEDIUM
+    if score > 0.0:
+        return Finding.SEVERITY_LOW
+
+    level = result.get('level', rule.get('defaultConfiguration', {}).get('level', 'warning'))
+
+    return SEVERITY_BY_LEVEL.get(level, Finding.SEVERITY_MEDIUM)
+
+def get_cwes(rule: dict) -> list:
+    properties = rule.get('properties', {})
+    candidates = properties.get('cwe', [])
+    candidates = candidates if isinstance(candidates, list) else [candidates]
+    cwes = []
+
+    for candidate in [*candidates, *properties.get('tags', [])]:
+        for match in CWE_PATTERN.findall(str(candidate)):
+            if int(match) not in cwes:
+                cwes.append(int(match))
+
+    return cwes
+
+def sarif_result_to_finding(driver: dict, rules: dict, result: dict) -> dict:
+    rule = get_rule(rules, result)
+    rule_id = result.get('ruleId', rule.get('id'))
+    locations = result.get('locations') or [{}]
+    physical_location = locations[0].get('physicalLocation', {})
+    region = physical_location.get('region', {})
+    context_region = physical_location.get('contextRegion', {})
+    file_path = physical_location.get('artifactLocation', {}).get('uri', '')
+    line = region.get('startLine', 0)
+    code = region.get('snippet', context_region.get('snippet', {})).get('text')
+    cwes = get_cwes(rule)
+    fingerprints = result.get('partialFingerprints') or result.get('fingerprints') or {}
+
+    finding = {
+        Finding.TOOL: driver.get('name', ''),
+        Finding.TITLE: rule.get('shortDescription', {}).get('text') or rule.get('name') or rule_id or '',
+        Finding.DESCRIPTION: result.get('message', {}).get('text', ''),
+        Finding.SCANNER_WEAKNESS: rule_id,
+        Finding.ID: next(iter(fingerprints.values()), None) or f"{rule_id}:{file_path}:{line}",
+        Finding.FILE: file_path,
+        Finding.ACTUAL_LINE: line,
+        Finding.ORIGINAL_LINE: line,
+        Finding.START_COLUMN: region.get('startColumn', 1),
+        Finding.END_COLUMN: region.get('endColumn', 1),
+        Finding.SEVERITY: get_severity(result, rule),
+        Finding.CONFIDENCE: CONFIDENCE_BY_PRECISION.get(result.get('properties', {}).get('precision', rule.get('properties', {}).get('precision')), 50),
+        Finding.TAGS: rule.get('properties', {}).get('tags', []),
+        Finding.DATE: datetime.now(timezone.utc)
+    }
+
+    if cwes:
+        finding[Finding.CWE] = cwes[0]
+        finding[Finding.EXTRA_CWE] = cwes[1:]
+
+    if rule.get('helpUri'):
+        finding[Finding.REFERENCES] = [rule['helpUri']]
+
+    if code is not None:
+        finding[Finding.SCANNER_REPORT_CODE] = code
+        code_lines = code.splitlines()
+        line_offset = line - context_region.get('startLine', line) if 'snippet' not in region else 0
+
+        if 0 <= line_offset < len(code_lines):
+            finding[Finding.SINGLE_LINE_CODE] = code_lines[line_offset].strip()
+
+    for key in (Finding.LANGUAGE, Finding.CATEGORY, Finding.PLATFORM, Finding.SERVICE):
+        if driver.get('properties', {}).get(key) is not None:
+            finding[key] = driver['properties'][key]
+
+    for key, value in result.get('properties', {}).items():
+        key = RESULT_PROPERTY_ALIASES.get(key, key)
+
+        if value is not None and key in RESULT_PROPERTY_FIELDS and key not in finding:
+            finding[key] = value
+
+    return finding
+
+def iter_sarif_findings(file, chunk_size: int = 65536):
+    for driver, rules, result in iter_sarif_results(file, chunk_size):
+        yield sarif_result_to_finding(driver, rules, result)
+
+def read_batch(findings, batch_size: int, overrides: dict) -> list:
+    return [{**sarif_finding, **overrides} for sarif_finding in itertools.islice(findings, batch_size)]
+
+# The next batch is parsed in a worker thread while the previous one is being written, and only
+# those two batches are held in memory no matter how large the report is.
+async def import_sarif(finding: Finding, source, client_id: str, repo_id: str, scan_id: str = None, batch_size: int = None, chunk_size: int = 65536) -> dict:
+    batch_size = batch_size or finding.db.write_batch_size
+    overrides = {Finding.CLIENT_ID: client_id, Finding.REPOSITORY_ID: repo_id}
+
+    if scan_id is not None:
+        overrides[Finding.SCAN_ID] = scan_id
+
+    summary = {'inserted_count': 0, 'errors': []}
+    pending = None
+    offset = 0
+
+    async def write(batch: list, batch_offset: int):
+        result = await finding.create_many(batch)
+        summary['inserted_count'] += sum(1 for finding_model in result['data'] if finding_model is not None)
+        summary['errors'].extend({'index': batch_offset + error['index'], 'detail': error['detail']} for error in result['errors'])
+
+    file = open_sarif(source) if isinstance(source, str) else source
+
+    try:
+        findings = iter_sarif_findings(file, chunk_size)
+
+        while True:
+            batch = await asyncio.to_thread(read_batch, findings, batch_size, overrides)
+
+            if pending:
+                task, pending = pending, None
+                await task
+
+            if not batch:
+                break
+
+            pending = asyncio.ensure_future(write(batch, offset))
+            offset += len(batch)
+    finally:
+        # A parse error must not drop the batch that is already being written
+        if pending:
+            await asyncio.gather(pending, return_exceptions=True)
+
+        if isinstance(source, str):
+            file.close()
+
+    return summary
@@ -13,6 +13,7 @@ setup(
     packages=find_packages(),
     install_requires=[
         'motor==3.5.1',
+        'numpy>=1.24',
         'openai==1.46.0',
         'pymongo==4.6.3',
         'pydantic==2.6.4',
@@ -0,0 +1,19 @@
+import os
+import pytest
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from run import get_parser, main
+
+@pytest.mark.asyncio
+async def test_benchmark_suite_runs_on_memory_backend():
+    report = await main(get_parser().parse_args(['--sizes', '120', '--operations', '5']))
+    results = report['results']['120']
+
+    assert results['create_many']['items'] == 120
+    assert results['iter_many']['items'] == 120
+    assert results['delete_many']['items'] == 120
+    assert results['find_one_concurrent']['round_trips'] == 1
+    assert all(result['p50_ms'] is not None and result['peak_memory_mb'] is not None for result in results.values())
+    assert report['meta']['peak_rss_mb'] > 0
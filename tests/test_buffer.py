@@ -0,0 +1,83 @@
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock
+from bson import ObjectId
+from libcovulor.finding import Finding
+
+@pytest.mark.asyncio
+async def test_write_behind_merges_updates_per_finding():
+    finding = Finding()
+    buffer = finding.enable_write_behind(max_pending=2, flush_interval=None)
+    ids = [ObjectId() for _ in range(3)]
+    bulk_write = AsyncMock(side_effect=lambda collection_name, operations, chunk_size: {'matched_count': len(operations), 'modified_count': len(operations), 'errors': []})
+
+    with patch.object(finding.db, 'bulk_write', bulk_write), patch.object(finding.db, 'close', AsyncMock()):
+        await finding.update('123', str(ids[0]), {'cwe': 79}, return_document=False)
+        await finding.update('123', str(ids[0]), {'status': 'enriched'}, return_document=False)
+        await finding.update('123', str(ids[0]), {'estimated_epss': 0.5}, return_document=False)
+        bulk_write.assert_not_called()
+        await finding.update('123', str(ids[1]), {'status': 'ready'}, return_document=False)
+        await finding.update('123', str(ids[2]), {'status': 'ready'}, return_document=False)
+        await finding.close()
+
+    first, second = [call.args[1] for call in bulk_write.call_args_list]
+    assert [operation._doc for operation in first] == [{'$set': {'cwe': 79, 'status': 'enriched', 'estimated_epss': 0.5}}, {'$set': {'status': 'ready'}}]
+    assert first[0]._filter == {'_id': ids[0], 'client_id': '123'}
+    assert [operation._filter['_id'] for operation in second] == [ids[2]]
+    assert buffer.stats() == {'updates': 5, 'writes': 3, 'flushes': 2, 'retries': 0, 'pending': 0, 'matched_count': 3, 'modified_count': 3, 'errors': 0}
+
+@pytest.mark.asyncio
+async def test_write_behind_flushes_on_interval():
+    finding = Finding()
+    buffer = finding.enable_write_behind(flush_interval=0.01)
+    bulk_write = AsyncMock(return_value={'matched_count': 1, 'modified_count': 1, 'errors': []})
+
+    with patch.object(finding.db, 'bulk_write', bulk_write):
+        await finding.update('123', str(ObjectId()), {'status': 'ready'}, return_document=False)
+        await asyncio.sleep(0.05)
+        await buffer.close()
+
+    bulk_write.assert_called_once()
+    assert len(buffer) == 0
+
+@pytest.mark.asyncio
+async def test_write_behind_requeues_failed_updates():
+    finding = Finding()
+    buffer = finding.enable_write_behind(flush_interval=None)
+    buffer.max_retries = 1
+    ids = [ObjectId() for _ in range(3)]
+    sent = []
+
+    async def bulk_write(collection_name, operations, chunk_size):
+        sent.append([operation._filter['_id'] for operation in operations])
+        # ids[1] fails once, ids[2] always fails
+        failing = [index for index, operation in enumerate(operations) if operation._filter['_id'] == ids[2] or (operation._filter['_id'] == ids[1] and len(sent) == 1)]
+        return {'matched_count': len(operations) - len(failing), 'modified_count': len(operations) - len(failing),
+                'errors': [{'index': index, 'detail': 'connection reset'} for index in failing]}
+
+    with patch.object(finding.db, 'bulk_write', side_effect=bulk_write):
+        for _id in ids:
+            await finding.update('123', str(_id), {'status': 'ready'}, return_document=False)
+        await buffer.flush()
+        await finding.update('123', str(ids[1]), {'cwe': 79}, return_document=False)
+        assert buffer.pending[('123', ids[1])] == {'status': 'ready', 'cwe': 79}
+        await buffer.close()
+
+    assert sent == [ids, [ids[1], ids[2]]]
+    assert buffer.stats()['writes'] == 2 and buffer.stats()['retries'] == 2
+    assert buffer.errors == [{'index': 1, 'detail': 'connection reset'}]
+
+@pytest.mark.asyncio
+async def test_reads_flush_buffered_updates_first():
+    finding = Finding()
+    finding.enable_write_behind(flush_interval=None)
+    calls = []
+    bulk_write = AsyncMock(side_effect=lambda *args: calls.append('bulk_write') or {'matched_count': 1, 'modified_count': 1, 'errors': []})
+    find_one = AsyncMock(side_effect=lambda *args: calls.append('find_one') or {})
+
+    with patch.object(finding.db, 'bulk_write', bulk_write), patch.object(finding.db, 'find_one', find_one):
+        await finding.update('123', str(ObjectId()), {'status': 'ready'}, return_document=False)
+        await finding.find_one('123', str(ObjectId()), read_mode=Finding.READ_RAW)
+        await finding.find_one('123', str(ObjectId()), read_mode=Finding.READ_RAW)
+
+    assert calls == ['bulk_write', 'find_one', 'find_one']
@@ -0,0 +1,127 @@
+import pytest
+import time
+from unittest.mock import patch, AsyncMock
+from pydantic import BaseModel
+from libcovulor.cache import ResponseCache, SQLiteResponseCache, TTLCache, get_response_cache_key
+from libcovulor.database import Database
+
+class Answer(BaseModel):
+    text: str
+
+class OtherAnswer(BaseModel):
+    value: int
+
+def test_ttl_cache_expiry_and_lru():
+    cache = TTLCache(max_entries=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+
+    with patch('time.monotonic', return_value=time.monotonic() + 11):
+        assert cache.get('a') is None
+
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 1
+
+def test_response_cache_key_covers_schema():
+    key = get_response_cache_key('gpt', 'system', 'prompt', Answer)
+
+    assert key == get_response_cache_key('gpt', 'system', 'prompt', Answer)
+    assert key != get_response_cache_key('gpt', 'system', 'prompt', OtherAnswer)
+    assert key != get_response_cache_key('gpt-mini', 'system', 'prompt', Answer)
+
+@pytest.mark.asyncio
+async def test_sqlite_response_cache(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / 'responses.db'), ttl=60, max_entries=2, eviction_interval=1)
+
+    assert await cache.get('missing') is None
+
+    await cache.set('a', {'text': 'a'})
+    await cache.set('b', {'text': 'b'})
+    assert await cache.get('a') == {'text': 'a'}
+    await cache.set('c', {'text': 'c'})
+
+    assert await cache.get('b') is None
+    assert await cache.get('c') == {'text': 'c'}
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['evictions'] == 1
+
+    with patch('time.time', return_value=time.time() + 61):
+        assert await cache.get('c') is None
+
+    cache.close()
+
+@pytest.mark.asyncio
+async def test_sqlite_response_cache_batches_touches(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / 'responses.db'), touch_batch_size=2)
+    await cache.set('a', {'text': 'a'})
+    await cache.set('b', {'text': 'b'})
+
+    def get_accessed_at():
+        return cache.executor.submit(lambda: cache.connection.execute("SELECT accessed_at FROM responses WHERE key = 'a'").fetchone()[0]).result()
+
+    stored = get_accessed_at()
+
+    with patch('time.time', return_value=time.time() + 1):
+        await cache.get('a')
+        assert get_accessed_at() == stored
+        await cache.get('b')
+
+    assert len(cache.touched) == 0
+    assert get_accessed_at() > stored
+
+    cache.close()
+
+@pytest.mark.asyncio
+async def test_reference_cache_batches_missing_keys():
+    database = Database()
+    cache = database.get_reference_cache(database.cwes_collection, key_field='cwe_id')
+    find_in = AsyncMock(side_effect=lambda collection_name, field, values, filters: [{'cwe_id': value, 'name': f'CWE-{value}'} for value in values if value != 999])
+
+    with patch.object(database, 'find_in', find_in):
+        first = await cache.get_many([79, 89, 79, 999])
+        second = await cache.get_many([89, 999, 22])
+        cache.invalidate([89])
+        third = await cache.get(89)
+
+    assert database.get_reference_cache(database.cwes_collection) is cache
+    assert first == {79: {'cwe_id': 79, 'name': 'CWE-79'}, 89: {'cwe_id': 89, 'name': 'CWE-89'}, 999: None}
+    assert second[999] is None and second[22]['name'] == 'CWE-22'
+    assert third['name'] == 'CWE-89'
+    assert [call.args[2] for call in find_in.call_args_list] == [[79, 89, 999], [22], [89]]
+    assert cache.stats()['queries'] == 3
+
+def test_reference_cache_requires_unknown_key_field():
+    database = Database()
+
+    with pytest.raises(ValueError):
+        database.get_reference_cache(database.owasps_collection)
+
+    assert database.get_reference_cache(database.epss_collection).key_field == 'cve'
+
+@pytest.mark.asyncio
+async def test_reference_cache_does_not_cache_failed_queries():
+    database = Database()
+    cache = database.get_reference_cache(database.epss_collection)
+    find_in = AsyncMock(side_effect=[None, [{'cve': 'CVE-2024-1', 'epss': 0.5}]])
+
+    with patch.object(database, 'find_in', find_in):
+        first = await cache.get('CVE-2024-1')
+        second = await cache.get('CVE-2024-1')
+
+    assert first is None
+    assert second['epss'] == 0.5
+    assert find_in.call_count == 2
+
+def test_response_cache_backend_must_implement_get_and_set():
+    class GetOnlyCache(ResponseCache):
+        async def get(self, key: str):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnlyCache()
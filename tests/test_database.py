@@ -0,0 +1,436 @@
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import AutoReconnect, BulkWriteError, OperationFailure
+from pymongo.results import InsertManyResult
+from libcovulor.database import Database, close_motor_clients, get_motor_client
+from libcovulor.finding import Finding
+from libcovulor.repository import Repository
+
+@pytest.fixture
+def mock_motor():
+    with patch('motor.motor_asyncio.AsyncIOMotorClient', side_effect=lambda *args, **kwargs: MagicMock()) as mock_client:
+        yield mock_client
+    close_motor_clients()
+
+@pytest.mark.asyncio
+async def test_shared_client_per_uri(mock_motor):
+    first = get_motor_client("mongodb://mongodb:27017", maxPoolSize=10)
+    second = get_motor_client("mongodb://mongodb:27017", maxPoolSize=10)
+
+    assert first is second
+    mock_motor.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_database_finding_repository_share_pool(mock_motor):
+    database = Database()
+    finding = Finding()
+    repository = Repository()
+
+    database.get_collection(database.findings_collection)
+    finding.db.get_collection(finding.db.findings_collection)
+    repository.db.get_collection(repository.db.repositories_collection)
+
+    mock_motor.assert_called_once()
+    assert mock_motor.call_args.kwargs['maxPoolSize'] == 100
+    assert 'maxIdleTimeMS' not in mock_motor.call_args.kwargs
+
+@pytest.mark.asyncio
+async def test_close_releases_pool(mock_motor):
+    database = Database(max_pool_size=5, min_pool_size=1, max_idle_time_ms=30000)
+    other = Database(max_pool_size=5, min_pool_size=1, max_idle_time_ms=30000)
+    database.get_collection(database.findings_collection)
+    other.get_collection(other.findings_collection)
+    client = get_motor_client(database.mongo.database_uri, **database.mongo.client_options)
+
+    # Other instances still use the pool, closing one only releases its reference
+    await database.close()
+    await database.close()
+    client.close.assert_not_called()
+
+    await other.close()
+
+    client.close.assert_called_once()
+    assert get_motor_client(database.mongo.database_uri, **database.mongo.client_options) is not client
+
+@pytest.mark.asyncio
+async def test_close_motor_clients_only_closes_running_loop(mock_motor):
+    database = Database()
+    database.get_collection(database.findings_collection)
+    client = get_motor_client(database.mongo.database_uri, **database.mongo.client_options)
+    other_loop = asyncio.new_event_loop()
+
+    async def get_other_client():
+        return get_motor_client(database.mongo.database_uri, **database.mongo.client_options)
+
+    other_client = await asyncio.to_thread(other_loop.run_until_complete, get_other_client())
+    close_motor_clients()
+
+    client.close.assert_called_once()
+    other_client.close.assert_not_called()
+    # Releasing after the process level shutdown doesn't close the next pool
+    await database.close()
+    assert not get_motor_client(database.mongo.database_uri, **database.mongo.client_options).close.called
+    other_loop.close()
+
+@pytest.mark.asyncio
+async def test_insert_many_retries_only_throttled_documents():
+    database = Database()
+    collection = MagicMock()
+    sent_chunks = []
+
+    async def insert_many(chunk, ordered):
+        sent_chunks.append([document['n'] for document in chunk])
+        for document in chunk:
+            document.setdefault('_id', f"id{document['n']}")
+        if len(sent_chunks) == 1:
+            raise BulkWriteError({'writeErrors': [{'index': 1, 'code': 16500, 'errmsg': 'TooManyRequests'},
+                                                  {'index': 2, 'code': 11000, 'errmsg': 'duplicate key'}],
+                                  'nInserted': 1})
+        return InsertManyResult([document['_id'] for document in chunk], True)
+
+    collection.insert_many = insert_many
+    documents = [{'n': n} for n in range(4)]
+
+    with patch.object(database, 'get_collection', return_value=collection), patch('asyncio.sleep'):
+        result = await database.insert_many('Finding', documents, chunk_size=3)
+
+    assert sent_chunks == [[0, 1, 2], [1], [3]]
+    assert result['inserted_ids'] == ['id0', 'id1', None, 'id3']
+    assert result['errors'] == [{'index': 2, 'detail': 'duplicate key'}]
+
+@pytest.mark.asyncio
+async def test_insert_many_failed_chunk_keeps_written_chunks():
+    database = Database()
+    collection = MagicMock()
+
+    async def insert_many(chunk, ordered):
+        if chunk[0]['n'] == 2:
+            raise AutoReconnect('connection reset')
+        for document in chunk:
+            document['_id'] = f"id{document['n']}"
+        return InsertManyResult([document['_id'] for document in chunk], True)
+
+    collection.insert_many = insert_many
+    documents = [{'n': n} for n in range(5)]
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        result = await database.insert_many('Finding', documents, chunk_size=2)
+
+    assert result['inserted_ids'] == ['id0', 'id1', None, None, 'id4']
+    assert [error['index'] for error in result['errors']] == [2, 3]
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def skip(self, skip):
+        self.documents = self.documents[skip:]
+        return self
+
+    def batch_size(self, *args):
+        return self
+
+    def limit(self, limit):
+        self.documents = self.documents[:limit]
+        return self
+
+    async def __aiter__(self):
+        for document in self.documents:
+            yield dict(document)
+
+def test_keyset_query_crosses_null_sort_values():
+    database = Database()
+    _id = ObjectId()
+
+    ascending = database.get_keyset_query({'client_id': '123'}, {'id': _id, 'value': None}, 'cwe', 1)
+    descending = database.get_keyset_query({'client_id': '123'}, {'id': _id, 'value': 79}, 'cwe', -1)
+
+    assert ascending == {'$and': [{'client_id': '123'}, {'$or': [{'cwe': None, '_id': {'$gt': _id}}, {'cwe': {'$ne': None}}]}]}
+    assert descending == {'$and': [{'client_id': '123'}, {'$or': [{'cwe': {'$lt': 79}}, {'cwe': 79, '_id': {'$lt': _id}}, {'cwe': None}]}]}
+
+@pytest.mark.asyncio
+async def test_find_many_rejects_invalid_cursor():
+    database = Database()
+
+    with patch.object(database, 'get_collection') as get_collection:
+        for cursor in ('!!notbase64', 'bm90IGpzb24=', 'WzFd'):
+            with pytest.raises(ValueError, match='Invalid pagination cursor'):
+                await database.find_many('Finding', '123', {'pagination': {'mode': 'keyset', 'cursor': cursor}})
+
+    get_collection.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_find_many_keyset_pagination():
+    database = Database()
+    collection = MagicMock()
+    collection.name = 'Finding'
+    documents = [{'_id': ObjectId(), 'severity': 'high'} for _ in range(3)]
+    collection.find.side_effect = lambda query, fields: FakeCursor(documents)
+    collection.count_documents = AsyncMock(return_value=3)
+    options = {'sort': {'field': 'severity', 'order': 1},
+               'pagination': {'mode': 'keyset', 'page_size': 2, 'count': 'cached'}}
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        first_page = await database.find_many('Finding', '123', options)
+        cursor = first_page['meta']['pagination']['nextCursor']
+        options['pagination']['cursor'] = cursor
+        await database.find_many('Finding', '123', options)
+
+    assert [document['_id'] for document in first_page['data']] == [str(document['_id']) for document in documents[:2]]
+    assert first_page['meta']['pagination']['total'] == 3
+    collection.count_documents.assert_called_once()
+    assert collection.find.call_args.args[0] == {'$and': [{'client_id': '123'},
+                                                          {'$or': [{'severity': {'$gt': 'high'}},
+                                                                   {'severity': 'high', '_id': {'$gt': documents[1]['_id']}}]}]}
+
+@pytest.mark.asyncio
+async def test_find_many_without_count():
+    database = Database()
+    collection = MagicMock()
+    collection.find.side_effect = lambda query, fields: FakeCursor([{'_id': ObjectId()}])
+    collection.count_documents = AsyncMock(return_value=1)
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        result = await database.find_many('Finding', '123', {'pagination': {'page': 3, 'count': False}})
+
+    collection.count_documents.assert_not_called()
+    assert result['meta']['pagination']['total'] is None
+
+@pytest.mark.asyncio
+async def test_iter_many_streams_all_documents_and_resumes_after_throttling():
+    database = Database()
+    collection = MagicMock()
+    documents = [{'_id': ObjectId()} for _ in range(25)]
+    queries = []
+
+    class ThrottledCursor(FakeCursor):
+        async def __aiter__(self):
+            for document in self.documents[:2]:
+                yield dict(document)
+            raise OperationFailure('TooManyRequests', 16500)
+
+    def find(query, fields):
+        queries.append(query)
+        if len(queries) == 1:
+            return ThrottledCursor(documents)
+        return FakeCursor(documents[2:])
+
+    collection.find.side_effect = find
+
+    with patch.object(database, 'get_collection', return_value=collection), patch('asyncio.sleep'):
+        results = [document async for document in database.iter_many('Finding', '123', batch_size=5)]
+
+    assert [document['_id'] for document in results] == [str(document['_id']) for document in documents]
+    assert queries[1] == {'$and': [{'client_id': '123'}, {'_id': {'$gt': documents[1]['_id']}}]}
+
+@pytest.mark.asyncio
+async def test_iter_many_raises_when_the_stream_breaks():
+    database = Database()
+    collection = MagicMock()
+    documents = [{'_id': ObjectId()} for _ in range(5)]
+
+    class BrokenCursor(FakeCursor):
+        async def __aiter__(self):
+            yield dict(self.documents[0])
+            raise AutoReconnect('connection reset')
+
+    collection.find.side_effect = lambda query, fields: BrokenCursor(documents)
+    results = []
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        with pytest.raises(AutoReconnect):
+            async for document in database.iter_many('Finding', '123'):
+                results.append(document)
+
+    assert len(results) == 1
+
+@pytest.mark.asyncio
+async def test_iter_aggregate_retries_throttling_only_before_the_first_document():
+    database = Database()
+    collection = MagicMock()
+    cursors = []
+
+    class AggregateCursor(FakeCursor):
+        def __init__(self, documents, fail_after):
+            super().__init__(documents)
+            self.fail_after = fail_after
+
+        async def __aiter__(self):
+            for document in self.documents[:self.fail_after]:
+                yield dict(document)
+            raise OperationFailure('TooManyRequests', 16500)
+
+    def aggregate(pipeline):
+        cursors.append(AggregateCursor([{'n': 0}, {'n': 1}], 0 if not cursors else 1))
+        return cursors[-1]
+
+    collection.aggregate.side_effect = aggregate
+    results = []
+
+    with patch.object(database, 'get_collection', return_value=collection), patch('asyncio.sleep'):
+        with pytest.raises(OperationFailure):
+            async for document in database.iter_aggregate('EPSS', [{'$match': {}}]):
+                results.append(document)
+
+    assert len(cursors) == 2
+    assert results == [{'n': 0}]
+
+@pytest.mark.asyncio
+async def test_update_one_is_a_single_round_trip():
+    database = Database()
+    collection = MagicMock()
+    _id = ObjectId()
+    collection.find_one_and_update = AsyncMock(return_value={'_id': _id, 'status': 'ready'})
+    collection.update_one = AsyncMock(return_value=MagicMock(matched_count=1))
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        document = await database.update_one('Finding', '123', str(_id), {'status': 'ready'}, projection={'status': 1})
+        matched = await database.update_one('Finding', '123', str(_id), {'status': 'ready'}, return_document=False)
+
+    assert document == {'_id': str(_id), 'status': 'ready'}
+    assert matched is True
+    assert collection.find_one_and_update.call_args.kwargs['return_document'] == ReturnDocument.AFTER
+    assert collection.find_one_and_update.call_args.kwargs['projection'] == {'status': 1}
+    collection.find_one.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_delete_many_by_server_side_ranges():
+    database = Database()
+    collection = MagicMock()
+    ids = [ObjectId() for _ in range(4)]
+    collection.count_documents = AsyncMock(return_value=2500)
+    pipelines = []
+    deleted_filters = []
+    progress = []
+
+    def aggregate(pipeline):
+        pipelines.append(pipeline)
+        buckets = [{'_id': {'min': ids[0], 'max': ids[1]}}, {'_id': {'min': ids[2], 'max': ids[3]}}]
+        if len(pipelines) > 1:
+            buckets = [{'_id': {'min': ids[0], 'max': ids[0]}}, {'_id': {'min': ids[1], 'max': ids[1]}}]
+        return FakeCursor(buckets)
+
+    async def delete_many(range_filter):
+        deleted_filters.append(range_filter)
+        if len(deleted_filters) == 1:
+            raise OperationFailure('Request rate is large', 16500)
+        return MagicMock(deleted_count=100)
+
+    collection.aggregate.side_effect = aggregate
+    collection.delete_many = delete_many
+
+    with patch.object(database, 'get_collection', return_value=collection), patch('asyncio.sleep'):
+        result = await database.delete_many('Finding', '123', chunk_size=1000, progress=lambda deleted, total: progress.append((deleted, total)))
+
+    assert result == {'deleted_count': 300, 'errors': []}
+    assert pipelines[0][1] == {'$bucketAuto': {'groupBy': '$_id', 'buckets': 3}}
+    assert pipelines[1][1] == {'$bucketAuto': {'groupBy': '$_id', 'buckets': 2}}
+    assert deleted_filters[0] == {'$and': [{'client_id': '123'}, {'_id': {'$gte': ids[0], '$lte': ids[1]}}]}
+    assert len(deleted_filters) == 4
+    assert progress[-1] == (300, 2500)
+    collection.find.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_delete_many_returns_failed_ranges():
+    database = Database()
+    collection = MagicMock()
+    ids = [ObjectId() for _ in range(4)]
+    collection.count_documents = AsyncMock(return_value=2000)
+    collection.aggregate.return_value = FakeCursor([{'_id': {'min': ids[0], 'max': ids[1]}}, {'_id': {'min': ids[2], 'max': ids[3]}}])
+
+    async def delete_many(range_filter):
+        if range_filter['$and'][1]['_id']['$gte'] == ids[2]:
+            raise OperationFailure('Command failed', 2)
+        return MagicMock(deleted_count=1000)
+
+    collection.delete_many = delete_many
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        result = await database.delete_many('Finding', '123', chunk_size=1000)
+
+    assert result == {'deleted_count': 1000, 'errors': [{'range': (ids[2], ids[3]), 'detail': 'Command failed'}]}
+
+    collection.count_documents = AsyncMock(side_effect=AutoReconnect('down'))
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        result = await database.delete_many('Finding', '123')
+
+    assert result == {'deleted_count': 0, 'errors': [{'range': None, 'detail': 'Delete failed'}]}
+
+def test_count_caches_are_shared_per_database():
+    database, other = Database(db_name='shared'), Database(db_name='shared')
+    database.count_cache.set(('Finding', '{}'), 5)
+    database.facet_cache.set(('Finding', '{}', ('severity',)), {'total': 5})
+
+    assert Database(db_name='other').count_cache.get(('Finding', '{}')) is None
+    assert other.count_cache.get(('Finding', '{}')) == 5
+
+    # A write through another instance drops the counts cached by the first one
+    other.invalidate_caches('Finding')
+
+    assert len(database.count_cache) == 0 and len(database.facet_cache) == 0
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_creates_declared_indexes():
+    database = Database()
+    collection = MagicMock()
+    collection.create_indexes = AsyncMock(side_effect=lambda indexes: [index.document['name'] for index in indexes])
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        created = await database.ensure_indexes([database.findings_collection, database.llm_cache_collection])
+
+    assert created == {'Finding': ['client_id_repo_id_status_severity', 'client_id_scan_id', 'fingerprint', 'cve'],
+                       'LLMCache': ['expires_at', 'accessed_at']}
+    assert collection.create_indexes.call_args.args[0][0].document['expireAfterSeconds'] == 0
+    # Only findings with a cve string are indexed, a sparse index would still hold the explicit nulls
+    assert database.indexes['Finding'][3].document['partialFilterExpression'] == {'cve': {'$type': 'string'}}
+
+@pytest.mark.asyncio
+async def test_check_indexes_reports_missing_and_unused():
+    database = Database()
+    collection = MagicMock()
+    collection.aggregate.return_value.to_list = AsyncMock(return_value=[{'name': '_id_', 'accesses': {'ops': 0}},
+                                                                        {'name': 'client_id_url', 'accesses': {'ops': 0}},
+                                                                        {'name': 'url', 'accesses': {'ops': 12}}])
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        report = await database.check_indexes([database.repositories_collection, database.scans_collection])
+
+    assert collection.aggregate.call_args.args[0] == [{'$indexStats': {}}]
+    assert report['Repository'] == {'missing': [], 'unused': ['client_id_url']}
+    assert report['Scan'] == {'missing': ['client_id_repo_id'], 'unused': ['client_id_url']}
+
+@pytest.mark.asyncio
+async def test_find_one_calls_in_the_same_tick_are_coalesced():
+    database = Database()
+    collection = MagicMock()
+    ids = [ObjectId() for _ in range(3)]
+    collection.find.side_effect = lambda query, fields: FakeCursor([{'_id': ids[0], 'name': 'a'}, {'_id': ids[1], 'name': 'b'}])
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        results = await asyncio.gather(database.find_one('Repository', '123', str(ids[0])),
+                                       database.find_one('Repository', '123', str(ids[1])),
+                                       database.find_one('Repository', '123', str(ids[0])),
+                                       database.find_one('Repository', '123', str(ids[2])))
+
+    collection.find.assert_called_once()
+    assert collection.find.call_args.args[0] == {'client_id': '123', '_id': {'$in': [ids[0], ids[1], ids[2]]}}
+    assert results == [{'_id': str(ids[0]), 'name': 'a'}, {'_id': str(ids[1]), 'name': 'b'}, {'_id': str(ids[0]), 'name': 'a'}, {}]
+    assert results[0] is not results[2]
+    assert database.pending_reads == {}
+
+@pytest.mark.asyncio
+async def test_find_in_tells_failure_from_no_matches():
+    database = Database()
+    collection = MagicMock()
+    collection.find.side_effect = [FakeCursor([]), AutoReconnect('connection reset')]
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        assert await database.find_in('EPSS', 'cve', ['CVE-2024-1']) == []
+        assert await database.find_in('EPSS', 'cve', ['CVE-2024-1']) is None
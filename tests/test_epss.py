@@ -0,0 +1,62 @@
+import gzip
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from pymongo.errors import OperationFailure
+from libcovulor.database import Database
+from libcovulor.epss import iter_epss_scores, load_epss, refresh_finding_epss
+
+FEED = """#model_version:v2023.03.01,score_date:2024-05-01T00:00:00+0000
+cve,epss,percentile
+CVE-2021-0001,0.00045,0.1
+CVE-2021-0002,0.97,0.99
+CVE-2021-0003,0.5,0.8
+"""
+
+def test_iter_epss_scores_reads_metadata(tmp_path):
+    path = tmp_path / 'epss.csv.gz'
+    with gzip.open(path, 'wt', encoding='utf-8') as file:
+        file.write(FEED)
+
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as file:
+        scores = list(iter_epss_scores(file))
+
+    assert len(scores) == 3
+    assert scores[0] == {'cve': 'CVE-2021-0001', 'epss': 0.00045, 'percentile': 0.1,
+                         'model_version': 'v2023.03.01', 'score_date': '2024-05-01T00:00:00+0000'}
+
+@pytest.mark.asyncio
+async def test_load_epss_upserts_only_changed_scores(tmp_path):
+    path = tmp_path / 'epss.csv.gz'
+    with gzip.open(path, 'wt', encoding='utf-8') as file:
+        file.write(FEED)
+
+    database = Database()
+    stored = [{'cve': 'CVE-2021-0001', 'epss': 0.00045, 'percentile': 0.1}, {'cve': 'CVE-2021-0002', 'epss': 0.9, 'percentile': 0.99}]
+    bulk_write = AsyncMock(return_value={'upserted_count': 1, 'modified_count': 1, 'errors': []})
+    collection = MagicMock()
+    collection.aggregate.return_value.to_list = AsyncMock(return_value=[])
+
+    with patch.object(database, 'find_in', AsyncMock(return_value=stored)), \
+         patch.object(database, 'bulk_write', bulk_write), patch.object(database, 'get_collection', return_value=collection):
+        result = await load_epss(database, str(path))
+
+    operations = bulk_write.call_args.args[1]
+    pipeline = collection.aggregate.call_args.args[0]
+    assert result == {'read_count': 3, 'unchanged_count': 1, 'upserted_count': 1, 'modified_count': 1, 'errors': []}
+    assert [operation._filter for operation in operations] == [{'cve': 'CVE-2021-0002'}, {'cve': 'CVE-2021-0003'}]
+    assert all(operation._upsert for operation in operations)
+    assert pipeline[0] == {'$match': {'cve': {'$in': ['CVE-2021-0002', 'CVE-2021-0003']}}}
+    assert pipeline[-1]['$merge']['into'] == 'Finding'
+
+@pytest.mark.asyncio
+async def test_refresh_finding_epss_reports_errors_and_invalidates_caches():
+    database = Database()
+    database.count_cache.set((database.findings_collection, '123', '{}'), 5)
+    collection = MagicMock()
+    collection.aggregate.return_value.to_list = AsyncMock(side_effect=OperationFailure('$merge failed'))
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        result = await refresh_finding_epss(database, ['CVE-2021-0001'])
+
+    assert result == {'errors': [{'detail': 'Finding EPSS refresh failed', 'cves': ['CVE-2021-0001']}]}
+    assert len(database.count_cache) == 0
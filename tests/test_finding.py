@@ -1,6 +1,10 @@
 import pytest
-from unittest.mock import patch, MagicMock
-from libcovulor.finding import Finding, FindingModel
+from unittest.mock import patch, AsyncMock, MagicMock
+from datetime import datetime
+from bson import ObjectId
+from pydantic import ValidationError
+from pymongo.errors import AutoReconnect
+from libcovulor.finding import Finding, FindingModel, FindingSummaryModel, get_fingerprint
 
 findingInstance = Finding()
 
@@ -186,3 +190,241 @@ async def test_update_finding(mock_db):
 
         assert result == finding
         mock_update_one.assert_called_once_with(mock_db, client_id, finding_id, finding)
+
+@pytest.mark.asyncio
+async def test_create_many_findings():
+    data = [
+        {"tool": "test", "title": "first", "repo_id": "", "line": 1, "client_id": "123", "date": "2000-01-01",
+         "description": "", "file_path": "a.py", "finding_id": "1", "original_line": 1, "severity": "high"},
+        {"tool": "test", "title": "invalid", "client_id": "123"},
+    ]
+
+    with patch.object(findingInstance.db, 'insert_many', return_value={'inserted_ids': ['507f1f77bcf86cd799439011'], 'errors': []}) as mock_insert_many, \
+         patch.object(findingInstance.db, 'find_in', return_value=[]):
+        result = await findingInstance.create_many(data)
+
+        assert result['data'][0].object_id == '507f1f77bcf86cd799439011'
+        assert result['data'][1] is None
+        assert [error['index'] for error in result['errors']] == [1]
+        assert len(mock_insert_many.call_args.args[1]) == 1
+
+@pytest.mark.asyncio
+async def test_find_many_findings_read_modes():
+    document = {"_id": "507f1f77bcf86cd799439011", "tool": "test", "title": "test title", "repo_id": "", "line": 1,
+                "client_id": "123", "date": datetime(2000, 1, 1), "description": "", "file_path": "", "finding_id": "",
+                "original_line": 1, "severity": "high", "tags": ["a"]}
+
+    with patch.object(findingInstance.db, 'find_many', side_effect=lambda *args: {"data": [dict(document)]}):
+        validated = await findingInstance.find_many("123", read_mode=Finding.READ_VALIDATE)
+        trusted = await findingInstance.find_many("123", read_mode=Finding.READ_TRUSTED)
+        raw = await findingInstance.find_many("123", read_mode=Finding.READ_RAW)
+
+    assert trusted["data"][0] == validated["data"][0]
+    assert trusted["data"][0].model_dump(by_alias=True) == validated["data"][0].model_dump(by_alias=True)
+    assert trusted["data"][0].object_id == "507f1f77bcf86cd799439011"
+    assert raw["data"][0] == document
+
+@pytest.mark.asyncio
+async def test_find_one_trusted_fails_like_validate_on_missing_document():
+    with patch.object(findingInstance.db, 'find_one', return_value={}):
+        for read_mode in (Finding.READ_VALIDATE, Finding.READ_TRUSTED):
+            with pytest.raises(ValidationError):
+                await findingInstance.find_one("123", "507f1f77bcf86cd799439011", read_mode=read_mode)
+
+    # A projection without the required fields is validated too instead of building a partial model
+    with patch.object(findingInstance.db, 'find_many', return_value={"data": [{"_id": "507f1f77bcf86cd799439011", "severity": "high"}]}):
+        with pytest.raises(ValidationError):
+            await findingInstance.find_many("123", {"fields": {"severity": 1}}, read_mode=Finding.READ_TRUSTED)
+
+@pytest.mark.asyncio
+async def test_find_many_summary_view():
+    document = {"_id": "507f1f77bcf86cd799439011", "title": "test title", "severity": "high", "status": "new",
+                "file_path": "a.py", "line": 3, "prioritization_value": 10, "repo_id": "repo"}
+
+    with patch.object(findingInstance.db, 'find_many', return_value={"data": [document]}) as mock_find_many:
+        result = await findingInstance.find_many("123", {"filters": {"status": "new"}}, view=Finding.VIEW_SUMMARY)
+
+    options = mock_find_many.call_args.args[2]
+    assert options["filters"] == {"status": "new"}
+    assert set(options["fields"]) == {"_id", "title", "severity", "status", "file_path", "line", "prioritization_value", "repo_id"}
+    assert isinstance(result["data"][0], FindingSummaryModel)
+    assert result["data"][0].actual_line == 3
+
+def test_fingerprint_ignores_path_and_whitespace_noise():
+    data = {"tool": "Opengrep", "title": "t", "repo_id": "", "line": 12, "client_id": "123", "date": "2000-01-01", "description": "",
+            "file_path": "./src/app.py", "finding_id": "", "original_line": 12, "severity": "high", "scanner_weakness": "rule", "cwe": 89,
+            "single_line_code": "query = 'SELECT ' +  id"}
+    fingerprint = get_fingerprint(FindingModel.model_validate(data))
+
+    assert fingerprint == get_fingerprint(FindingModel.model_validate({**data, "tool": "opengrep", "file_path": "src\\app.py", "line": 40,
+                                                                       "single_line_code": "  query = 'SELECT ' + id"}))
+    assert fingerprint != get_fingerprint(FindingModel.model_validate({**data, "cwe": 79}))
+    assert fingerprint != get_fingerprint(FindingModel.model_validate({**data, "file_path": ".github/app.py"}))
+
+@pytest.mark.asyncio
+async def test_create_many_marks_duplicates_in_one_pass():
+    base = {"tool": "test", "title": "t", "repo_id": "repo", "line": 1, "client_id": "123", "date": "2000-01-01", "description": "",
+            "finding_id": "", "original_line": 1, "severity": "high", "scan_id": "scan", "single_line_code": "eval(x)"}
+    data = [{**base, "file_path": "a.py"}, {**base, "file_path": "a.py", "line": 50}, {**base, "file_path": "b.py"}]
+    existing_id = ObjectId()
+    b_fingerprint = get_fingerprint(FindingModel.model_validate(data[2]))
+
+    async def insert_many(collection_name, documents, chunk_size):
+        return {'inserted_ids': [str(document['_id']) for document in documents], 'errors': []}
+
+    with patch.object(findingInstance.db, 'insert_many', side_effect=insert_many) as mock_insert_many, \
+         patch.object(findingInstance.db, 'find_in', return_value=[{'_id': existing_id, 'fingerprint': b_fingerprint}]) as mock_find_in, \
+         patch.object(findingInstance.db, 'bulk_write', return_value={}) as mock_bulk_write:
+        await findingInstance.create_many(data)
+
+    documents = mock_insert_many.call_args.args[1]
+    mock_find_in.assert_called_once()
+    assert documents[0]['duplicate'] is False and documents[0]['nb_occurrences'] == 2
+    assert documents[1]['duplicate'] is True and documents[1]['duplicate_finding_id'] == str(documents[0]['_id'])
+    assert documents[2]['duplicate'] is True and documents[2]['duplicate_finding_id'] == str(existing_id)
+    assert len(mock_bulk_write.call_args.args[1]) == 1
+
+@pytest.mark.asyncio
+async def test_create_many_counts_only_inserted_duplicates():
+    base = {"tool": "test", "title": "t", "repo_id": "repo", "line": 1, "client_id": "123", "date": "2000-01-01", "description": "",
+            "finding_id": "", "original_line": 1, "severity": "high", "scan_id": "scan", "single_line_code": "eval(x)", "file_path": "a.py"}
+    data = [dict(base), {**base, "line": 2}, {**base, "line": 3}, {**base, "file_path": "b.py"}]
+    existing_id = ObjectId()
+    b_fingerprint = get_fingerprint(FindingModel.model_validate(data[3]))
+
+    # The in-batch original and the duplicate of the existing original fail to insert
+    async def insert_many(collection_name, documents, chunk_size):
+        return {'inserted_ids': [None if index in (0, 3) else str(document['_id']) for index, document in enumerate(documents)],
+                'errors': [{'index': 0, 'detail': 'failed'}, {'index': 3, 'detail': 'failed'}]}
+
+    with patch.object(findingInstance.db, 'insert_many', side_effect=insert_many) as mock_insert_many, \
+         patch.object(findingInstance.db, 'find_in', return_value=[{'_id': existing_id, 'fingerprint': b_fingerprint}]), \
+         patch.object(findingInstance.db, 'bulk_write', return_value={}) as mock_bulk_write:
+        await findingInstance.create_many(data)
+
+    documents = mock_insert_many.call_args.args[1]
+    promote, repoint = mock_bulk_write.call_args.args[1]
+    assert promote._filter == {'_id': documents[1]['_id']}
+    assert promote._doc == {'$set': {'duplicate': False, 'duplicate_finding_id': None, 'nb_occurrences': 2}}
+    assert repoint._filter == {'_id': {'$in': [documents[2]['_id']]}}
+    assert repoint._doc == {'$set': {'duplicate_finding_id': str(documents[1]['_id'])}}
+
+@pytest.mark.asyncio
+async def test_diff_scans_merges_by_fingerprint():
+    ids = {name: ObjectId() for name in ('old_a', 'old_b', 'old_c', 'new_b', 'new_c', 'new_d')}
+    scans = {
+        'old': [{'_id': str(ids['old_a']), 'fingerprint': 'a', 'status': 'ready'},
+                {'_id': str(ids['old_b']), 'fingerprint': 'b', 'status': 'issued'},
+                {'_id': str(ids['old_c']), 'fingerprint': 'c', 'status': 'solved'}],
+        'new': [{'_id': str(ids['new_b']), 'fingerprint': 'b', 'status': 'new'},
+                {'_id': str(ids['new_c']), 'fingerprint': 'c', 'status': 'new'},
+                {'_id': str(ids['new_d']), 'fingerprint': 'd', 'status': 'new'}]
+    }
+
+    async def iter_many(collection_name, client_id, options, batch_size):
+        for document in scans[options['filters']['scan_id']]:
+            yield document
+
+    with patch.object(findingInstance.db, 'iter_many', side_effect=iter_many), \
+         patch.object(findingInstance.db, 'bulk_write', return_value={'modified_count': 2, 'errors': []}) as mock_bulk_write:
+        result = await findingInstance.diff_scans('123', 'repo', 'old', 'new')
+
+    operations = mock_bulk_write.call_args.args[1]
+    assert result == {'new_count': 2, 'fixed_count': 1, 'unchanged_count': 1, 'modified_count': 2, 'errors': []}
+    assert [(operation._filter['_id'], operation._doc['$set']['status']) for operation in operations] == [(ids['old_a'], 'solved'), (ids['new_b'], 'issued')]
+
+@pytest.mark.asyncio
+async def test_diff_scans_handles_repeated_fingerprints():
+    ids = {name: ObjectId() for name in ('old_a1', 'old_a2', 'old_b1', 'old_b2', 'new_a', 'new_b1', 'new_b2', 'new_c1', 'new_c2')}
+    scans = {
+        'old': [{'_id': str(ids['old_a1']), 'fingerprint': 'a', 'status': 'issued'},
+                {'_id': str(ids['old_a2']), 'fingerprint': 'a', 'status': 'issued'},
+                {'_id': str(ids['old_b1']), 'fingerprint': 'b', 'status': 'solved'},
+                {'_id': str(ids['old_b2']), 'fingerprint': 'b', 'status': 'ready'}],
+        'new': [{'_id': str(ids['new_a']), 'fingerprint': 'a', 'status': 'new'},
+                {'_id': str(ids['new_b1']), 'fingerprint': 'b', 'status': 'new'},
+                {'_id': str(ids['new_b2']), 'fingerprint': 'b', 'status': 'new'},
+                {'_id': str(ids['new_c1']), 'fingerprint': 'c', 'status': 'new'},
+                {'_id': str(ids['new_c2']), 'fingerprint': 'c', 'status': 'new'}]
+    }
+
+    async def iter_many(collection_name, client_id, options, batch_size):
+        for document in scans[options['filters']['scan_id']]:
+            yield document
+
+    with patch.object(findingInstance.db, 'iter_many', side_effect=iter_many), \
+         patch.object(findingInstance.db, 'bulk_write', return_value={'modified_count': 3, 'errors': []}) as mock_bulk_write:
+        result = await findingInstance.diff_scans('123', 'repo', 'old', 'new')
+
+    operations = [(operation._filter['_id'], operation._doc['$set']['status']) for operation in mock_bulk_write.call_args.args[1]]
+    assert result == {'new_count': 2, 'fixed_count': 0, 'unchanged_count': 3, 'modified_count': 3, 'errors': []}
+    assert operations == [(ids['new_a'], 'issued'), (ids['new_b1'], 'ready'), (ids['new_b2'], 'ready')]
+
+@pytest.mark.asyncio
+async def test_diff_scans_aborts_when_a_scan_read_fails():
+    finding = Finding()
+    collection = MagicMock()
+    scans = {'old': [{'_id': ObjectId(), 'fingerprint': fingerprint, 'status': 'ready'} for fingerprint in 'abcd'],
+             'new': [{'_id': ObjectId(), 'fingerprint': 'a', 'status': 'new'}]}
+
+    class Cursor:
+        def __init__(self, scan_id):
+            self.scan_id = scan_id
+
+        def sort(self, *args):
+            return self
+
+        def batch_size(self, *args):
+            return self
+
+        async def __aiter__(self):
+            for document in scans[self.scan_id]:
+                yield dict(document)
+            # The new scan's read breaks after its first document
+            if self.scan_id == 'new':
+                raise AutoReconnect('connection reset')
+
+    collection.find.side_effect = lambda query, fields: Cursor(query['scan_id'])
+
+    with patch.object(finding.db, 'get_collection', return_value=collection), \
+         patch.object(finding.db, 'bulk_write', AsyncMock()) as mock_bulk_write:
+        with pytest.raises(AutoReconnect):
+            await finding.diff_scans('123', 'repo', 'old', 'new')
+
+    mock_bulk_write.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_stats_single_facet_query_cached_until_write():
+    finding = Finding()
+    facet_result = [{'total': [{'count': 3}],
+                     'severity': [{'_id': 'high', 'count': 2}, {'_id': 'low', 'count': 1}],
+                     'status': [{'_id': 'new', 'count': 3}]}]
+
+    with patch.object(finding.db, 'aggregate', return_value=facet_result) as mock_aggregate, \
+         patch.object(finding.db, 'execute_query', return_value=True):
+        first = await finding.stats('123', {'repo_id': 'repo'}, facets=['severity', 'status'])
+        await finding.stats('123', {'repo_id': 'repo'}, facets=['severity', 'status'])
+        await finding.update('123', str(ObjectId()), {'status': 'ready'}, return_document=False)
+        await finding.stats('123', {'repo_id': 'repo'}, facets=['severity', 'status'])
+
+    assert first == {'total': 3, 'facets': {'severity': {'high': 2, 'low': 1}, 'status': {'new': 3}}}
+    assert mock_aggregate.call_count == 2
+    assert mock_aggregate.call_args.args[1][0] == {'$match': {'client_id': '123', 'repo_id': 'repo'}}
+    assert set(mock_aggregate.call_args.args[1][1]['$facet']) == {'total', 'severity', 'status'}
+
+@pytest.mark.asyncio
+async def test_transition_many_is_one_guarded_update():
+    finding = Finding()
+    collection = MagicMock()
+    collection.update_many = AsyncMock(return_value=MagicMock(matched_count=3, modified_count=2))
+
+    with patch.object(finding.db, 'get_collection', return_value=collection):
+        result = await finding.transition_many('123', {'scan_id': 'scan'}, Finding.STATUS_NEW, Finding.STATUS_ENRICHED, {'processing_status': 'done'})
+        await finding.transition_many('123', {'scan_id': 'scan'}, [Finding.STATUS_ENRICHED, Finding.STATUS_READY], Finding.STATUS_ISSUED,
+                                      {'severity_numerical': {'$round': [{'$multiply': ['$cvssv3_score', 10]}, 0]}}, pipeline=True)
+
+    first, second = collection.update_many.call_args_list
+    assert result == {'matched_count': 3, 'modified_count': 2}
+    assert first.args == ({'client_id': '123', 'scan_id': 'scan', 'status': {'$in': ['new']}}, {'$set': {'processing_status': 'done', 'status': 'enriched'}})
+    assert second.args[0]['status'] == {'$in': ['enriched', 'ready']}
+    assert second.args[1] == [{'$set': {'severity_numerical': {'$round': [{'$multiply': ['$cvssv3_score', 10]}, 0]}, 'status': {'$literal': 'issued'}}}]
@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from pymongo.errors import OperationFailure
+from libcovulor.database import Database
+from libcovulor.instrumentation import MemoryCollector, current_operation
+
+@pytest.mark.asyncio
+async def test_memory_collector_records_queries_throttles_and_slow_plans():
+    collector = MemoryCollector(slow_query_ms=0, count_bytes=True)
+    database = Database(instrumentation=collector)
+    collection = MagicMock()
+    collection.name = 'Finding'
+    collection.aggregate.return_value.to_list = AsyncMock(side_effect=[OperationFailure('TooManyRequests', 16500), [{'_id': 'high', 'count': 2}]])
+    collection.database.command = AsyncMock(return_value={'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}})
+
+    with patch.object(database, 'get_collection', return_value=collection), patch('asyncio.sleep'):
+        await database.aggregate('Finding', [{'$group': {'_id': '$severity', 'count': {'$sum': 1}}}])
+
+    snapshot = collector.snapshot()
+    stats = snapshot['operations']['Finding.aggregate']
+    assert (stats['count'], stats['attempts'], stats['documents'], stats['errors']) == (1, 2, 1, 0)
+    assert stats['bytes'] > 0
+    assert stats['p50_ms'] is not None
+    assert (snapshot['throttles'], snapshot['retries']) == (1, 1)
+    assert snapshot['events'][0]['type'] == 'slow_query'
+    assert snapshot['events'][0]['explain'] == {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}
+
+@pytest.mark.asyncio
+async def test_errors_are_structured_events(caplog):
+    collector = MemoryCollector()
+    database = Database(instrumentation=collector)
+    collection = MagicMock()
+    collection.count_documents = AsyncMock(side_effect=OperationFailure('bad query', 2))
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        assert await database.count_documents('Finding', {}) == 0
+
+    snapshot = collector.snapshot()
+    assert snapshot['operations']['Finding.count_documents']['errors'] == 1
+    assert snapshot['events'][0]['type'] == 'error' and 'bad query' in snapshot['events'][0]['detail']
+    assert caplog.records[0].event['operation'] == 'count_documents'
+
+@pytest.mark.asyncio
+async def test_command_listener_counts_server_round_trips_per_operation():
+    collector = MemoryCollector(count_commands=True)
+    database = Database(instrumentation=collector)
+    listener = collector.get_event_listeners()[0]
+    collection = MagicMock()
+    collection.name = 'Finding'
+
+    def command(name, **command):
+        return MagicMock(command_name=name, command={name: 'Finding', **command})
+
+    # Stands in for the driver: a paginated find_many sends a count, a find and a getMore from an executor thread
+    async def count_documents(query):
+        await asyncio.to_thread(listener.started, command('aggregate'))
+        return 120
+
+    def find(*args, **kwargs):
+        cursor = MagicMock()
+        cursor.sort.return_value.skip.return_value.batch_size.return_value.limit.return_value.__aiter__ = lambda self: iterate()
+        return cursor
+
+    async def iterate():
+        await asyncio.to_thread(listener.started, command('find'))
+        yield {'_id': 1}
+        await asyncio.to_thread(listener.started, MagicMock(command_name='getMore', command={'getMore': 1, 'collection': 'Finding'}))
+        yield {'_id': 2}
+
+    collection.count_documents = count_documents
+    collection.find.side_effect = find
+
+    with patch.object(database, 'get_collection', return_value=collection):
+        await database.find_many('Finding', '123', {'pagination': {'page_size': 2}})
+
+    listener.started(MagicMock(command_name='getMore', command={'getMore': 1, 'collection': 'Finding'}))
+    snapshot = collector.snapshot()
+
+    assert snapshot['operations']['Finding.find_many']['attempts'] == 1
+    assert snapshot['operations']['Finding.find_many']['round_trips'] == 3
+    assert snapshot['operations']['Finding.getMore']['round_trips'] == 1
+    assert snapshot['round_trips'] == 4
+    assert current_operation.get() is None
@@ -0,0 +1,184 @@
+import asyncio
+import httpx
+import json
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from datetime import datetime
+from openai import RateLimitError
+from bson import ObjectId
+from pydantic import BaseModel, Field
+from typing import Optional
+from libcovulor.finding import Finding
+from libcovulor.cache import SQLiteResponseCache
+from libcovulor.openai import OpenAIRetryPolicy, get_async_client, get_response_format, read_batch_results, send_message_async, send_messages, write_batch_requests
+
+class Answer(BaseModel):
+    text: str
+
+openai_data = {"api_key": "key", "api_base": "http://localhost", "deployment_name": "gpt", "max_concurrency": 2}
+
+def get_response(text):
+    response = MagicMock()
+    response.choices[0].message.parsed = Answer(text=text)
+    return response
+
+def get_rate_limit_error():
+    response = httpx.Response(429, headers={"retry-after-ms": "10"}, request=httpx.Request("POST", "http://localhost"))
+    return RateLimitError("Rate limit reached", response=response, body=None)
+
+@pytest.mark.asyncio
+async def test_async_client_is_reused():
+    assert get_async_client(openai_data) is get_async_client(dict(openai_data))
+
+@pytest.mark.asyncio
+async def test_send_message_async_retries_rate_limits():
+    client = MagicMock()
+    calls = []
+
+    async def parse(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise get_rate_limit_error()
+        return get_response("ok")
+
+    client.beta.chat.completions.parse = parse
+
+    with patch('libcovulor.openai.get_async_client', return_value=client), patch('asyncio.sleep') as mock_sleep:
+        result = await send_message_async(openai_data, "prompt", "system", Answer)
+
+    assert result == {"text": "ok"}
+    assert len(calls) == 2
+    assert 0.01 <= mock_sleep.call_args.args[0] <= 0.012
+    assert OpenAIRetryPolicy().get_retry_after(get_rate_limit_error()) == 0.01
+
+@pytest.mark.asyncio
+async def test_send_messages_keeps_order_and_bounds_concurrency():
+    client = MagicMock()
+    running = {"now": 0, "max": 0}
+
+    async def parse(messages, **kwargs):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        prompt = messages[1]["content"]
+        await asyncio.sleep(0.01 * (5 - int(prompt)))
+        running["now"] -= 1
+        return get_response(prompt)
+
+    client.beta.chat.completions.parse = parse
+
+    with patch('libcovulor.openai.get_async_client', return_value=client):
+        results = await send_messages(openai_data, [(str(index), "system") for index in range(5)], Answer)
+
+    assert [result["text"] for result in results] == ["0", "1", "2", "3", "4"]
+    assert running["max"] == 2
+
+@pytest.mark.asyncio
+async def test_send_messages_uses_cache_and_dedupes_prompts(tmp_path):
+    client = MagicMock()
+    calls = []
+
+    async def parse(messages, **kwargs):
+        calls.append(messages[1]["content"])
+        return get_response(messages[1]["content"])
+
+    client.beta.chat.completions.parse = parse
+    cache = SQLiteResponseCache(str(tmp_path / 'responses.db'))
+
+    with patch('libcovulor.openai.get_async_client', return_value=client):
+        first = await send_messages(openai_data, [("a", "system"), ("b", "system"), ("a", "system")], Answer, cache=cache)
+        second = await send_messages(openai_data, [("b", "system"), ("a", "system")], Answer, cache=cache)
+
+    assert [result["text"] for result in first] == ["a", "b", "a"]
+    assert [result["text"] for result in second] == ["b", "a"]
+    assert sorted(calls) == ["a", "b"]
+    assert cache.stats()['hits'] == 2
+
+@pytest.mark.asyncio
+async def test_send_message_async_treats_cache_errors_as_misses():
+    client = MagicMock()
+    cache = MagicMock()
+    cache.get = AsyncMock(side_effect=OSError('disk I/O error'))
+    cache.set = AsyncMock(side_effect=OSError('disk I/O error'))
+
+    async def parse(messages, **kwargs):
+        return get_response(messages[1]["content"])
+
+    client.beta.chat.completions.parse = parse
+
+    with patch('libcovulor.openai.get_async_client', return_value=client):
+        results = await send_messages(openai_data, [("a", "system"), ("b", "system")], Answer, cache=cache)
+
+    assert [result["text"] for result in results] == ["a", "b"]
+
+class Location(BaseModel):
+    file: str
+    line: Optional[int] = None
+
+class Review(BaseModel):
+    summary: str
+    location: Location = Field(description="Where the issue is")
+
+def test_response_format_is_strict_json_schema():
+    response_format = get_response_format(Review)
+    schema = response_format["json_schema"]["schema"]
+
+    assert response_format["type"] == "json_schema"
+    assert response_format["json_schema"]["name"] == "Review" and response_format["json_schema"]["strict"]
+    assert schema["additionalProperties"] is False and schema["required"] == ["summary", "location"]
+    assert schema["properties"]["location"]["description"] == "Where the issue is"
+    assert schema["properties"]["location"]["required"] == ["file", "line"]
+    assert schema["properties"]["location"]["additionalProperties"] is False
+    assert "default" not in schema["properties"]["location"]["properties"]["line"]
+
+def run_batch_stub(request_path, result_path, respond):
+    # Local stand-in for the Batch API: answers every request line with respond(request body)
+    with open(request_path, encoding='utf-8') as requests, open(result_path, 'w', encoding='utf-8') as results:
+        for line in requests:
+            request = json.loads(line)
+            content = respond(request["body"])
+            response = {"status_code": 200, "body": {"choices": [{"message": {"role": "assistant", "content": content, "refusal": None}}]}}
+            if content is None:
+                response = {"status_code": 500, "body": {"error": "server error"}}
+            results.write(json.dumps({"id": "batch_req", "custom_id": request["custom_id"], "response": response, "error": None}) + "\n")
+
+def test_batch_request_and_result_files(tmp_path):
+    request_path, result_path = str(tmp_path / "requests.jsonl"), str(tmp_path / "results.jsonl")
+    count = write_batch_requests(request_path, openai_data, [("1", "first", "system"), ("2", "second", "system"), ("3", "third", "system")], Answer)
+
+    run_batch_stub(request_path, result_path,
+                   lambda body: None if body["messages"][1]["content"] == "third" else json.dumps({"text": body["messages"][1]["content"].upper()}))
+
+    with open(request_path, encoding='utf-8') as file:
+        request = json.loads(file.readline())
+
+    assert count == 3
+    assert request["url"] == "/v1/chat/completions"
+    assert request["body"]["response_format"]["json_schema"]["name"] == "Answer"
+    results = list(read_batch_results(result_path, Answer))
+    assert results[:2] == [("1", {"text": "FIRST"}), ("2", {"text": "SECOND"})]
+    assert results[2][1]["status_code"] == 500
+
+@pytest.mark.asyncio
+async def test_finding_enrichment_batch_round_trip(tmp_path):
+    finding = Finding()
+    request_path, result_path = str(tmp_path / "requests.jsonl"), str(tmp_path / "results.jsonl")
+    finding_ids = ["507f1f77bcf86cd799439011", "507f1f77bcf86cd799439012"]
+
+    async def iter_many(collection_name, client_id, options, batch_size):
+        for finding_id in finding_ids:
+            yield {"_id": finding_id, "title": f"title {finding_id}", "tool": "test", "repo_id": "repo", "line": 1, "client_id": "123",
+                   "date": datetime(2000, 1, 1), "description": "", "file_path": "a.py", "finding_id": "", "original_line": 1, "severity": "high"}
+
+    with patch.object(finding.db, 'iter_many', side_effect=iter_many):
+        count = await finding.create_enrichment_batch("123", request_path, openai_data, "system", lambda model: model.title, Answer)
+
+    run_batch_stub(request_path, result_path, lambda body: json.dumps({"text": body["messages"][1]["content"]}))
+
+    with patch.object(finding.db, 'bulk_write', return_value={'matched_count': 2, 'modified_count': 2, 'errors': []}) as mock_bulk_write:
+        result = await finding.apply_enrichment_batch("123", result_path, Answer, to_update=lambda response: {"mitigation": response["text"]})
+
+    operations = mock_bulk_write.call_args.args[1]
+    assert count == 2
+    assert result == {'matched_count': 2, 'modified_count': 2, 'errors': []}
+    assert operations[0]._filter == {"_id": ObjectId(finding_ids[0]), "client_id": "123"}
+    assert operations[0]._doc == {"$set": {"mitigation": f"title {finding_ids[0]}"}}
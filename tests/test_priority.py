@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from unittest.mock import patch, AsyncMock
+from bson import ObjectId
+from libcovulor.finding import Finding
+from libcovulor.priority import get_priority_columns, reprioritize, score_priorities
+
+FINDINGS = [
+    {'cvssv3_score': 9.8, 'estimated_epss': 0.9, 'confidence': 90, 'severity': 'critical', 'exploitability': 'high', 'tags': ['KEV']},
+    {'cvssv3_score': 0.0, 'estimated_epss': 0.0, 'confidence': 50, 'severity': 'low'},
+    {'severity': 'info', 'confidence': None}
+]
+
+def test_score_priorities_is_vectorized_and_bounded():
+    numerical_severities, priorities = score_priorities(get_priority_columns(FINDINGS))
+
+    assert numerical_severities.tolist() == [100, 25, 0]
+    assert priorities.tolist() == [100, 10, 0]
+    assert priorities.dtype == np.int64
+
+def test_score_priorities_uses_custom_weights():
+    _, priorities = score_priorities(get_priority_columns(FINDINGS, tag_boosts={}), {Finding.CONFIDENCE: 1})
+
+    assert priorities.tolist() == [90, 50, 0]
+
+@pytest.mark.asyncio
+async def test_reprioritize_writes_only_changed_findings():
+    finding = Finding()
+    documents = [{'_id': str(ObjectId()), **FINDINGS[0], 'severity_numerical': 100, 'prioritization_value': 100},
+                 {'_id': str(ObjectId()), **FINDINGS[1]}]
+
+    async def iter_many(collection_name, client_id, options, batch_size):
+        for document in documents:
+            yield document
+
+    bulk_write = AsyncMock(return_value={'matched_count': 1, 'modified_count': 1, 'errors': []})
+
+    with patch.object(finding.db, 'iter_many', side_effect=iter_many), patch.object(finding.db, 'bulk_write', bulk_write):
+        result = await reprioritize(finding, '123')
+
+    operations = bulk_write.call_args.args[1]
+    assert result == {'scored_count': 2, 'matched_count': 1, 'modified_count': 1, 'errors': []}
+    assert len(operations) == 1
+    assert operations[0]._doc == {'$set': {'severity_numerical': 25, 'prioritization_value': 10}}
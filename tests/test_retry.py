@@ -0,0 +1,64 @@
+import pytest
+import time
+from unittest.mock import patch, AsyncMock, MagicMock
+from pymongo.errors import OperationFailure
+from libcovulor.database import Database
+from libcovulor.retry import RetryPolicy, TokenBucket
+
+COSMOS_THROTTLE = "Error=16500, RetryAfterMs=72, Details='Response status code does not indicate success: TooManyRequests (429)'"
+
+def test_retry_after_hint_is_honored():
+    policy = RetryPolicy(max_delay=10)
+    delay = policy.get_delay(3, OperationFailure(COSMOS_THROTTLE, 16500))
+
+    assert 0.072 <= delay <= 0.072 * 1.2
+    assert policy.is_retryable({'code': 16500, 'errmsg': 'TooManyRequests'})
+    assert not policy.is_retryable(OperationFailure('not authorized', 13))
+
+def test_backoff_is_capped():
+    policy = RetryPolicy(base_delay=1, max_delay=4)
+
+    assert all(0 <= policy.get_delay(attempt) <= 4 for attempt in range(20))
+
+@pytest.mark.asyncio
+async def test_backoff_stops_at_max_attempts_and_deadline():
+    policy = RetryPolicy(max_attempts=3, deadline=5)
+
+    with patch('asyncio.sleep') as mock_sleep:
+        assert await policy.backoff(0, time.monotonic())
+        assert await policy.backoff(1, time.monotonic())
+        assert not await policy.backoff(2, time.monotonic())
+        assert not await policy.backoff(0, time.monotonic() - 10)
+        assert mock_sleep.call_count == 2
+
+@pytest.mark.asyncio
+async def test_execute_query_gives_up_after_retries():
+    database = Database(retries=2)
+    query = AsyncMock(side_effect=OperationFailure(COSMOS_THROTTLE, 16500))
+
+    with patch.object(database, 'get_collection', return_value=MagicMock()), patch('asyncio.sleep'):
+        result = await database.execute_query('Finding', query)
+
+    assert result is None
+    assert query.call_count == 3
+
+@pytest.mark.asyncio
+async def test_token_bucket_spaces_out_requests():
+    limiter = TokenBucket(rate=10, capacity=2)
+    waits = []
+
+    with patch('asyncio.sleep', side_effect=lambda delay: waits.append(delay)):
+        for _ in range(4):
+            await limiter.acquire()
+
+    assert len(waits) == 2
+    assert waits[0] == pytest.approx(0.1, abs=0.01)
+    assert waits[1] == pytest.approx(0.2, abs=0.01)
+
+@pytest.mark.asyncio
+async def test_rate_limiter_is_shared_per_server():
+    first = Database(rate_limit=50)
+    second = Database(rate_limit=50)
+
+    assert first.rate_limiter is second.rate_limiter
+    assert Database().rate_limiter is None
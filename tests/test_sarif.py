@@ -0,0 +1,145 @@
+import asyncio
+import io
+import json
+import os
+import pytest
+import threading
+from unittest.mock import patch
+from libcovulor.finding import Finding, FindingModel
+from libcovulor.sarif import JsonStream, import_sarif, iter_sarif_findings, iter_sarif_results
+
+SARIF_PATH = os.path.join(os.path.dirname(__file__), '..', 'findings.sarif')
+
+findingInstance = Finding()
+
+def test_json_stream_small_chunks():
+    document = {"runs": [{"results": [{"a": 12345, "b": [1.5, True, None, "x, y"]}, {}]}], "version": "2.1.0"}
+    stream = JsonStream(io.StringIO(json.dumps(document)), chunk_size=3)
+    results = []
+
+    for key in stream.items():
+        if key == 'runs':
+            for _ in stream.elements():
+                for run_key in stream.items():
+                    for _ in stream.elements():
+                        results.append(stream.value())
+        else:
+            assert stream.value() == "2.1.0"
+
+    assert results == document['runs'][0]['results']
+
+def test_iter_sarif_results_matches_full_parse():
+    with open(SARIF_PATH, encoding='utf-8') as file:
+        expected = json.load(file)['runs'][0]['results']
+
+    with open(SARIF_PATH, encoding='utf-8') as file:
+        results = [result for _, _, result in iter_sarif_results(file, chunk_size=16)]
+
+    assert results == expected
+
+def test_sarif_result_mapping():
+    with open(SARIF_PATH, encoding='utf-8') as file:
+        findings = list(iter_sarif_findings(file))
+
+    assert len(findings) == 5
+    assert findings[0][Finding.TOOL] == 'opengrep'
+    assert findings[0][Finding.SCANNER_WEAKNESS] == 'php.lang.security.injection.tainted-sql-string.tainted-sql-string'
+    assert findings[0][Finding.FILE] == 'index.php'
+    assert findings[0][Finding.ACTUAL_LINE] == 20
+    assert findings[0][Finding.SEVERITY] == Finding.SEVERITY_HIGH
+    assert findings[0][Finding.SINGLE_LINE_CODE].startswith('$sql = ')
+    assert findings[3][Finding.SEVERITY] == Finding.SEVERITY_MEDIUM
+    assert findings[3][Finding.CONFIDENCE] == 10
+
+def test_sarif_result_properties_do_not_override_computed_fields():
+    with open(SARIF_PATH, encoding='utf-8') as file:
+        findings = list(iter_sarif_findings(file))
+
+    # The bundled report was exported with status 'enriched', a new import still starts as new
+    assert all(Finding.STATUS not in finding for finding in findings)
+    assert FindingModel.model_validate({**findings[0], Finding.CLIENT_ID: "123", Finding.REPOSITORY_ID: "repo"}).status == Finding.STATUS_NEW
+    assert findings[0]['data_source'] == 'plexalyzer'
+
+    result = {'ruleId': 'rule', 'message': {'text': 'm'}, 'properties': {'confidence': 'HIGH', 'tags': 'sql', 'unknown': 1, 'duplicate_finding_id': 'x'}}
+    finding = list(iter_sarif_findings(io.StringIO(json.dumps({'runs': [{'tool': {'driver': {'name': 't'}}, 'results': [result]}]}))))[0]
+
+    assert finding[Finding.CONFIDENCE] == 50 and finding[Finding.TAGS] == []
+    assert 'unknown' not in finding and Finding.DUPLICATE_ID not in finding
+    FindingModel.model_validate({**finding, Finding.CLIENT_ID: "123", Finding.REPOSITORY_ID: "repo"})
+
+def test_iter_sarif_results_reads_results_before_tool_again():
+    runs = [{'tool': {'driver': {'name': 'first'}}, 'results': [{'ruleId': 'a'}]},
+            {'results': [{'ruleId': 'b'}, {'ruleId': 'c'}], 'tool': {'driver': {'name': 'second', 'rules': [{'id': 'b', 'name': 'B'}]}}},
+            {'tool': {'driver': {'name': 'third'}}, 'results': [{'ruleId': 'd'}]}]
+    document = json.dumps({'runs': runs})
+    results = [(driver['name'], rules['by_id'].get(result['ruleId'], {}).get('name'), result['ruleId'])
+               for driver, rules, result in iter_sarif_results(io.StringIO(document), chunk_size=8)]
+
+    assert results == [('first', None, 'a'), ('second', 'B', 'b'), ('second', None, 'c'), ('third', None, 'd')]
+
+    class Unseekable(io.StringIO):
+        def seekable(self):
+            return False
+
+    with pytest.raises(ValueError):
+        list(iter_sarif_results(Unseekable(document)))
+
+@pytest.mark.asyncio
+async def test_import_sarif_in_batches():
+    batches = []
+
+    async def create_many(data):
+        batches.append(data)
+        return {'data': [object()] * len(data), 'errors': []}
+
+    with patch.object(findingInstance, 'create_many', side_effect=create_many):
+        result = await import_sarif(findingInstance, SARIF_PATH, "123", "repo", scan_id="scan", batch_size=2)
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert all(finding[Finding.SCAN_ID] == "scan" and finding[Finding.CLIENT_ID] == "123" for batch in batches for finding in batch)
+    assert result == {'inserted_count': 5, 'errors': []}
+
+@pytest.mark.asyncio
+async def test_import_sarif_parses_next_batch_during_write():
+    parsed = threading.Event()
+    overlapped = []
+
+    def iter_findings(file, chunk_size):
+        for index in range(4):
+            if index == 2:
+                parsed.set()
+            yield {Finding.TITLE: str(index)}
+
+    async def create_many(data):
+        # The first write only finishes once the second batch has started parsing
+        if not overlapped:
+            overlapped.append(await asyncio.to_thread(parsed.wait, 5))
+        return {'data': [object()] * len(data), 'errors': []}
+
+    with patch('libcovulor.sarif.iter_sarif_findings', side_effect=iter_findings), \
+         patch.object(findingInstance, 'create_many', side_effect=create_many):
+        result = await import_sarif(findingInstance, io.StringIO(''), "123", "repo", batch_size=2)
+
+    assert overlapped == [True]
+    assert result['inserted_count'] == 4
+
+@pytest.mark.asyncio
+async def test_import_sarif_parse_error_finishes_pending_write():
+    batches = []
+
+    def iter_findings(file, chunk_size):
+        yield {Finding.TITLE: '0'}
+        yield {Finding.TITLE: '1'}
+        raise ValueError('Invalid JSON')
+
+    async def create_many(data):
+        await asyncio.sleep(0)
+        batches.append(data)
+        return {'data': [object()] * len(data), 'errors': []}
+
+    with patch('libcovulor.sarif.iter_sarif_findings', side_effect=iter_findings), \
+         patch.object(findingInstance, 'create_many', side_effect=create_many):
+        with pytest.raises(ValueError):
+            await import_sarif(findingInstance, io.StringIO(''), "123", "repo", batch_size=2)
+
+    assert [len(batch) for batch in batches] == [2]